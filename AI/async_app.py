@@ -0,0 +1,1263 @@
+"""Async serving mode for the knowledge base API
+
+Uses the async Azure SDK clients and the async OpenAI client so that one
+worker can multiplex hundreds of in-flight requests. CPU-bound ingestion work
+(PDF/HTML extraction and chunking) runs on a process pool.
+
+    hypercorn async_app:app --workers 4 --bind 0.0.0.0:8000
+"""
+import asyncio
+import copy
+import datetime
+import multiprocessing
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
+import httpx
+from quart import Quart, Blueprint, request, jsonify, render_template
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.storage.blob.aio import BlobServiceClient
+from azure.cosmos.aio import CosmosClient
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError,
+)
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.indexes.aio import SearchIndexClient
+from openai import AsyncAzureOpenAI
+
+from index2 import (
+    CATALOG_FIELDS,
+    Config,
+    Deadline,
+    DocumentNotFoundError,
+    DocumentProcessor,
+    KnowledgeRetriever,
+    LatencyTracker,
+    LearningTools,
+    MetadataStore,
+    NearDuplicateDetector,
+    SingleFlight,
+    StageTimeout,
+    WEB_REQUEST_HEADERS,
+    add_to_keyword_index,
+    artifact_context,
+    artifact_sections,
+    build_document_artifacts,
+    fail_pending_artifacts,
+    split_pool,
+    store_artifacts,
+    as_vector,
+    SEARCH_RESULT_FIELDS,
+    backfill_select,
+    next_chunks_page,
+    open_keyword_index,
+    build_catalog_entry,
+    build_context,
+    expand_topic,
+    fields_in_index,
+    fit_to_index,
+    reciprocal_rank_fusion,
+    chunk_ids,
+    chunk_signatures,
+    duplicate_links,
+    index_batches,
+    prepare_ingest_metadata,
+    previous_chunk_count,
+    compute_simhashes,
+    duplicate_sources,
+    links_within,
+    merged_metadata,
+    record_linker,
+    rehomed_chunk,
+    configured_key_normalizer,
+    logger,
+    odata_string,
+    provision_resources,
+    remove_from_keyword_index,
+    RequestError,
+    document_artifacts_response,
+    generate_learning_material,
+    parse_ask_request,
+    parse_file_upload,
+    parse_learning_request,
+    parse_list_request,
+    parse_upload_request,
+    public_metadata,
+    resolve_artifacts,
+)
+
+# Result handed to followers whose leader was cancelled
+_LEADER_CANCELLED = object()
+
+# Single-flight coalescing on the event loop
+class AsyncSingleFlight(SingleFlight):
+    async def do(self, kind, text, params, func):
+        """Await func once per key; concurrent callers with the same key share its result"""
+        if not Config.COALESCE_REQUESTS:
+            return await func()
+
+        key = self.make_key(kind, text, params)
+        self.calls += 1
+        while True:
+            future = self._in_flight.get(key)
+            if future is None:
+                break
+            result = await asyncio.shield(future)
+            if result is not _LEADER_CANCELLED:
+                self.deduplicated += 1
+                return copy.deepcopy(result)
+            # The leader's request was cancelled; the next waiter runs func itself
+
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[key] = future
+        self.executions += 1
+        try:
+            result = await func()
+            future.set_result(result)
+            return copy.deepcopy(result)
+        except asyncio.CancelledError:
+            # Cancellation belongs to the leader's caller, not to the callers sharing its key
+            future.set_result(_LEADER_CANCELLED)
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting
+            future.exception()
+            raise
+        finally:
+            self._in_flight.pop(key, None)
+
+# Async Azure services
+class AsyncAzureServices:
+    def __init__(self):
+        self.blob_service_client = None
+        self.cosmos_client = None
+        self.search_client = None
+        self.openai_client = None
+        self.web_client = None
+        self._http_session = None
+        self._containers = {}
+        self._index_fields = None
+
+    async def initialize_services(self):
+        """Create the async clients; must run inside the worker's event loop"""
+        try:
+            # One pooled aiohttp session shared by the Azure SDK clients of this worker
+            self._http_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=Config.ASYNC_POOL_SIZE)
+            )
+
+            self.blob_service_client = BlobServiceClient.from_connection_string(
+                Config.AZURE_STORAGE_CONNECTION_STRING, **self._transport_kwargs())
+
+            self.cosmos_client = CosmosClient(
+                Config.COSMOS_DB_ENDPOINT,
+                credential=Config.COSMOS_DB_KEY,
+                **self._transport_kwargs()
+            )
+
+            self.search_client = SearchClient(
+                endpoint=Config.SEARCH_SERVICE_ENDPOINT,
+                index_name=Config.SEARCH_INDEX_NAME,
+                credential=AzureKeyCredential(Config.SEARCH_SERVICE_KEY),
+                **self._transport_kwargs()
+            )
+
+            limits = httpx.Limits(max_connections=Config.ASYNC_POOL_SIZE,
+                                  max_keepalive_connections=Config.ASYNC_POOL_SIZE)
+            self.openai_client = AsyncAzureOpenAI(
+                api_version=Config.AZURE_OPENAI_API_VERSION,
+                azure_endpoint=Config.AZURE_OPENAI_ENDPOINT,
+                api_key=Config.AZURE_OPENAI_API_KEY,
+                http_client=httpx.AsyncClient(limits=limits)
+            )
+
+            # Client for fetching web pages during ingestion
+            self.web_client = httpx.AsyncClient(headers=WEB_REQUEST_HEADERS, limits=limits,
+                                                follow_redirects=True)
+
+            await self._load_index_fields()
+
+            logger.info("Successfully initialized async Azure services")
+
+        except Exception as e:
+            logger.error(f"Error initializing async Azure services: {str(e)}")
+            raise
+
+    async def _load_index_fields(self):
+        """Read the live search index's fields once (see AzureServices.index_fields)"""
+        try:
+            async with SearchIndexClient(endpoint=Config.SEARCH_SERVICE_ENDPOINT,
+                                         credential=AzureKeyCredential(Config.SEARCH_SERVICE_KEY),
+                                         **self._transport_kwargs()) as index_client:
+                index = await index_client.get_index(Config.SEARCH_INDEX_NAME)
+            self._index_fields = frozenset(field.name for field in index.fields)
+        except Exception as e:
+            logger.error(f"Error reading search index fields: {str(e)}")
+
+    def index_fields(self):
+        return self._index_fields
+
+    def _transport_kwargs(self):
+        """A transport of its own for one SDK client over the shared session (see AzureServices)"""
+        return {"transport": AioHttpTransport(session=self._http_session, session_owner=False)}
+
+    async def close(self):
+        for client in (self.blob_service_client, self.cosmos_client, self.search_client,
+                       self.openai_client, self.web_client):
+            try:
+                if client:
+                    # httpx.AsyncClient closes with aclose(); the SDK clients with close()
+                    await (client.aclose() if isinstance(client, httpx.AsyncClient) else client.close())
+            except Exception as e:
+                logger.error(f"Error closing async client: {str(e)}")
+        if self._http_session:
+            await self._http_session.close()
+
+    def get_container(self, name):
+        """Return a cached Cosmos DB container client"""
+        container = self._containers.get(name)
+        if container is None:
+            container = self.cosmos_client.get_database_client(
+                Config.COSMOS_DB_DATABASE_NAME
+            ).get_container_client(name)
+            self._containers[name] = container
+        return container
+
+    def get_metadata_container(self):
+        """Return the Cosmos DB container holding document metadata"""
+        return self.get_container(Config.COSMOS_DB_CONTAINER_NAME)
+
+    def get_catalog_container(self):
+        """Return the Cosmos DB container holding the document catalog"""
+        return self.get_container(Config.COSMOS_DB_CATALOG_CONTAINER_NAME)
+
+    async def generate_embedding(self, text):
+        """Generate embedding vector for a text chunk"""
+        try:
+            response = await self.openai_client.embeddings.create(
+                input=text,
+                model=Config.AZURE_OPENAI_EMBEDDING_MODEL
+            )
+            return as_vector(response.data[0].embedding)
+
+        except Exception as e:
+            logger.error(f"Error generating embedding: {str(e)}")
+            return None
+
+    async def generate_embeddings(self, texts):
+        """Generate embedding vectors for several texts in one call; entries are None on failure"""
+        try:
+            response = await self.openai_client.embeddings.create(
+                input=list(texts),
+                model=Config.AZURE_OPENAI_EMBEDDING_MODEL
+            )
+            embeddings = [None] * len(texts)
+            for item in response.data:
+                embeddings[item.index] = as_vector(item.embedding)
+            return embeddings
+
+        except Exception as e:
+            logger.error(f"Error generating embeddings for {len(texts)} texts: {str(e)}")
+            return [None] * len(texts)
+
+    async def chat(self, messages, temperature, max_tokens):
+        response = await self.openai_client.chat.completions.create(
+            model=Config.AZURE_OPENAI_CHAT_MODEL,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens
+        )
+        return response.choices[0].message.content
+
+# Async document metadata storage
+class AsyncMetadataStore(MetadataStore):
+    """Async counterpart of MetadataStore"""
+    async def get(self, content_id):
+        try:
+            return await self.azure_services.get_metadata_container().read_item(
+                item=content_id, partition_key=content_id)
+        except CosmosResourceNotFoundError:
+            return None
+
+    async def update(self, content_id, change):
+        container = self.azure_services.get_metadata_container()
+        for attempt in range(Config.METADATA_WRITE_RETRIES + 1):
+            item = await self.get(content_id)
+            if item is None:
+                return False
+            if change(item) is False:
+                return True
+            try:
+                await container.replace_item(item=content_id, body=item, etag=item.get("_etag"),
+                                             match_condition=MatchConditions.IfNotModified)
+                return True
+            except CosmosResourceNotFoundError:
+                return False
+            except CosmosAccessConditionFailedError:
+                if attempt == Config.METADATA_WRITE_RETRIES:
+                    raise
+
+    async def _write(self, metadata):
+        container = self.azure_services.get_metadata_container()
+        for attempt in range(Config.METADATA_WRITE_RETRIES + 1):
+            stored = await self.get(metadata["id"])
+            body = merged_metadata(metadata, stored)
+            try:
+                if stored is None:
+                    return await container.create_item(body=body)
+                return await container.replace_item(item=metadata["id"], body=body, etag=stored.get("_etag"),
+                                                    match_condition=MatchConditions.IfNotModified)
+            except (CosmosResourceExistsError, CosmosAccessConditionFailedError):
+                if attempt == Config.METADATA_WRITE_RETRIES:
+                    raise
+
+    async def record_links(self, metadata):
+        found = await asyncio.gather(*[
+            self.update(source, lambda item: record_linker(item, metadata["id"]))
+            for source in metadata["duplicate_of"]
+        ])
+        missing = [source for source, exists in zip(metadata["duplicate_of"], found) if not exists]
+        metadata["links_recorded"] = not missing
+        return missing
+
+    async def upsert(self, metadata):
+        metadata["duplicate_of"] = duplicate_sources(metadata.get("duplicate_chunks"))
+        await self.record_links(metadata)
+        await asyncio.gather(
+            self._write(metadata),
+            self.azure_services.get_catalog_container().upsert_item(body=build_catalog_entry(metadata))
+        )
+
+    async def bulk_upsert(self, items):
+        if not items:
+            return {}
+        for item in items:
+            item["duplicate_of"] = duplicate_sources(item.get("duplicate_chunks"))
+        outside = links_within(items)
+        semaphore = asyncio.Semaphore(Config.METADATA_WRITE_CONCURRENCY)
+
+        async def record(source):
+            async with semaphore:
+                return await self.update(source, lambda item: any([record_linker(item, linker_id)
+                                                                   for linker_id in outside[source]]))
+
+        found = await asyncio.gather(*[record(source) for source in outside])
+        missing = {source: outside[source] for source, exists in zip(outside, found) if not exists}
+        for item in items:
+            item["links_recorded"] = not any(source in missing for source in item["duplicate_of"])
+
+        async def write(item):
+            async with semaphore:
+                await self._write(item)
+
+        catalog = self.azure_services.get_catalog_container()
+        batches = [catalog.execute_item_batch(
+                       batch_operations=[("upsert", (build_catalog_entry(item),))
+                                         for item in items[start:start + Config.METADATA_BATCH_SIZE]],
+                       partition_key=Config.CATALOG_PARTITION)
+                   for start in range(0, len(items), Config.METADATA_BATCH_SIZE)]
+        await asyncio.gather(*[write(item) for item in items], *batches)
+        return missing
+
+    async def list(self, source_type=None, limit=50, continuation=None):
+        query = "SELECT * FROM c"
+        parameters = []
+        if source_type:
+            query += " WHERE c.source_type = @source_type"
+            parameters.append({"name": "@source_type", "value": source_type})
+        query += " ORDER BY c.created_date DESC"
+
+        pages = self.azure_services.get_catalog_container().query_items(
+            query=query,
+            parameters=parameters,
+            partition_key=Config.CATALOG_PARTITION,
+            max_item_count=limit
+        ).by_page(continuation)
+
+        entries = []
+        async for page in pages:
+            entries = [{field: item.get(field) for field in CATALOG_FIELDS} async for item in page]
+            break
+        return entries, pages.continuation_token
+
+    async def indexed_chunk_ids(self, content_id):
+        try:
+            results = await self.azure_services.search_client.search(
+                search_text="*", filter=f"content_id eq '{odata_string(content_id)}'", select=["id"])
+            return [result["id"] async for result in results]
+        except HttpResponseError as e:
+            logger.warning(f"Cannot filter chunks by content ID, probing chunk IDs instead: {str(e)}")
+
+        found = []
+        while True:
+            chunk_id = f"{content_id}-chunk-{len(found)}"
+            try:
+                await self.azure_services.search_client.get_document(key=chunk_id, selected_fields=["id"])
+            except ResourceNotFoundError:
+                return found
+            found.append(chunk_id)
+
+    async def delete_chunks(self, content_id, start, end):
+        return await self.delete_chunk_ids(chunk_ids(content_id, start, end))
+
+    async def delete_chunk_ids(self, ids):
+        await asyncio.gather(*[
+            self.azure_services.search_client.delete_documents(documents=[{"id": chunk_id} for chunk_id in batch])
+            for batch in index_batches(ids)
+        ])
+        await asyncio.to_thread(remove_from_keyword_index, self.keyword_index, ids)
+        return len(ids)
+
+    async def rehome_linked_chunks(self, metadata):
+        content_id = metadata["id"]
+        rehomed = 0
+        for linker_id in metadata.get("linked_by") or []:
+            linked = await self.get(linker_id)
+            links = self._links_to(linked, content_id) if linked else {}
+            if not links:
+                continue
+
+            documents = []
+            for index, canonical in links.items():
+                try:
+                    chunk = await self.azure_services.search_client.get_document(key=canonical)
+                except ResourceNotFoundError:
+                    logger.warning(f"Linked chunk {canonical} of {linked['id']} is missing")
+                    continue
+                documents.append(rehomed_chunk(chunk, linked, int(index)))
+
+            if documents:
+                await self.azure_services.search_client.upload_documents(
+                    documents=fit_to_index(documents, self.azure_services.index_fields()))
+                await asyncio.to_thread(add_to_keyword_index, self.keyword_index, documents)
+
+            for index in links:
+                del linked["duplicate_chunks"][index]
+            await self.upsert(linked)
+            rehomed += len(documents)
+
+        return rehomed
+
+    async def delete(self, content_id):
+        metadata = await self.get(content_id)
+        if metadata is None:
+            return False
+
+        await self.rehome_linked_chunks(metadata)
+        if metadata.get("chunk_count"):
+            deleted_chunks = await self.delete_chunks(content_id, 0, metadata["chunk_count"])
+        else:
+            deleted_chunks = await self.delete_chunk_ids(await self.indexed_chunk_ids(content_id))
+
+        if metadata.get("source_type") not in (None, "web"):
+            try:
+                await self.azure_services.blob_service_client.get_blob_client(
+                    container=Config.AZURE_STORAGE_CONTAINER_NAME,
+                    blob=f"{content_id}.{metadata['source_type']}"
+                ).delete_blob()
+            except ResourceNotFoundError:
+                pass
+
+        try:
+            await self.azure_services.get_catalog_container().delete_item(
+                item=content_id, partition_key=Config.CATALOG_PARTITION)
+        except CosmosResourceNotFoundError:
+            pass
+        await self.azure_services.get_metadata_container().delete_item(item=content_id, partition_key=content_id)
+
+        logger.info(f"Deleted content ID {content_id} and {deleted_chunks} chunks")
+        return True
+
+# CPU-bound ingestion steps, each a single round trip to the process pool
+def prepare_chunks(content, page_spans=None):
+    """Split text into chunks and compute each chunk's SimHash"""
+    chunks = DocumentProcessor._split_into_chunks(content, page_spans)
+    return chunks, compute_simhashes([chunk["text"] for chunk in chunks])
+
+def prepare_pdf(file_data):
+    """Extract and chunk a PDF; returns its text, chunks and chunk SimHashes"""
+    content, page_spans = DocumentProcessor._extract_pdf_content(file_data)
+    return (content,) + prepare_chunks(content, page_spans)
+
+def prepare_html(html, url):
+    """Parse and chunk a web page; returns its text, title, chunks and chunk SimHashes"""
+    content, title = DocumentProcessor._parse_html(html, url)
+    return (content, title) + prepare_chunks(content)
+
+# Async document processor
+class AsyncDocumentProcessor:
+    def __init__(self, azure_services, learning_tools, cpu_executor, metadata_store=None, keyword_index=None):
+        self.azure_services = azure_services
+        self.learning_tools = learning_tools
+        self.cpu_executor = cpu_executor
+        self.keyword_index = keyword_index
+        self.metadata_store = metadata_store or AsyncMetadataStore(azure_services, keyword_index)
+        self._artifact_tasks = set()
+
+    async def _run_cpu(self, func, *args):
+        """Run CPU-bound extraction work off the event loop"""
+        return await asyncio.get_running_loop().run_in_executor(self.cpu_executor, func, *args)
+
+    async def process_document(self, file_data=None, filename=None, url=None, text_content=None,
+                               title=None, source_type=None, content_id=None):
+        """Process documents from different sources (file bytes, URL, or text)"""
+        metadata = None
+        try:
+            reingest = content_id is not None
+            content_id = content_id or str(uuid.uuid4())
+            document_content = ""
+            chunks = None
+
+            # Only existing documents are re-ingested; check before extracting anything
+            previous = await self.metadata_store.get(content_id) if reingest else None
+            if reingest and previous is None:
+                raise DocumentNotFoundError(content_id)
+
+            if file_data is not None:
+                source_type = source_type or os.path.splitext(filename)[1][1:].lower()
+                title = title or os.path.basename(filename)
+
+                if source_type == 'pdf':
+                    document_content, chunks, signatures = await self._run_cpu(prepare_pdf, file_data)
+                else:
+                    document_content = file_data.decode('utf-8', errors='ignore')
+
+                # Upload to blob storage
+                blob_client = self.azure_services.blob_service_client.get_blob_client(
+                    container=Config.AZURE_STORAGE_CONTAINER_NAME,
+                    blob=f"{content_id}.{source_type}"
+                )
+                await blob_client.upload_blob(file_data, overwrite=True)
+
+            elif url:
+                source_type = 'web'
+                document_content, title, chunks, signatures = await self._extract_web_content(url)
+
+            elif text_content:
+                source_type = source_type or 'text'
+                document_content = text_content
+                title = title or f"Note {datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}"
+
+            # Text sent to the process pool once, for chunking and signing together
+            if chunks is None:
+                chunks, signatures = await self._run_cpu(prepare_chunks, document_content)
+
+            metadata = DocumentProcessor._build_metadata(content_id, title, source_type, url,
+                                                         precompute=Config.PRECOMPUTE_ARTIFACTS)
+
+            if previous:
+                # Chunks other documents link to are about to be overwritten
+                await self.metadata_store.rehome_linked_chunks(previous)
+            # Record the chunk count before indexing, so chunks of an interrupted ingest can be deleted
+            prepare_ingest_metadata(metadata, previous, len(chunks))
+            await self.metadata_store.upsert(metadata)
+
+            chunk_count, duplicate_chunks = await self._process_and_index_content(metadata, chunks, signatures)
+
+            # Drop chunks left over from a longer earlier version of the document
+            if previous_chunk_count(previous) > chunk_count:
+                await self.metadata_store.delete_chunks(content_id, chunk_count, previous_chunk_count(previous))
+
+            # Record the chunk count and chunks linked to existing near-duplicates
+            metadata["chunk_count"] = chunk_count
+            metadata["duplicate_chunks"] = duplicate_chunks
+            await self.metadata_store.upsert(metadata)
+
+            if Config.PRECOMPUTE_ARTIFACTS:
+                task = asyncio.create_task(self._precompute_artifacts(document_content, metadata))
+                self._artifact_tasks.add(task)
+                task.add_done_callback(self._artifact_tasks.discard)
+
+            return {"content_id": content_id, "title": title}
+
+        except Exception as e:
+            logger.error(f"Error processing document: {str(e)}")
+            # No artifact job was started; artifacts left pending would stay pending
+            if metadata is not None and metadata["artifacts_status"] == "pending":
+                try:
+                    await self.metadata_store.update(content_id, fail_pending_artifacts(metadata["ingest_version"]))
+                except Exception as update_error:
+                    logger.error(f"Error marking artifacts failed for content ID {content_id}: "
+                                 f"{str(update_error)}")
+            raise
+
+    async def _extract_web_content(self, url):
+        """Fetch a web page, then parse and chunk it on the process pool"""
+        try:
+            response = await self.azure_services.web_client.get(url)
+            response.raise_for_status()
+            return await self._run_cpu(prepare_html, response.text, url)
+
+        except Exception as e:
+            logger.error(f"Error extracting web content from {url}: {str(e)}")
+            return "", url, [], []
+
+    async def _find_duplicates(self, content_id, signatures):
+        """Async counterpart of NearDuplicateDetector.find_duplicates"""
+        candidates = []
+        try:
+            for start in range(0, len(signatures), Config.NEAR_DUPLICATE_LOOKUP_BATCH):
+                batch = [signature for _, signature in signatures[start:start + Config.NEAR_DUPLICATE_LOOKUP_BATCH]]
+                results = await self.azure_services.search_client.search(
+                    search_text="*",
+                    filter=NearDuplicateDetector.build_candidate_filter(batch),
+                    select=["id", "simhash"],
+                    top=1000
+                )
+                candidates.extend(NearDuplicateDetector.parse_candidates([result async for result in results]))
+
+        except Exception as e:
+            logger.error(f"Error looking up near-duplicate chunks: {str(e)}")
+
+        return NearDuplicateDetector.match(content_id, signatures, candidates)
+
+    async def _process_and_index_content(self, metadata, chunks, signatures):
+        """Embed chunks concurrently and index them in one batch
+
+        Returns the number of chunks and a mapping of chunk index to the ID of the
+        existing chunk it duplicates.
+        """
+        try:
+            duplicates = [None] * len(chunks)
+            if Config.DEDUPLICATE_CHUNKS and chunks:
+                duplicates = await self._find_duplicates(metadata["id"], chunk_signatures(metadata["id"], signatures))
+
+            semaphore = asyncio.Semaphore(Config.EMBEDDING_CONCURRENCY)
+
+            async def embed(chunk):
+                async with semaphore:
+                    return await self.azure_services.generate_embedding(chunk)
+
+            new_chunks = [i for i in range(len(chunks)) if not duplicates[i]]
+            embeddings = await asyncio.gather(*[embed(chunks[i]["text"]) for i in new_chunks])
+
+            chunk_docs = [DocumentProcessor._build_chunk_document(metadata, i, chunks[i], embedding, signatures[i])
+                          for i, embedding in zip(new_chunks, embeddings)
+                          if embedding is not None]
+            if chunk_docs:
+                await asyncio.gather(*[
+                    self.azure_services.search_client.upload_documents(
+                        documents=fit_to_index(batch, self.azure_services.index_fields()))
+                    for batch in index_batches(chunk_docs)
+                ])
+                await asyncio.to_thread(add_to_keyword_index, self.keyword_index, chunk_docs)
+
+            duplicate_chunks = duplicate_links(duplicates)
+            logger.info(f"Processed and indexed {len(chunks)} chunks for content ID: {metadata['id']} "
+                        f"({len(duplicate_chunks)} near-duplicates linked)")
+            return len(chunks), duplicate_chunks
+
+        except Exception as e:
+            logger.error(f"Error processing and indexing content: {str(e)}")
+            raise
+
+    async def _precompute_artifacts(self, document_content, metadata):
+        """Async counterpart of ArtifactPrecomputer._precompute"""
+        content_id = metadata["id"]
+        for attempt in range(Config.ARTIFACT_RETRIES + 1):
+            try:
+                artifacts = await self.learning_tools.generate_document_artifacts(document_content, metadata)
+                status = "ready" if artifacts else "empty"
+                break
+            except Exception as e:
+                logger.error(f"Error precomputing artifacts for content ID {content_id} "
+                             f"(attempt {attempt + 1}): {str(e)}")
+                artifacts = None
+                status = "failed"
+                if attempt < Config.ARTIFACT_RETRIES:
+                    await asyncio.sleep(Config.ARTIFACT_RETRY_DELAY * 2 ** attempt)
+
+        try:
+            change = store_artifacts(metadata["ingest_version"], artifacts, status)
+            if await self.metadata_store.update(content_id, change) and change.stored:
+                logger.info(f"Stored precomputed artifacts for content ID: {content_id} ({status})")
+            else:
+                logger.info(f"Discarding stale artifacts for content ID: {content_id}")
+
+        except Exception as e:
+            logger.error(f"Error storing artifacts for content ID {content_id}: {str(e)}")
+
+    async def drain(self):
+        """Wait for background artifact jobs before shutdown"""
+        if self._artifact_tasks:
+            await asyncio.gather(*self._artifact_tasks, return_exceptions=True)
+
+# Async knowledge retrieval
+class AsyncKnowledgeRetriever:
+    def __init__(self, azure_services, key_normalizer=None, keyword_index=None):
+        self.azure_services = azure_services
+        self.keyword_index = keyword_index
+        self.single_flight = AsyncSingleFlight("knowledge_retriever", key_normalizer)
+        self.latencies = {stage: LatencyTracker() for stage in ("embedding", "search", "generation")}
+
+    async def _timed(self, stage, make_call):
+        started = asyncio.get_running_loop().time()
+        result = await make_call()
+        self.latencies[stage].record(asyncio.get_running_loop().time() - started)
+        return result
+
+    async def _run_stage(self, stage, make_call, timeout, hedge=False):
+        """Async counterpart of KnowledgeRetriever._run_stage; losing calls are cancelled"""
+        if timeout <= 0:
+            raise StageTimeout(stage)
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        tasks = [asyncio.create_task(self._timed(stage, make_call))]
+
+        try:
+            hedge_delay = self.latencies[stage].percentile(Config.HEDGE_PERCENTILE) if hedge else None
+            if hedge_delay is not None:
+                hedge_delay = max(hedge_delay, Config.HEDGE_MIN_DELAY)
+                if hedge_delay < timeout:
+                    done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+                    if not done:
+                        logger.info(f"Hedging {stage} call after {hedge_delay:.3f}s")
+                        tasks.append(asyncio.create_task(self._timed(stage, make_call)))
+
+            error = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(timeout - (loop.time() - started), 0),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    break
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+
+            if error is not None and not pending:
+                raise error
+            raise StageTimeout(stage)
+
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def search_knowledge_base(self, query, top_k=5, filter_criteria=None):
+        """Search knowledge base for relevant content based on query"""
+        return await self.single_flight.do("search", query, [top_k, filter_criteria],
+                                           lambda: self._search_knowledge_base(query, top_k, filter_criteria))
+
+    async def _search_knowledge_base(self, query, top_k, filter_criteria):
+        try:
+            fast_results = await asyncio.to_thread(KnowledgeRetriever._keyword_fast_path, self.keyword_index,
+                                                   query, top_k, filter_criteria)
+            if fast_results is not None:
+                return fast_results
+
+            query_embedding = await self.azure_services.generate_embedding(query)
+
+            if query_embedding is None:
+                logger.error("Failed to generate embedding for query; falling back to keyword search")
+
+            return await self._execute_search(query, query_embedding, top_k, filter_criteria)
+
+        except Exception as e:
+            logger.error(f"Error searching knowledge base: {str(e)}")
+            return []
+
+    async def _execute_search(self, query, query_embedding, top_k, filter_criteria):
+        """Async counterpart of KnowledgeRetriever._execute_search"""
+        fetch_k = top_k * 2 if Config.DEDUPLICATE_CHUNKS else top_k
+
+        keyword_results = None
+        if self.keyword_index is not None:
+            try:
+                keyword_results = await asyncio.to_thread(self.keyword_index.search, query, fetch_k,
+                                                          filter_criteria)
+            except Exception as e:
+                logger.error(f"Error searching keyword index: {str(e)}")
+
+        search_kwargs = {}
+        if query_embedding is not None:
+            search_kwargs["vector"] = {"value": query_embedding.tolist(), "k": fetch_k, "fields": "content_vector"}
+
+        results = await self.azure_services.search_client.search(
+            search_text=query,
+            select=fields_in_index(SEARCH_RESULT_FIELDS, self.azure_services.index_fields()),
+            filter=KnowledgeRetriever._build_filter(filter_criteria),
+            top=fetch_k,
+            **search_kwargs
+        )
+
+        search_results = [KnowledgeRetriever._format_result(result) async for result in results]
+        return KnowledgeRetriever._merge_results(search_results, keyword_results, top_k)
+
+    async def multi_query_search(self, queries, top_k=5, filter_criteria=None, deadline=None):
+        """Async counterpart of KnowledgeRetriever.multi_query_search"""
+        deadline = deadline or Deadline(Config.MULTI_QUERY_DEADLINE_SECONDS)
+        try:
+            ranked_lists = await asyncio.gather(*[
+                asyncio.to_thread(KnowledgeRetriever._keyword_fast_path, self.keyword_index, query, top_k,
+                                  filter_criteria)
+                for query in queries
+            ])
+            pending = [i for i, results in enumerate(ranked_lists) if results is None]
+
+            # Embed within a budget that leaves time to search; sub-queries without an
+            # embedding are searched by keyword only
+            embeddings = [None] * len(pending)
+            if pending:
+                try:
+                    embeddings = await asyncio.wait_for(
+                        self.azure_services.generate_embeddings([queries[i] for i in pending]),
+                        deadline.budget(cap=Config.EMBEDDING_TIMEOUT, reserve=Config.MIN_SEARCH_BUDGET)
+                    )
+                except asyncio.TimeoutError:
+                    logger.warning("Sub-query embeddings timed out; falling back to keyword search")
+            searches = await asyncio.gather(
+                *[asyncio.wait_for(self._execute_search(queries[i], embedding, top_k, filter_criteria),
+                                   deadline.remaining())
+                  for i, embedding in zip(pending, embeddings)],
+                return_exceptions=True
+            )
+
+            for i, results in zip(pending, searches):
+                if isinstance(results, asyncio.TimeoutError):
+                    logger.warning(f"Sub-query '{queries[i]}' missed the retrieval deadline")
+                    results = []
+                elif isinstance(results, Exception):
+                    logger.error(f"Error searching sub-query '{queries[i]}': {str(results)}")
+                    results = []
+                ranked_lists[i] = results
+
+            merged = reciprocal_rank_fusion(ranked_lists, [1.0] * len(queries))
+            return KnowledgeRetriever._merge_results(merged, None, top_k)
+
+        except Exception as e:
+            logger.error(f"Error in multi-query search: {str(e)}")
+            return []
+
+    async def get_answer(self, query, top_k=5, filter_criteria=None, deadline=None):
+        """Get answer to a query within a deadline (see KnowledgeRetriever.get_answer)"""
+        deadline = deadline or Deadline(Config.ASK_DEADLINE_SECONDS)
+        return await self.single_flight.do("answer", query, [top_k, filter_criteria, deadline.bucket()],
+                                           lambda: self._get_answer(query, top_k, filter_criteria, deadline))
+
+    async def _get_answer(self, query, top_k, filter_criteria, deadline):
+        degraded = []
+        try:
+            search_results = await asyncio.to_thread(KnowledgeRetriever._keyword_fast_path, self.keyword_index,
+                                                     query, top_k, filter_criteria)
+
+            if search_results is None:
+                query_embedding = None
+                try:
+                    query_embedding = await self._run_stage(
+                        "embedding",
+                        lambda: self.azure_services.generate_embedding(query),
+                        deadline.budget(cap=Config.EMBEDDING_TIMEOUT,
+                                        reserve=Config.MIN_SEARCH_BUDGET + Config.MIN_GENERATION_BUDGET),
+                        hedge=Config.HEDGE_REQUESTS
+                    )
+                except StageTimeout:
+                    logger.warning("Query embedding timed out; falling back to text-only search")
+                if query_embedding is None:
+                    degraded.append("embedding")
+
+                try:
+                    search_results = await self._run_stage(
+                        "search",
+                        lambda: self._execute_search(query, query_embedding, top_k, filter_criteria),
+                        max(deadline.budget(reserve=Config.MIN_GENERATION_BUDGET),
+                            min(deadline.remaining(), Config.MIN_SEARCH_BUDGET)),
+                        hedge=Config.HEDGE_REQUESTS
+                    )
+                except StageTimeout:
+                    logger.warning("Search timed out")
+                    degraded.append("search")
+                    return {
+                        "answer": "Sorry, searching your knowledge base took too long. Please try again.",
+                        "sources": [],
+                        "degraded": degraded
+                    }
+
+            if not search_results:
+                return {
+                    "answer": "I couldn't find any relevant information in your knowledge base.",
+                    "sources": [],
+                    "degraded": degraded
+                }
+
+            sources = KnowledgeRetriever._format_sources(search_results)
+
+            generation_timeout = deadline.budget()
+            if generation_timeout < Config.MIN_GENERATION_BUDGET:
+                degraded.append("generation")
+                return {"answer": None, "sources": sources, "degraded": degraded}
+
+            try:
+                answer = await self._run_stage(
+                    "generation",
+                    lambda: self.azure_services.chat(
+                        KnowledgeRetriever._answer_messages(query, search_results),
+                        temperature=0.3,
+                        max_tokens=1000
+                    ),
+                    generation_timeout
+                )
+            except StageTimeout:
+                logger.warning("Answer generation timed out; returning sources only")
+                degraded.append("generation")
+                return {"answer": None, "sources": sources, "degraded": degraded}
+
+            return {
+                "answer": answer,
+                "sources": sources,
+                "degraded": degraded
+            }
+
+        except Exception as e:
+            logger.error(f"Error getting answer: {str(e)}")
+            return {
+                "answer": "Sorry, I encountered an error while trying to answer your question.",
+                "sources": [],
+                "degraded": degraded
+            }
+
+# Async learning tools
+class AsyncLearningTools:
+    def __init__(self, azure_services, knowledge_retriever, key_normalizer=None):
+        self.azure_services = azure_services
+        self.knowledge_retriever = knowledge_retriever
+        self.single_flight = AsyncSingleFlight("learning_tools", key_normalizer)
+
+    async def _retrieve(self, topic, top_k):
+        """Retrieve context for a topic (see LearningTools._retrieve)"""
+        if Config.MULTI_QUERY_RETRIEVAL:
+            return await self.knowledge_retriever.multi_query_search(expand_topic(topic),
+                                                                     top_k * Config.MULTI_QUERY_TOP_K_FACTOR)
+        return await self.knowledge_retriever.search_knowledge_base(topic, top_k=top_k)
+
+    async def _create_flashcards(self, context, topic, count):
+        text = await self.azure_services.chat(LearningTools._flashcard_messages(context, topic, count),
+                                              temperature=0.5, max_tokens=max(1000, count * 150))
+        return LearningTools._parse_flashcards(text)
+
+    async def _create_summary(self, context, topic):
+        return await self.azure_services.chat(LearningTools._summary_messages(context, topic),
+                                              temperature=0.3, max_tokens=1000)
+
+    async def _create_quiz(self, context, topic, question_count):
+        text = await self.azure_services.chat(LearningTools._quiz_messages(context, topic, question_count),
+                                              temperature=0.5, max_tokens=max(1500, question_count * 250))
+        return LearningTools._parse_quiz(text)
+
+    async def generate_flashcards(self, topic, count=None):
+        """Generate flashcards for a specific topic"""
+        count = count or Config.FLASHCARD_COUNT
+        return await self.single_flight.do("flashcards", topic, [count],
+                                           lambda: self._generate_flashcards(topic, count))
+
+    async def _generate_flashcards(self, topic, count):
+        try:
+            search_results = await self._retrieve(topic, top_k=3)
+            if not search_results:
+                return []
+            return await self._create_flashcards(build_context(search_results), topic, count)
+
+        except Exception as e:
+            logger.error(f"Error generating flashcards: {str(e)}")
+            return []
+
+    async def generate_summary(self, topic):
+        """Generate a summary for a specific topic"""
+        return await self.single_flight.do("summary", topic, None, lambda: self._generate_summary(topic))
+
+    async def _generate_summary(self, topic):
+        try:
+            search_results = await self._retrieve(topic, top_k=5)
+            if not search_results:
+                return "I couldn't find any relevant information to summarize."
+            return await self._create_summary(build_context(search_results), topic)
+
+        except Exception as e:
+            logger.error(f"Error generating summary: {str(e)}")
+            return "Sorry, I encountered an error while trying to generate a summary."
+
+    async def generate_quiz(self, topic, question_count=5):
+        """Generate a quiz for a specific topic"""
+        return await self.single_flight.do("quiz", topic, [question_count],
+                                           lambda: self._generate_quiz(topic, question_count))
+
+    async def _generate_quiz(self, topic, question_count):
+        try:
+            search_results = await self._retrieve(topic, top_k=3)
+            if not search_results:
+                return []
+            return await self._create_quiz(build_context(search_results), topic, question_count)
+
+        except Exception as e:
+            logger.error(f"Error generating quiz: {str(e)}")
+            return []
+
+    async def generate_document_artifacts(self, document_content, metadata):
+        """Generate the summary, flashcard pool and quiz pool for one document concurrently
+
+        Sections of long documents are generated concurrently as well (see
+        LearningTools.generate_document_artifacts).
+        """
+        sections, truncated = artifact_sections(document_content)
+        if not sections:
+            return None
+
+        topic = metadata["title"]
+        contexts = [artifact_context(topic, section) for section in sections]
+
+        async def nothing():
+            return []
+
+        summaries, flashcards, quizzes = await asyncio.gather(
+            asyncio.gather(*[self._create_summary(context, topic) for context in contexts]),
+            asyncio.gather(*[self._create_flashcards(context, topic, count) if count else nothing()
+                             for context, count in zip(contexts, split_pool(Config.FLASHCARD_POOL_SIZE,
+                                                                            len(contexts)))]),
+            asyncio.gather(*[self._create_quiz(context, topic, count) if count else nothing()
+                             for context, count in zip(contexts, split_pool(Config.QUIZ_POOL_SIZE, len(contexts)))])
+        )
+        summary = summaries[0] if len(summaries) == 1 else \
+            await self._create_summary(artifact_context(topic, "\n\n".join(summaries)), topic)
+
+        return build_document_artifacts(metadata, summary, flashcards, quizzes, truncated)
+
+    async def get_document_artifacts(self, content_ids):
+        """Load precomputed artifacts for the given documents (see LearningTools.get_document_artifacts)"""
+        container = self.azure_services.get_metadata_container()
+
+        async def read(content_id):
+            try:
+                return await container.read_item(item=content_id, partition_key=content_id)
+            except CosmosResourceNotFoundError:
+                return None
+
+        items = await asyncio.gather(*[read(content_id) for content_id in content_ids])
+        return resolve_artifacts(items)
+
+async def all_indexed_chunks(search_client, select, page_size=1000):
+    """Async counterpart of index2.all_indexed_chunks, returning a list"""
+    select = list(select)
+    if "uploaded_date" not in select:
+        select.append("uploaded_date")
+    documents, last_date, skip = [], None, 0
+    while True:
+        results = await search_client.search(search_text="*", select=select, order_by=["uploaded_date asc"],
+                                             filter=f"uploaded_date ge {last_date}" if last_date else None,
+                                             top=page_size, skip=skip or None)
+        page = [result async for result in results]
+        documents.extend(page)
+        if len(page) < page_size:
+            return documents
+        last_date, skip = next_chunks_page(page, last_date, skip)
+
+# Per-worker services, created inside the event loop
+class AsyncServices:
+    def __init__(self):
+        self.azure_services = AsyncAzureServices()
+        self.keyword_index = open_keyword_index()
+        self.metadata_store = AsyncMetadataStore(self.azure_services, self.keyword_index)
+        key_normalizer = configured_key_normalizer()
+        self.knowledge_retriever = AsyncKnowledgeRetriever(self.azure_services, key_normalizer, self.keyword_index)
+        self.learning_tools = AsyncLearningTools(self.azure_services, self.knowledge_retriever, key_normalizer)
+        self.cpu_executor = ProcessPoolExecutor(
+            max_workers=Config.INGEST_CPU_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+        self.document_processor = AsyncDocumentProcessor(self.azure_services, self.learning_tools,
+                                                         self.cpu_executor, self.metadata_store, self.keyword_index)
+
+    async def start(self):
+        await self.azure_services.initialize_services()
+
+        # An index kept in process memory only is loaded from the search index
+        if self.keyword_index is not None and not Config.KEYWORD_INDEX_PATH:
+            try:
+                documents = await all_indexed_chunks(self.azure_services.search_client,
+                                                     backfill_select(self.azure_services))
+                await asyncio.to_thread(self.keyword_index.rebuild, documents)
+            except Exception as e:
+                logger.error(f"Error loading keyword index: {str(e)}")
+
+    def coalescing_stats(self):
+        return {
+            "knowledge_retriever": self.knowledge_retriever.single_flight.stats(),
+            "learning_tools": self.learning_tools.single_flight.stats()
+        }
+
+    async def close(self):
+        await self.document_processor.drain()
+        await self.azure_services.close()
+        self.cpu_executor.shutdown(wait=True)
+
+# API endpoints
+api = Blueprint('api', __name__)
+
+def get_services():
+    from quart import current_app
+    return current_app.extensions["knowledge_services"]
+
+@api.route('/')
+async def index():
+    """Main page"""
+    return await render_template('index.html')
+
+@api.route('/api/upload', methods=['POST'])
+async def upload_document():
+    """Upload a document to the knowledge base"""
+    try:
+        files = await request.files
+
+        if 'file' in files:
+            file = files['file']
+            upload = parse_file_upload(file.filename, await request.form)
+            result = await get_services().document_processor.process_document(
+                file_data=file.read(), filename=file.filename, **upload)
+            return jsonify(result)
+
+        upload = parse_upload_request(await request.get_json())
+        result = await get_services().document_processor.process_document(**upload)
+        return jsonify(result)
+
+    except RequestError as e:
+        return jsonify({"error": str(e)}), 400
+    except DocumentNotFoundError:
+        return jsonify({"error": "Document not found"}), 404
+    except Exception as e:
+        logger.error(f"Error in upload_document: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/ask', methods=['POST'])
+async def ask_question():
+    """Ask a question to the knowledge base"""
+    try:
+        query, filter_criteria, deadline = parse_ask_request(await request.get_json())
+        result = await get_services().knowledge_retriever.get_answer(
+            query, filter_criteria=filter_criteria, deadline=deadline)
+        return jsonify(result)
+
+    except RequestError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error in ask_question: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+async def _learning_tool_endpoint(kind):
+    """Serve precomputed material for document-scoped requests, else generate it for the topic"""
+    try:
+        topic, count, content_ids = parse_learning_request(kind, await request.get_json())
+        learning_tools = get_services().learning_tools
+
+        if content_ids:
+            status, documents = await learning_tools.get_document_artifacts(content_ids)
+            response = document_artifacts_response(kind, status, documents, count, topic)
+            if response is not None:
+                body, code = response
+                return jsonify(body), code
+
+        return jsonify({kind: await generate_learning_material(learning_tools, kind, topic, count)})
+
+    except RequestError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error in create_{kind}: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/flashcards', methods=['POST'])
+async def create_flashcards():
+    """Create flashcards for a topic or for specific documents"""
+    return await _learning_tool_endpoint("flashcards")
+
+@api.route('/api/summary', methods=['POST'])
+async def create_summary():
+    """Create a summary for a topic or for specific documents"""
+    return await _learning_tool_endpoint("summary")
+
+@api.route('/api/quiz', methods=['POST'])
+async def create_quiz():
+    """Create a quiz for a topic or for specific documents"""
+    return await _learning_tool_endpoint("quiz")
+
+@api.route('/api/documents', methods=['GET'])
+async def list_documents():
+    """List documents in the knowledge base, newest first"""
+    try:
+        source_type, limit, continuation = parse_list_request(request.args)
+        documents, continuation = await get_services().metadata_store.list(
+            source_type=source_type,
+            limit=limit,
+            continuation=continuation
+        )
+        return jsonify({"documents": documents, "continuation": continuation})
+
+    except RequestError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        logger.error(f"Error in list_documents: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/documents/<content_id>', methods=['GET'])
+async def get_document(content_id):
+    """Get a document's metadata"""
+    try:
+        metadata = await get_services().metadata_store.get(content_id)
+        if metadata is None:
+            return jsonify({"error": "Document not found"}), 404
+        return jsonify(public_metadata(metadata))
+
+    except Exception as e:
+        logger.error(f"Error in get_document: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/documents/<content_id>', methods=['DELETE'])
+async def delete_document(content_id):
+    """Delete a document and all of its chunks"""
+    try:
+        if not await get_services().metadata_store.delete(content_id):
+            return jsonify({"error": "Document not found"}), 404
+        return jsonify({"deleted": content_id})
+
+    except Exception as e:
+        logger.error(f"Error in delete_document: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/metrics/coalescing', methods=['GET'])
+async def coalescing_metrics():
+    """Report how many calls were served from an identical in-flight call"""
+    return jsonify(get_services().coalescing_stats())
+
+def create_app(provision=False):
+    """Async application factory; clients are created per worker when serving starts"""
+    if provision:
+        provision_resources()
+
+    app = Quart(__name__)
+    app.register_blueprint(api)
+
+    @app.before_serving
+    async def start_services():
+        services = AsyncServices()
+        await services.start()
+        app.extensions["knowledge_services"] = services
+
+    @app.after_serving
+    async def stop_services():
+        services = app.extensions.pop("knowledge_services", None)
+        if services:
+            await services.close()
+
+    return app
+
+app = create_app()
+
+if __name__ == '__main__':
+    provision_resources()
+    app.run(debug=True)
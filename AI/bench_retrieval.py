@@ -0,0 +1,198 @@
+"""Benchmark latency and recall of the local keyword index
+
+Offline (default) the keyword index is built over a synthetic corpus with
+planted identifier terms, and exact-term queries are checked against
+brute-force ground truth.
+
+With --live, each query in a JSONL file runs through three retrieval paths
+against the configured Azure services: the search index alone (embedding plus
+its built-in hybrid search, i.e. retrieval without the keyword index), vector
+search fused with the keyword index, and the keyword fast path for exact-term
+queries. Each line is {"query": ..., "relevant": [chunk IDs]}. Without
+"relevant", the top-k of a pure vector search stand in as the reference, so
+that the keyword index is never graded against itself; labelled queries give
+the more meaningful recall.
+
+    python bench_retrieval.py --chunks 20000
+    python bench_retrieval.py --live queries.jsonl
+"""
+import argparse
+import itertools
+import json
+import random
+import time
+
+import numpy as np
+
+from index2 import (
+    AzureServices,
+    BM25Index,
+    Config,
+    KnowledgeRetriever,
+    all_indexed_chunks,
+    backfill_select,
+    compute_simhash,
+    is_exact_term_query,
+)
+
+
+def synthetic_chunks(count, words_per_chunk=300, vocabulary=20000, identifiers=500, seed=0):
+    """Zipf-distributed word chunks; each identifier is planted in one to three chunks"""
+    rng = random.Random(seed)
+    words = [f"w{i}" for i in range(vocabulary)]
+    cumulative = list(itertools.accumulate(1 / (rank + 1) for rank in range(vocabulary)))
+    chunks = [rng.choices(words, cum_weights=cumulative, k=words_per_chunk) for _ in range(count)]
+
+    planted = {}
+    for number in range(identifiers):
+        identifier = f"ERR_{1000 + number}"
+        planted[identifier] = set()
+        for index in rng.sample(range(count), rng.randint(1, 3)):
+            chunks[index].insert(rng.randrange(len(chunks[index])), identifier)
+            planted[identifier].add(str(index))
+
+    documents = [{"id": str(index), "content_id": "bench", "title": "bench", "content": " ".join(chunk),
+                  "source_type": "text", "simhash": format(compute_simhash(" ".join(chunk)), '016x')}
+                 for index, chunk in enumerate(chunks)]
+    return documents, planted
+
+
+def recall(found_ids, relevant, top_k):
+    if not relevant:
+        return None
+    return len(set(found_ids[:top_k]) & set(relevant)) / min(top_k, len(relevant))
+
+
+def vector_reference(retriever, query, top_k):
+    """Chunk IDs of a vector-only search, independent of any keyword ranking"""
+    embedding = retriever._generate_embedding(query)
+    if embedding is None:
+        return None
+    results = retriever.azure_services.search_client.search(
+        search_text=None,
+        vector={"value": embedding.tolist(), "k": top_k, "fields": "content_vector"},
+        select=["id"],
+        top=top_k
+    )
+    return [result["id"] for result in results]
+
+
+def percentiles(latencies):
+    return np.percentile(latencies, 50) * 1000, np.percentile(latencies, 95) * 1000
+
+
+def print_rows(rows):
+    print(f"{'path':<28}{'queries':>9}{'p50 ms':>10}{'p95 ms':>10}{'recall':>9}")
+    for name, latencies, recalls in rows:
+        if not latencies:
+            continue
+        p50, p95 = percentiles(latencies)
+        recalls = [value for value in recalls if value is not None]
+        mean_recall = f"{np.mean(recalls):>9.3f}" if recalls else f"{'-':>9}"
+        print(f"{name:<28}{len(latencies):>9}{p50:>10.2f}{p95:>10.2f}{mean_recall}")
+
+
+def run_offline(chunk_count, query_count, top_k):
+    documents, planted = synthetic_chunks(chunk_count)
+    index = BM25Index()
+
+    started = time.perf_counter()
+    index.add(documents)
+    build = time.perf_counter() - started
+    print(f"{chunk_count} chunks indexed in {build:.2f}s, recall@{top_k}")
+
+    rng = random.Random(1)
+    identifiers = rng.sample(sorted(planted), min(query_count, len(planted)))
+
+    # Substring scan of every chunk: the cost of exact-term matching without an inverted index
+    contents = [(document["id"], document["content"].lower()) for document in documents]
+    scan_latencies = []
+    for identifier in identifiers:
+        started = time.perf_counter()
+        [chunk_id for chunk_id, content in contents if identifier.lower() in content]
+        scan_latencies.append(time.perf_counter() - started)
+
+    fast_latencies, fast_recalls = [], []
+    for identifier in identifiers:
+        started = time.perf_counter()
+        results = KnowledgeRetriever._keyword_fast_path(index, identifier, top_k, None) or []
+        fast_latencies.append(time.perf_counter() - started)
+        fast_recalls.append(recall([result["id"] for result in results], planted[identifier], top_k))
+
+    topic_latencies = []
+    for _ in range(query_count):
+        query = " ".join(f"w{rng.randrange(50, 5000)}" for _ in range(rng.randint(3, 8)))
+        started = time.perf_counter()
+        index.search(query, top_k * 2)
+        topic_latencies.append(time.perf_counter() - started)
+
+    print_rows([("brute-force scan", scan_latencies, []),
+                ("keyword fast path", fast_latencies, fast_recalls),
+                ("BM25 topic queries", topic_latencies, [])])
+
+
+def run_live(query_file, top_k):
+    with open(query_file) as f:
+        queries = [json.loads(line) for line in f if line.strip()]
+
+    azure_services = AzureServices(provision=False)
+    try:
+        keyword_index = BM25Index(Config.KEYWORD_INDEX_PATH or None)
+        if not Config.KEYWORD_INDEX_PATH:
+            keyword_index.rebuild(all_indexed_chunks(azure_services.search_client, backfill_select(azure_services)))
+        print(f"{len(keyword_index)} chunks in the keyword index, {len(queries)} queries, recall@{top_k}")
+
+        baseline = KnowledgeRetriever(azure_services)
+        fused = KnowledgeRetriever(azure_services, keyword_index=keyword_index)
+
+        rows = {name: ([], []) for name in ("search index only", "fused", "keyword fast path")}
+        fast_path = Config.KEYWORD_FAST_PATH
+        for item in queries:
+            query = item["query"]
+            relevant = item.get("relevant")
+            if relevant is None:
+                relevant = vector_reference(baseline, query, top_k)
+
+            Config.KEYWORD_FAST_PATH = False
+            try:
+                for name, retriever in (("search index only", baseline), ("fused", fused)):
+                    started = time.perf_counter()
+                    results = retriever._search_knowledge_base(query, top_k, None)
+                    rows[name][0].append(time.perf_counter() - started)
+                    rows[name][1].append(recall([result["id"] for result in results], relevant, top_k))
+            finally:
+                Config.KEYWORD_FAST_PATH = fast_path
+
+            if is_exact_term_query(query):
+                started = time.perf_counter()
+                results = KnowledgeRetriever._keyword_fast_path(keyword_index, query, top_k, None)
+                if results is not None:
+                    rows["keyword fast path"][0].append(time.perf_counter() - started)
+                    rows["keyword fast path"][1].append(
+                        recall([result["id"] for result in results], relevant, top_k))
+
+        baseline.close()
+        fused.close()
+        print_rows([(name, latencies, recalls) for name, (latencies, recalls) in rows.items()])
+
+    finally:
+        azure_services.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the local keyword index")
+    parser.add_argument("--chunks", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--live", metavar="QUERIES_JSONL",
+                        help="compare retrieval paths against the configured Azure services")
+    args = parser.parse_args(argv)
+
+    if args.live:
+        run_live(args.live, args.top_k)
+    else:
+        run_offline(args.chunks, args.queries, args.top_k)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Benchmark memory, disk footprint and recall of compact vector storage
+
+Compares float32 storage against int8 and float16 quantization, with and
+without exact float32 rescoring, on synthetic clustered embeddings (or on
+vectors from a saved CompactVectorStore with --store).
+
+    python bench_vectors.py --vectors 20000 --queries 200
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from index2 import Config
+from vector_store import CompactVectorStore, normalize
+
+
+def synthetic_vectors(count, dimension, clusters=200, seed=0):
+    """Clustered unit vectors, roughly mimicking topical embedding neighbourhoods"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimension)).astype(np.float32)
+    labels = rng.integers(0, clusters, count)
+    vectors = centers[labels] + 0.6 * rng.standard_normal((count, dimension)).astype(np.float32)
+    return normalize(vectors)
+
+
+def exact_neighbours(vectors, queries, top_k):
+    scores = queries @ vectors.T
+    return np.argsort(-scores, axis=1)[:, :top_k]
+
+
+def run(vectors, queries, top_k):
+    truth = exact_neighbours(vectors, queries, top_k)
+    ids = list(range(len(vectors)))
+    rows = []
+
+    configs = [("float32", "none", False, False),
+               ("float16", "float16", False, False),
+               ("float16 + rescore", "float16", True, True),
+               ("int8", "int8", False, False),
+               ("int8 + rescore", "int8", True, True)]
+
+    for name, quantization, keep_full, rescore in configs:
+        store = CompactVectorStore(vectors.shape[1], quantization, keep_full=keep_full)
+        store.add(ids, vectors)
+
+        with tempfile.TemporaryDirectory() as path:
+            store.save(path)
+            disk = store.disk_bytes(path)
+            loaded = CompactVectorStore.load(path)
+
+            started = time.perf_counter()
+            results = [loaded.search(query, top_k, rescore=rescore) for query in queries]
+            latency = (time.perf_counter() - started) / len(queries)
+
+            memory = loaded.memory_bytes()
+            del loaded
+
+        recall = np.mean([len(set(vector_id for vector_id, _ in found) & set(expected)) / top_k
+                          for found, expected in zip(results, truth)])
+        rows.append((name, memory, disk, recall, latency))
+
+    baseline_memory, baseline_disk = rows[0][1], rows[0][2]
+    print(f"{len(vectors)} vectors x {vectors.shape[1]} dims, {len(queries)} queries, recall@{top_k}")
+    print(f"{'storage':<24}{'memory MB':>11}{'x':>6}{'disk MB':>10}{'x':>6}{'recall':>9}{'ms/query':>10}")
+    for name, memory, disk, recall, latency in rows:
+        print(f"{name:<24}{memory / 2**20:>11.1f}{baseline_memory / memory:>6.1f}"
+              f"{disk / 2**20:>10.1f}{baseline_disk / disk:>6.1f}{recall:>9.4f}{latency * 1000:>10.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark compact vector storage")
+    parser.add_argument("--vectors", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--dimension", type=int, default=Config.VECTOR_DIMENSION)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--store", help="benchmark the float32 vectors of a saved store instead")
+    args = parser.parse_args(argv)
+
+    if args.store:
+        store = CompactVectorStore.load(args.store)
+        vectors = normalize(store._full if store.keep_full else store._codes)
+    else:
+        vectors = synthetic_vectors(args.vectors + args.queries, args.dimension)
+
+    # Hold out perturbed copies of some vectors as queries
+    rng = np.random.default_rng(1)
+    picks = rng.choice(len(vectors), args.queries, replace=False)
+    queries = normalize(vectors[picks] + 0.3 * rng.standard_normal(vectors[picks].shape).astype(np.float32))
+    run(vectors, queries, args.top_k)
+
+
+if __name__ == '__main__':
+    main()
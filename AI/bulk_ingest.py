@@ -0,0 +1,538 @@
+"""Resumable bulk ingestion of document archives
+
+Walks directories, extracts text on a process pool and pipelines the chunks
+through batched embedding and batched indexing, with bounded queues between
+the stages. Completed files are appended to a checkpoint file so that an
+interrupted run resumes without reprocessing them.
+
+    python bulk_ingest.py ./archive --checkpoint archive.checkpoint.jsonl
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from tqdm import tqdm
+
+from index2 import (
+    AzureServices,
+    Config,
+    DocumentProcessor,
+    MetadataStore,
+    NearDuplicateDetector,
+    add_to_keyword_index,
+    chunk_signatures,
+    compute_simhashes,
+    fit_to_index,
+    logger,
+    open_keyword_index,
+    previous_chunk_count,
+    simhash_bands,
+)
+from vector_store import CompactVectorStore
+
+DEFAULT_EXTENSIONS = ("pdf", "txt", "md", "html", "htm", "doc", "docx")
+
+# Queue sentinel marking the end of a stage's output
+_DONE = object()
+
+
+def extract_file(path):
+    """Read and chunk one file; runs in a worker process"""
+    source_type = os.path.splitext(path)[1][1:].lower()
+    with open(path, 'rb') as file:
+        file_data = file.read()
+
+    page_spans = None
+    if source_type == 'pdf':
+        content, page_spans = DocumentProcessor._extract_pdf_content(file_data)
+    elif source_type in ('html', 'htm'):
+        content, _ = DocumentProcessor._parse_html(file_data.decode('utf-8', errors='ignore'), path)
+    else:
+        content = file_data.decode('utf-8', errors='ignore')
+
+    chunks = DocumentProcessor._split_into_chunks(content, page_spans)
+    return {
+        "path": path,
+        "source_type": source_type,
+        "title": os.path.basename(path),
+        "chunks": chunks,
+        "signatures": compute_simhashes([chunk["text"] for chunk in chunks])
+    }
+
+
+def file_content_id(path):
+    """Stable content ID so a re-run overwrites a partially indexed file instead of duplicating it"""
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, "file://" + os.path.abspath(path)))
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": int(stat.st_mtime)}
+
+
+class Checkpoint:
+    """Append-only JSON-lines record of fully ingested files"""
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A torn final line from an interrupted run
+                        continue
+                    self.completed[entry["path"]] = entry
+
+    def is_done(self, path):
+        entry = self.completed.get(os.path.abspath(path))
+        if entry is None:
+            return False
+        signature = file_signature(path)
+        return entry["size"] == signature["size"] and entry["mtime"] == signature["mtime"]
+
+    def mark_done(self, path, content_id, chunk_count):
+        entry = dict(file_signature(path), path=os.path.abspath(path),
+                     content_id=content_id, chunks=chunk_count)
+        with self._lock:
+            self.completed[entry["path"]] = entry
+            if self.path:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(entry) + "\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+
+
+def discover_files(roots, extensions):
+    for root in roots:
+        if os.path.isfile(root):
+            yield root
+            continue
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if os.path.splitext(filename)[1][1:].lower() in extensions:
+                    yield os.path.join(dirpath, filename)
+
+
+class BulkIngester:
+    def __init__(self, azure_services, checkpoint, extract_workers=None, queue_size=64,
+                 embedding_batch_size=None, index_batch_size=None, upload_blobs=True, vector_store=None):
+        self.azure_services = azure_services
+        # Chunks go into the shared keyword index database that the API servers read
+        self.keyword_index = open_keyword_index() if Config.KEYWORD_INDEX_PATH else None
+        self.metadata_store = MetadataStore(azure_services, self.keyword_index)
+        self.checkpoint = checkpoint
+        self.extract_workers = extract_workers or Config.INGEST_CPU_WORKERS
+        self.queue_size = queue_size
+        self.embedding_batch_size = embedding_batch_size or Config.EMBEDDING_BATCH_SIZE
+        self.index_batch_size = index_batch_size or Config.INDEX_BATCH_SIZE
+        self.upload_blobs = upload_blobs
+        # Optional compact local copy of the chunk vectors
+        self.vector_store = vector_store
+        self.duplicate_detector = NearDuplicateDetector(azure_services) if Config.DEDUPLICATE_CHUNKS else None
+
+        # Band index of chunks queued during this run, which may not be searchable yet
+        self._run_bands = [{} for _ in range(Config.SIMHASH_BANDS)]
+
+        # Stage queues: extracted chunks -> embedded documents
+        self.chunk_queue = queue.Queue(maxsize=queue_size * self.embedding_batch_size)
+        self.document_queue = queue.Queue(maxsize=queue_size * self.embedding_batch_size)
+
+        # Per-file bookkeeping so a file is checkpointed only once all its chunks are indexed
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        # Finalized files whose metadata is written in one bulk upsert, then checkpointed;
+        # files are finalized from both the extraction and the indexing thread
+        self._finalized = []
+        self._finalized_lock = threading.Lock()
+        # Links to documents not written yet, as {linked content ID: [linking content IDs]},
+        # recorded in the linked document's linked_by when it is; flushes run one at a
+        # time so a link is never returned after its document has been written
+        self._unrecorded_links = {}
+        self._flush_lock = threading.Lock()
+        self._errors = []
+        self._finished_extractions = 0
+        self.files_done = 0
+        self.chunks_done = 0
+        self.chunks_deduplicated = 0
+
+    def run(self, paths):
+        # A file named twice, e.g. directly and inside a listed directory, is ingested once
+        paths = list(dict.fromkeys(os.path.abspath(path) for path in paths))
+        todo = [path for path in paths if not self.checkpoint.is_done(path)]
+        skipped = len(paths) - len(todo)
+
+        self.file_bar = tqdm(total=len(todo), desc="files", unit="file", position=0)
+        self.chunk_bar = tqdm(desc="chunks", unit="chunk", position=1)
+        started = time.time()
+
+        embedder = threading.Thread(target=self._embed_stage, name="embed", daemon=True)
+        indexer = threading.Thread(target=self._index_stage, name="index", daemon=True)
+        embedder.start()
+        indexer.start()
+
+        try:
+            self._extract_stage(todo)
+        finally:
+            self.chunk_queue.put(_DONE)
+            embedder.join()
+            indexer.join()
+            self._flush_metadata()
+            self.file_bar.close()
+            self.chunk_bar.close()
+        if self._unrecorded_links:
+            logger.warning(f"{len(self._unrecorded_links)} linked documents were not written; "
+                           "their links are recorded when resources are next provisioned")
+
+        elapsed = max(time.time() - started, 1e-9)
+        return {
+            "files_total": len(paths),
+            "files_skipped": skipped,
+            "files_ingested": self.files_done,
+            "files_failed": len(self._errors),
+            "chunks_indexed": self.chunks_done,
+            "chunks_deduplicated": self.chunks_deduplicated,
+            "elapsed_seconds": round(elapsed, 2),
+            "files_per_second": round(self.files_done / elapsed, 2),
+            "chunks_per_second": round(self.chunks_done / elapsed, 2)
+        }
+
+    def _extract_stage(self, paths):
+        """Extract files on a process pool, keeping a bounded number in flight"""
+        in_flight = threading.BoundedSemaphore(self.extract_workers * 2)
+        results = queue.Queue()
+
+        def on_done(future):
+            results.put(future)
+            in_flight.release()
+
+        with ProcessPoolExecutor(max_workers=self.extract_workers,
+                                 mp_context=multiprocessing.get_context("spawn")) as executor:
+            submitted = 0
+            for path in paths:
+                in_flight.acquire()
+                future = executor.submit(extract_file, path)
+                future.path = path
+                future.add_done_callback(on_done)
+                submitted += 1
+                self._drain_extracted(results)
+
+            while self._finished_extractions < submitted:
+                self._handle_extracted(results.get())
+
+    def _drain_extracted(self, results):
+        while True:
+            try:
+                self._handle_extracted(results.get_nowait())
+            except queue.Empty:
+                return
+
+    def _handle_extracted(self, future):
+        self._finished_extractions += 1
+        try:
+            extracted = future.result()
+        except Exception as e:
+            logger.error(f"Error extracting {future.path}: {str(e)}")
+            self._errors.append(future.path)
+            self.file_bar.update(1)
+            return
+
+        path = extracted["path"]
+        metadata = DocumentProcessor._build_metadata(file_content_id(path), extracted["title"],
+                                                     extracted["source_type"])
+        chunks = extracted["chunks"]
+        try:
+            previous_count = self._prepare_reingest(metadata)
+            new_chunks = self._deduplicate(metadata, extracted["signatures"])
+        except Exception as e:
+            logger.error(f"Error preparing {path}: {str(e)}")
+            self._errors.append(path)
+            self.file_bar.update(1)
+            return
+
+        if not new_chunks:
+            self._finalize_file(path, metadata, len(chunks), previous_count)
+            return
+
+        with self._pending_lock:
+            self._pending[metadata["id"]] = {"path": path, "metadata": metadata,
+                                             "remaining": len(new_chunks), "total": len(chunks),
+                                             "previous": previous_count, "failed": False}
+        for i in new_chunks:
+            # Blocks when the embedding stage falls behind
+            self.chunk_queue.put((metadata, i, chunks[i], extracted["signatures"][i]))
+
+    def _prepare_reingest(self, metadata):
+        """Read the metadata of an earlier ingest of a changed file and copy out chunks others link to
+
+        Returns the earlier chunk count; chunks past the new count are deleted
+        when the file is finalized, as DocumentProcessor.process_document does.
+        """
+        previous = self.metadata_store.get(metadata["id"])
+        if not previous:
+            return 0
+        metadata["created_date"] = previous.get("created_date", metadata["created_date"])
+        # Chunks other documents link to are about to be overwritten
+        self.metadata_store.rehome_linked_chunks(previous)
+        return previous_chunk_count(previous)
+
+    def _deduplicate(self, metadata, signatures):
+        """Link near-duplicate chunks and return the indexes of chunks to embed"""
+        if not self.duplicate_detector or not signatures:
+            return list(range(len(signatures)))
+
+        signed_chunks = chunk_signatures(metadata["id"], signatures)
+        matches = self.duplicate_detector.find_duplicates(metadata["id"], signed_chunks)
+
+        # Chunks queued earlier in this run are not in the index yet
+        local = {}
+        for i, signature in enumerate(signatures):
+            for band, value in enumerate(simhash_bands(signature)):
+                for candidate in self._run_bands[band].get(value, ()):
+                    local[candidate[0]] = candidate
+        if local:
+            local_matches = NearDuplicateDetector.match(metadata["id"], signed_chunks, list(local.values()))
+            matches = [match or local_match for match, local_match in zip(matches, local_matches)]
+
+        new_chunks = []
+        for i, (chunk_id, signature) in enumerate(signed_chunks):
+            if matches[i]:
+                metadata["duplicate_chunks"][str(i)] = matches[i]
+                continue
+            new_chunks.append(i)
+            for band, value in enumerate(simhash_bands(signature)):
+                self._run_bands[band].setdefault(value, []).append((chunk_id, signature))
+
+        self.chunks_deduplicated += len(signatures) - len(new_chunks)
+        return new_chunks
+
+    def _embed_stage(self):
+        batch = []
+        while True:
+            item = self.chunk_queue.get()
+            if item is not _DONE:
+                batch.append(item)
+            if batch and (item is _DONE or len(batch) >= self.embedding_batch_size
+                          or self.chunk_queue.empty()):
+                try:
+                    documents = self._embed_batch(batch)
+                except Exception as e:
+                    # A chunk without a document fails its file; the pipeline keeps going
+                    logger.error(f"Error embedding batch of {len(batch)} chunks: {str(e)}")
+                    documents = [(metadata["id"], None) for metadata, _, _, _ in batch]
+                for document in documents:
+                    self.document_queue.put(document)
+                batch = []
+            if item is _DONE:
+                self.document_queue.put(_DONE)
+                return
+
+    def _embed_batch(self, batch):
+        """Embed a batch of queued chunks into (content ID, chunk document or None) pairs"""
+        embeddings = self.azure_services.generate_embeddings([chunk["text"] for _, _, chunk, _ in batch])
+        if self.vector_store is not None:
+            embedded = [(f"{metadata['id']}-chunk-{i}", embedding)
+                        for (metadata, i, _, _), embedding in zip(batch, embeddings)
+                        if embedding is not None]
+            if embedded:
+                self.vector_store.add([chunk_id for chunk_id, _ in embedded],
+                                      np.stack([embedding for _, embedding in embedded]))
+        return [(metadata["id"],
+                 DocumentProcessor._build_chunk_document(metadata, i, chunk, embedding, signature)
+                 if embedding is not None else None)
+                for (metadata, i, chunk, signature), embedding in zip(batch, embeddings)]
+
+    def _index_stage(self):
+        batch = []
+        while True:
+            item = self.document_queue.get()
+            if item is not _DONE:
+                batch.append(item)
+            if batch and (item is _DONE or len(batch) >= self.index_batch_size
+                          or self.document_queue.empty()):
+                try:
+                    self._upload_batch(batch)
+                except Exception as e:
+                    logger.error(f"Error indexing batch of {len(batch)} chunks: {str(e)}")
+                    self._fail_files({content_id for content_id, _ in batch})
+                batch = []
+            if item is _DONE:
+                return
+
+    def _upload_batch(self, batch):
+        documents = [document for _, document in batch if document]
+        rejected = set()
+        if documents:
+            try:
+                results = self.azure_services.search_client.upload_documents(
+                    documents=fit_to_index(documents, self.azure_services.index_fields()))
+            except Exception as e:
+                logger.error(f"Error indexing batch of {len(documents)} chunks: {str(e)}")
+                self._fail_files({content_id for content_id, _ in batch})
+                return
+
+            # The index accepts or rejects each document separately
+            rejected = {result.key for result in results if not result.succeeded}
+            if rejected:
+                logger.error(f"Search index rejected {len(rejected)} of {len(documents)} chunks")
+                documents = [document for document in documents if document["id"] not in rejected]
+
+        add_to_keyword_index(self.keyword_index, documents)
+
+        self.chunks_done += len(documents)
+        self.chunk_bar.update(len(documents))
+
+        completed = []
+        with self._pending_lock:
+            for content_id, document in batch:
+                entry = self._pending.get(content_id)
+                if entry is None:
+                    continue
+                entry["remaining"] -= 1
+                entry["failed"] = entry["failed"] or document is None or document["id"] in rejected
+                if entry["remaining"] == 0:
+                    completed.append(self._pending.pop(content_id))
+
+        for entry in completed:
+            if entry["failed"]:
+                # Leave the file out of the checkpoint so the next run retries it
+                logger.error(f"Embedding or indexing failed for some chunks of {entry['path']}")
+                self._errors.append(entry["path"])
+                self.file_bar.update(1)
+            else:
+                self._finalize_file(entry["path"], entry["metadata"], entry["total"], entry["previous"])
+
+    def _fail_files(self, content_ids):
+        """Count files with chunks still in flight as failed; their remaining chunks are ignored"""
+        with self._pending_lock:
+            for content_id in content_ids:
+                entry = self._pending.pop(content_id, None)
+                if entry:
+                    self._errors.append(entry["path"])
+                    self.file_bar.update(1)
+
+    def _finalize_file(self, path, metadata, chunk_count, previous_count=0):
+        """Store the raw file and queue its metadata for the next bulk upsert
+
+        Chunks of a longer earlier version of the file are deleted first.
+        """
+        try:
+            if previous_count > chunk_count:
+                self.metadata_store.delete_chunks(metadata["id"], chunk_count, previous_count)
+
+            if self.upload_blobs:
+                with open(path, 'rb') as file:
+                    self.azure_services.blob_service_client.get_blob_client(
+                        container=Config.AZURE_STORAGE_CONTAINER_NAME,
+                        blob=f"{metadata['id']}.{metadata['source_type']}"
+                    ).upload_blob(file, overwrite=True)
+
+            metadata["chunk_count"] = chunk_count
+            with self._finalized_lock:
+                self._finalized.append((path, metadata))
+                full = len(self._finalized) >= Config.METADATA_BATCH_SIZE
+            if full:
+                self._flush_metadata()
+
+        except Exception as e:
+            logger.error(f"Error finalizing {path}: {str(e)}")
+            self._errors.append(path)
+            self.file_bar.update(1)
+
+    def _flush_metadata(self):
+        """Write queued metadata in one bulk upsert, then checkpoint those files"""
+        with self._flush_lock:
+            with self._finalized_lock:
+                finalized, self._finalized = self._finalized, []
+            if not finalized:
+                return
+            items = [metadata for _, metadata in finalized]
+            for item in items:
+                if item["id"] in self._unrecorded_links:
+                    item["linked_by"] = self._unrecorded_links[item["id"]]
+            try:
+                missing = self.metadata_store.bulk_upsert(items)
+            except Exception as e:
+                logger.error(f"Error writing metadata for {len(finalized)} files: {str(e)}")
+                self._errors.extend(path for path, _ in finalized)
+                self.file_bar.update(len(finalized))
+                return
+            for item in items:
+                self._unrecorded_links.pop(item["id"], None)
+            for source, linkers in missing.items():
+                self._unrecorded_links.setdefault(source, []).extend(linkers)
+
+        for path, metadata in finalized:
+            self.checkpoint.mark_done(path, metadata["id"], metadata["chunk_count"])
+        with self._finalized_lock:
+            self.files_done += len(finalized)
+        self.file_bar.update(len(finalized))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk ingest documents into the knowledge base")
+    parser.add_argument("paths", nargs="+", help="files or directories to ingest")
+    parser.add_argument("--checkpoint", default="bulk_ingest.checkpoint.jsonl",
+                        help="checkpoint file used to resume interrupted runs")
+    parser.add_argument("--extensions", default=",".join(DEFAULT_EXTENSIONS),
+                        help="comma-separated file extensions to include")
+    parser.add_argument("--workers", type=int, default=Config.INGEST_CPU_WORKERS,
+                        help="extraction processes")
+    parser.add_argument("--queue-size", type=int, default=64,
+                        help="bound on batches buffered between pipeline stages")
+    parser.add_argument("--embedding-batch-size", type=int, default=Config.EMBEDDING_BATCH_SIZE)
+    parser.add_argument("--index-batch-size", type=int, default=Config.INDEX_BATCH_SIZE)
+    parser.add_argument("--skip-blobs", action="store_true",
+                        help="do not copy the raw files to blob storage")
+    parser.add_argument("--vector-store",
+                        help="directory for a compact local copy of the chunk vectors")
+    parser.add_argument("--quantization", default=Config.VECTOR_QUANTIZATION,
+                        choices=["int8", "float16", "none"],
+                        help="quantization of the local vector copy")
+    args = parser.parse_args(argv)
+
+    extensions = {extension.strip().lower().lstrip('.') for extension in args.extensions.split(",")}
+    paths = list(discover_files(args.paths, extensions))
+
+    vector_store = None
+    if args.vector_store:
+        if os.path.exists(os.path.join(args.vector_store, "store.json")):
+            vector_store = CompactVectorStore.load(args.vector_store)
+        else:
+            vector_store = CompactVectorStore(quantization=args.quantization)
+
+    azure_services = AzureServices(provision=True)
+    try:
+        ingester = BulkIngester(
+            azure_services,
+            Checkpoint(args.checkpoint),
+            extract_workers=args.workers,
+            queue_size=args.queue_size,
+            embedding_batch_size=args.embedding_batch_size,
+            index_batch_size=args.index_batch_size,
+            upload_blobs=not args.skip_blobs,
+            vector_store=vector_store
+        )
+        report = ingester.run(paths)
+    finally:
+        azure_services.close()
+        if vector_store is not None:
+            vector_store.save(args.vector_store)
+
+    print(json.dumps(report, indent=2))
+    return 0 if report["files_failed"] == 0 else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,33 @@
+"""Gunicorn configuration for the knowledge base API
+
+Worker and thread counts are tuned through SERVER_WORKERS and SERVER_THREADS
+(see Config in index2.py). Azure resources are provisioned once in the master,
+and each worker builds its own clients and connection pools after fork.
+"""
+from index2 import Config, provision_resources, reset_services, shutdown_services
+
+bind = Config.SERVER_BIND
+workers = Config.SERVER_WORKERS
+threads = Config.SERVER_THREADS
+worker_class = "gthread"
+timeout = Config.SERVER_TIMEOUT
+graceful_timeout = Config.SERVER_TIMEOUT
+keepalive = 5
+
+# Importing the app in the master is cheap because services are created lazily
+preload_app = True
+
+
+def on_starting(server):
+    """Provision the storage container, database and index once per deployment"""
+    provision_resources()
+
+
+def post_fork(server, worker):
+    """Make sure the worker never touches clients created before the fork"""
+    reset_services()
+
+
+def worker_exit(server, worker):
+    """Let background artifact jobs finish and close connection pools"""
+    shutdown_services()
@@ -1,8 +1,14 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Blueprint, request, jsonify, render_template
 import os
 import uuid
 import datetime
 import logging
+import hashlib
+import copy
+import json
+import sqlite3
+import contextlib
+import itertools
 from azure.storage.blob import BlobServiceClient
 from azure.cosmos import CosmosClient, PartitionKey
 from azure.search.documents import SearchClient
@@ -15,25 +21,42 @@ from azure.search.documents.indexes.models import (
     VectorSearch,
     VectorSearchAlgorithmConfiguration
 )
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError,
+)
 from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
 from azure.ai.textanalytics import TextAnalyticsClient
 from openai import AzureOpenAI
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 import fitz  # PyMuPDF
-import io
 import re
 import time
+import random
+import math
+import bisect
 import numpy as np
-from tqdm import tqdm
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    import tiktoken
+except ImportError:  # optional; token counts fall back to a word-based estimate
+    tiktoken = None
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-
 # Configuration
 class Config:
     # Azure Storage configuration
@@ -45,6 +68,12 @@ class Config:
     COSMOS_DB_KEY = os.environ.get("COSMOS_DB_KEY")
     COSMOS_DB_DATABASE_NAME = "PersonalKnowledgeBase"
     COSMOS_DB_CONTAINER_NAME = "ContentMetadata"
+    # Small listing entries kept in one logical partition so listing never fans out
+    COSMOS_DB_CATALOG_CONTAINER_NAME = "ContentCatalog"
+    CATALOG_PARTITION = "catalog"
+    METADATA_BATCH_SIZE = 100  # operations per Cosmos transactional batch (service maximum)
+    METADATA_WRITE_CONCURRENCY = 16  # parallel point writes during bulk upserts
+    METADATA_WRITE_RETRIES = 5  # re-reads of an item written concurrently before a write gives up
     
     # Azure AI Search configuration
     SEARCH_SERVICE_ENDPOINT = os.environ.get("SEARCH_SERVICE_ENDPOINT")
@@ -63,78 +92,191 @@ class Config:
     TEXT_ANALYTICS_KEY = os.environ.get("TEXT_ANALYTICS_KEY")
     
     # Application configuration
-    MAX_CHUNK_SIZE = 1000  # characters
+    CHUNK_TARGET_TOKENS = 400  # chunks close once they reach this many tokens
+    CHUNK_MIN_TOKENS = 200  # chunks may close early at a paragraph break past this size
+    CHUNK_MAX_TOKENS = 600  # sentences longer than this are split on word boundaries
+    CHUNK_OVERLAP_TOKENS = 40  # trailing sentences repeated at the start of the next chunk
+    TOKENIZER_ENCODING = "cl100k_base"  # tokenizer of the embedding model
     VECTOR_DIMENSION = 1536  # dimensions for the embedding model
-    OVERLAP_SIZE = 100  # characters overlap between chunks
     FLASHCARD_COUNT = 5  # default number of flashcards to generate
+    
+    # Precomputed learning artifacts
+    PRECOMPUTE_ARTIFACTS = os.environ.get("PRECOMPUTE_ARTIFACTS", "true").lower() == "true"
+    ARTIFACT_WORKERS = int(os.environ.get("ARTIFACT_WORKERS", "2"))
+    ARTIFACT_CONTEXT_CHARS = 12000  # characters of document text per generation call
+    ARTIFACT_MAX_SECTIONS = 8  # sections of ARTIFACT_CONTEXT_CHARS covered; text past them is left out
+    FLASHCARD_POOL_SIZE = 20  # flashcards precomputed per document
+    QUIZ_POOL_SIZE = 15  # quiz questions precomputed per document
+    ARTIFACT_RETRIES = 2  # extra attempts after a failed artifact generation
+    ARTIFACT_RETRY_DELAY = 2.0  # seconds before the first retry, doubled for each further one
+    
+    # Server configuration
+    SERVER_BIND = os.environ.get("SERVER_BIND", "0.0.0.0:8000")
+    SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", str(2 * (os.cpu_count() or 1) + 1)))
+    SERVER_THREADS = int(os.environ.get("SERVER_THREADS", "8"))
+    SERVER_TIMEOUT = int(os.environ.get("SERVER_TIMEOUT", "120"))  # seconds
+    
+    # Async serving configuration (async_app.py)
+    ASYNC_POOL_SIZE = int(os.environ.get("ASYNC_POOL_SIZE", "200"))  # connections per client per worker
+    INGEST_CPU_WORKERS = int(os.environ.get("INGEST_CPU_WORKERS", str(os.cpu_count() or 1)))
+    EMBEDDING_CONCURRENCY = 8  # in-flight embedding calls per ingested document
+    
+    # Bulk ingestion configuration (bulk_ingest.py)
+    EMBEDDING_BATCH_SIZE = 16  # chunks per embeddings call
+    INDEX_BATCH_SIZE = 500  # documents per search index upload
+    
+    # Near-duplicate chunk detection
+    DEDUPLICATE_CHUNKS = os.environ.get("DEDUPLICATE_CHUNKS", "true").lower() == "true"
+    NEAR_DUPLICATE_MAX_DISTANCE = 3  # max differing SimHash bits (of 64) for a near-duplicate
+    NEAR_DUPLICATE_LOOKUP_BATCH = 32  # chunks per candidate lookup query
+    SIMHASH_BANDS = 4  # 16-bit bands; any pair within 3 bits shares at least one band
+    
+    # Deadlines and hedging for /api/ask
+    ASK_DEADLINE_SECONDS = float(os.environ.get("ASK_DEADLINE_SECONDS", "20"))
+    MAX_DEADLINE_SECONDS = 60.0  # cap on client-requested deadlines
+    EMBEDDING_TIMEOUT = 2.0  # seconds before falling back to text-only search
+    MIN_SEARCH_BUDGET = 0.5  # seconds of deadline needed to attempt a search
+    MIN_GENERATION_BUDGET = 3.0  # seconds of deadline needed to attempt an answer
+    HEDGE_REQUESTS = os.environ.get("HEDGE_REQUESTS", "false").lower() == "true"
+    HEDGE_PERCENTILE = 95  # hedge idempotent calls slower than this latency percentile
+    HEDGE_MIN_SAMPLES = 20  # latency samples needed before hedging a stage
+    HEDGE_MIN_DELAY = 0.05  # seconds
+    STAGE_WORKERS = 32  # threads per worker process for deadline-bounded stage calls
+    # HTTP connections kept per client in each worker; defaults to one per request thread
+    # and one per stage thread, since stage calls run on their own threads
+    HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", str(SERVER_THREADS + STAGE_WORKERS)))
+    
+    # Local vector storage (vector_store.py)
+    VECTOR_QUANTIZATION = os.environ.get("VECTOR_QUANTIZATION", "int8")  # int8, float16 or none
+    VECTOR_RESCORE_FACTOR = 4  # candidates rescored in float32 per requested result
+    
+    # Request coalescing for identical in-flight queries and topics
+    COALESCE_REQUESTS = os.environ.get("COALESCE_REQUESTS", "true").lower() == "true"
+    COALESCE_KEY_NORMALIZER = os.environ.get("COALESCE_KEY_NORMALIZER", "default")  # default or exact
+    
+    # Local BM25 keyword index fused with vector search results
+    KEYWORD_INDEX = os.environ.get("KEYWORD_INDEX", "true").lower() == "true"
+    # SQLite database shared by all processes; empty keeps the index in process memory only
+    KEYWORD_INDEX_PATH = os.environ.get(
+        "KEYWORD_INDEX_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "keyword_index.db"))
+    RRF_K = 60  # reciprocal rank fusion constant
+    # Fusion weight of search index (vector plus its own text) results
+    SEARCH_INDEX_WEIGHT = float(os.environ.get("SEARCH_INDEX_WEIGHT", "1.0"))
+    KEYWORD_WEIGHT = float(os.environ.get("KEYWORD_WEIGHT", "1.0"))  # fusion weight of BM25 results
+    # Answer exact-term queries from the keyword index without embedding or searching
+    KEYWORD_FAST_PATH = os.environ.get("KEYWORD_FAST_PATH", "true").lower() == "true"
+    FAST_PATH_MAX_TERMS = 4  # longer queries always go through hybrid search
+    
+    # Multi-query retrieval for flashcards, summaries and quizzes
+    MULTI_QUERY_RETRIEVAL = os.environ.get("MULTI_QUERY_RETRIEVAL", "true").lower() == "true"
+    MULTI_QUERY_COUNT = 4  # sub-queries per topic, including the topic itself
+    MULTI_QUERY_FACETS = ["key concepts", "examples", "details"]  # appended to the topic as sub-queries
+    MULTI_QUERY_TOP_K_FACTOR = 2  # merged context is this many times the chunks a single query retrieves
+    MULTI_QUERY_DEADLINE_SECONDS = float(os.environ.get("MULTI_QUERY_DEADLINE_SECONDS", "15"))
 
 # Initialize Azure Services
 class AzureServices:
-    def __init__(self):
+    def __init__(self, provision=True):
         self.blob_service_client = None
         self.cosmos_client = None
         self.search_index_client = None
         self.search_client = None
         self.openai_client = None
         self.text_analytics_client = None
-        self.initialize_services()
+        self._http_session = None
+        self._openai_http_client = None
+        self._containers = {}
+        self._index_fields = None
+        self.initialize_services(provision)
+        
+    def initialize_services(self, provision=True):
+        """Create clients, and optionally the storage container, database and index
         
-    def initialize_services(self):
+        Provisioning makes several management calls, so server workers skip it
+        and rely on provision_resources() having run once before forking.
+        """
         try:
+            # One pooled HTTP session shared by the Azure SDK clients of this process
+            self._http_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=Config.HTTP_POOL_SIZE,
+                                  pool_maxsize=Config.HTTP_POOL_SIZE)
+            self._http_session.mount("https://", adapter)
+            self._http_session.mount("http://", adapter)
+            
             # Initialize Azure Blob Storage
             self.blob_service_client = BlobServiceClient.from_connection_string(
-                Config.AZURE_STORAGE_CONNECTION_STRING)
+                Config.AZURE_STORAGE_CONNECTION_STRING, **self._transport_kwargs())
             
-            # Create container if it doesn't exist
-            container_client = self.blob_service_client.get_container_client(
-                Config.AZURE_STORAGE_CONTAINER_NAME)
-            if not container_client.exists():
-                container_client.create_container()
+            if provision:
+                # Create container if it doesn't exist
+                container_client = self.blob_service_client.get_container_client(
+                    Config.AZURE_STORAGE_CONTAINER_NAME)
+                if not container_client.exists():
+                    container_client.create_container()
             
             # Initialize Azure Cosmos DB
             self.cosmos_client = CosmosClient(
                 Config.COSMOS_DB_ENDPOINT, 
-                credential=Config.COSMOS_DB_KEY
+                credential=Config.COSMOS_DB_KEY,
+                **self._transport_kwargs()
             )
             
-            # Create database if it doesn't exist
-            database = self.cosmos_client.create_database_if_not_exists(
-                id=Config.COSMOS_DB_DATABASE_NAME
-            )
-            
-            # Create container if it doesn't exist
-            database.create_container_if_not_exists(
-                id=Config.COSMOS_DB_CONTAINER_NAME,
-                partition_key=PartitionKey(path="/id")
-            )
+            if provision:
+                # Create database if it doesn't exist
+                database = self.cosmos_client.create_database_if_not_exists(
+                    id=Config.COSMOS_DB_DATABASE_NAME
+                )
+                
+                # Create container if it doesn't exist
+                database.create_container_if_not_exists(
+                    id=Config.COSMOS_DB_CONTAINER_NAME,
+                    partition_key=PartitionKey(path="/id")
+                )
+                
+                # Create the document catalog used for listing
+                database.create_container_if_not_exists(
+                    id=Config.COSMOS_DB_CATALOG_CONTAINER_NAME,
+                    partition_key=PartitionKey(path="/pk")
+                )
             
             # Initialize Azure AI Search
             self.search_index_client = SearchIndexClient(
                 endpoint=Config.SEARCH_SERVICE_ENDPOINT,
-                credential=AzureKeyCredential(Config.SEARCH_SERVICE_KEY)
+                credential=AzureKeyCredential(Config.SEARCH_SERVICE_KEY),
+                **self._transport_kwargs()
             )
             
-            # Create search index if it doesn't exist
-            if not self._index_exists():
-                self._create_search_index()
+            # Create the search index if it doesn't exist, or add fields it lacks
+            if provision:
+                if self._index_exists():
+                    self._update_search_index()
+                else:
+                    self._create_search_index()
             
             self.search_client = SearchClient(
                 endpoint=Config.SEARCH_SERVICE_ENDPOINT,
                 index_name=Config.SEARCH_INDEX_NAME,
-                credential=AzureKeyCredential(Config.SEARCH_SERVICE_KEY)
+                credential=AzureKeyCredential(Config.SEARCH_SERVICE_KEY),
+                **self._transport_kwargs()
             )
             
-            # Initialize Azure OpenAI
+            # Initialize Azure OpenAI with its own pooled HTTP client
+            self._openai_http_client = httpx.Client(
+                limits=httpx.Limits(max_connections=Config.HTTP_POOL_SIZE,
+                                    max_keepalive_connections=Config.HTTP_POOL_SIZE)
+            )
             self.openai_client = AzureOpenAI(
                 api_version=Config.AZURE_OPENAI_API_VERSION,
                 azure_endpoint=Config.AZURE_OPENAI_ENDPOINT,
-                api_key=Config.AZURE_OPENAI_API_KEY
+                api_key=Config.AZURE_OPENAI_API_KEY,
+                http_client=self._openai_http_client
             )
             
             # Initialize Azure Text Analytics
             self.text_analytics_client = TextAnalyticsClient(
                 endpoint=Config.TEXT_ANALYTICS_ENDPOINT,
-                credential=AzureKeyCredential(Config.TEXT_ANALYTICS_KEY)
+                credential=AzureKeyCredential(Config.TEXT_ANALYTICS_KEY),
+                **self._transport_kwargs()
             )
             
             logger.info("Successfully initialized all Azure services")
@@ -143,6 +285,52 @@ class AzureServices:
             logger.error(f"Error initializing Azure services: {str(e)}")
             raise
     
+    def _transport_kwargs(self):
+        """A transport of its own for one SDK client, over the shared session
+        
+        Closing a client closes its transport, so clients must not share one;
+        the session itself is only closed by close().
+        """
+        return {"transport": RequestsTransport(session=self._http_session, session_owner=False)}
+    
+    def index_fields(self):
+        """Names of the live search index's fields, read once per process
+        
+        An index created by an older version may lack newer fields until
+        provisioning adds them. Returns None if the index cannot be read, in
+        which case callers assume every field exists.
+        """
+        if self._index_fields is None:
+            try:
+                index = self.search_index_client.get_index(Config.SEARCH_INDEX_NAME)
+                self._index_fields = frozenset(field.name for field in index.fields)
+            except Exception as e:
+                logger.error(f"Error reading search index fields: {str(e)}")
+        return self._index_fields
+    
+    def generate_embeddings(self, texts, timeout=None):
+        """Generate embedding vectors for several texts in one call
+        
+        Returns a list aligned with texts; entries are None if the call failed
+        or took longer than timeout seconds.
+        """
+        try:
+            options = {"timeout": timeout} if timeout is not None else {}
+            response = self.openai_client.embeddings.create(
+                input=list(texts),
+                model=Config.AZURE_OPENAI_EMBEDDING_MODEL,
+                **options
+            )
+            
+            embeddings = [None] * len(texts)
+            for item in response.data:
+                embeddings[item.index] = as_vector(item.embedding)
+            return embeddings
+        
+        except Exception as e:
+            logger.error(f"Error generating embeddings for {len(texts)} texts: {str(e)}")
+            return [None] * len(texts)
+    
     def _index_exists(self):
         try:
             indexes = list(self.search_index_client.list_indexes())
@@ -154,6 +342,62 @@ class AzureServices:
             logger.error(f"Error checking if index exists: {str(e)}")
             return False
     
+    def close(self):
+        """Release the HTTP connection pools held by this process"""
+        for client in (self.blob_service_client, self.search_index_client, self.search_client,
+                       self.text_analytics_client):
+            try:
+                if client:
+                    client.close()
+            except Exception as e:
+                logger.error(f"Error closing Azure client: {str(e)}")
+        if self._openai_http_client:
+            self._openai_http_client.close()
+        if self._http_session:
+            self._http_session.close()
+    
+    def get_container(self, name):
+        """Return a cached Cosmos DB container client"""
+        container = self._containers.get(name)
+        if container is None:
+            container = self.cosmos_client.get_database_client(
+                Config.COSMOS_DB_DATABASE_NAME
+            ).get_container_client(name)
+            self._containers[name] = container
+        return container
+    
+    def get_metadata_container(self):
+        """Return the Cosmos DB container holding document metadata"""
+        return self.get_container(Config.COSMOS_DB_CONTAINER_NAME)
+    
+    def get_catalog_container(self):
+        """Return the Cosmos DB container holding the document catalog"""
+        return self.get_container(Config.COSMOS_DB_CATALOG_CONTAINER_NAME)
+    
+    @staticmethod
+    def _search_fields():
+        """Fields of the search index, in the order they are created"""
+        return [
+            SimpleField(name="id", type=SearchFieldDataType.String, key=True),
+            SimpleField(name="content_id", type=SearchFieldDataType.String, filterable=True),
+            SimpleField(name="source_type", type=SearchFieldDataType.String, filterable=True),
+            SimpleField(name="title", type=SearchFieldDataType.String, filterable=True, sortable=True),
+            SimpleField(name="url", type=SearchFieldDataType.String),
+            SimpleField(name="uploaded_date", type=SearchFieldDataType.DateTimeOffset, filterable=True, sortable=True),
+            SimpleField(name="chunk_id", type=SearchFieldDataType.String),
+            SimpleField(name="page_start", type=SearchFieldDataType.Int32, filterable=True),
+            SimpleField(name="page_end", type=SearchFieldDataType.Int32, filterable=True),
+            SimpleField(name="char_start", type=SearchFieldDataType.Int32),
+            SimpleField(name="char_end", type=SearchFieldDataType.Int32),
+            SimpleField(name="simhash", type=SearchFieldDataType.String),
+            *[SimpleField(name=f"simhash_b{band}", type=SearchFieldDataType.String, filterable=True)
+              for band in range(Config.SIMHASH_BANDS)],
+            SearchableField(name="content", type=SearchFieldDataType.String),
+            SearchableField(name="content_vector", type=SearchFieldDataType.Collection(SearchFieldDataType.Single), 
+                           vector_search_dimensions=Config.VECTOR_DIMENSION, 
+                           vector_search_configuration="vector-config")
+        ]
+    
     def _create_search_index(self):
         try:
             # Define vector search configuration
@@ -172,40 +416,649 @@ class AzureServices:
                 ]
             )
             
-            # Define index fields
-            fields = [
-                SimpleField(name="id", type=SearchFieldDataType.String, key=True),
-                SimpleField(name="content_id", type=SearchFieldDataType.String),
-                SimpleField(name="source_type", type=SearchFieldDataType.String, filterable=True),
-                SimpleField(name="title", type=SearchFieldDataType.String, filterable=True, sortable=True),
-                SimpleField(name="url", type=SearchFieldDataType.String),
-                SimpleField(name="uploaded_date", type=SearchFieldDataType.DateTimeOffset, filterable=True, sortable=True),
-                SimpleField(name="chunk_id", type=SearchFieldDataType.String),
-                SearchableField(name="content", type=SearchFieldDataType.String),
-                SearchableField(name="content_vector", type=SearchFieldDataType.Collection(SearchFieldDataType.Single), 
-                               vector_search_dimensions=Config.VECTOR_DIMENSION, 
-                               vector_search_configuration="vector-config")
-            ]
-            
             # Create the index
-            index = SearchIndex(name=Config.SEARCH_INDEX_NAME, fields=fields, vector_search=vector_search)
+            index = SearchIndex(name=Config.SEARCH_INDEX_NAME, fields=self._search_fields(),
+                                vector_search=vector_search)
             self.search_index_client.create_index(index)
             logger.info(f"Created search index: {Config.SEARCH_INDEX_NAME}")
         
         except Exception as e:
             logger.error(f"Error creating search index: {str(e)}")
             raise
+    
+    def _update_search_index(self):
+        """Add fields introduced since an existing search index was created
+        
+        Azure AI Search accepts new fields on an existing index but cannot
+        change existing ones, so missing fields are only ever added.
+        """
+        try:
+            index = self.search_index_client.get_index(Config.SEARCH_INDEX_NAME)
+            existing = {field.name for field in index.fields}
+            missing = [field for field in self._search_fields() if field.name not in existing]
+            if not missing:
+                return
+            
+            index.fields = list(index.fields) + missing
+            self.search_index_client.create_or_update_index(index)
+            logger.info(f"Added fields to search index {Config.SEARCH_INDEX_NAME}: "
+                        f"{', '.join(field.name for field in missing)}")
+        
+        except Exception as e:
+            logger.error(f"Error updating search index: {str(e)}")
+            raise
+
+def as_vector(values):
+    """Convert an embedding from the API into a compact float32 array"""
+    return np.asarray(values, dtype=np.float32)
+
+def compute_simhash(text):
+    """64-bit SimHash of a text over 3-word shingles"""
+    words = re.findall(r'\w+', text.lower())
+    shingles = [' '.join(words[i:i + 3]) for i in range(max(len(words) - 2, 1))]
+    weights = [0] * 64
+    
+    for shingle in shingles:
+        value = int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+def compute_simhashes(chunks):
+    return [compute_simhash(chunk) for chunk in chunks]
+
+def simhash_bands(simhash):
+    """Split a SimHash into fixed-width hex bands used for candidate lookup"""
+    width = 64 // Config.SIMHASH_BANDS
+    mask = (1 << width) - 1
+    return [format(simhash >> (band * width) & mask, f'0{width // 4}x') for band in range(Config.SIMHASH_BANDS)]
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+# Near-duplicate detection across the indexed corpus
+class NearDuplicateDetector:
+    def __init__(self, azure_services):
+        self.azure_services = azure_services
+    
+    @staticmethod
+    def build_candidate_filter(signatures):
+        """OData filter matching indexed chunks that share any band with the signatures"""
+        parts = []
+        for band in range(Config.SIMHASH_BANDS):
+            values = sorted({simhash_bands(signature)[band] for signature in signatures})
+            parts.append(f"search.in(simhash_b{band}, '{','.join(values)}', ',')")
+        return " or ".join(parts)
+    
+    @staticmethod
+    def match(content_id, signatures, candidates):
+        """Return the canonical chunk ID for each signature, or None if it is new
+        
+        Candidates are (chunk ID, SimHash) pairs already in the index; earlier
+        chunks of the same batch also count, while a document's own previously
+        indexed chunks are ignored so re-ingesting it does not link to itself.
+        """
+        own_prefix = f"{content_id}-chunk-"
+        known = [(chunk_id, signature) for chunk_id, signature in candidates
+                 if not chunk_id.startswith(own_prefix)]
+        matches = []
+        
+        for chunk_id, signature in signatures:
+            canonical = None
+            for known_id, known_signature in known:
+                if hamming_distance(signature, known_signature) <= Config.NEAR_DUPLICATE_MAX_DISTANCE:
+                    canonical = known_id
+                    break
+            matches.append(canonical)
+            if canonical is None:
+                known.append((chunk_id, signature))
+        
+        return matches
+    
+    @staticmethod
+    def parse_candidates(results):
+        return [(result["id"], int(result["simhash"], 16)) for result in results if result.get("simhash")]
+    
+    def find_duplicates(self, content_id, signatures):
+        """Look up near-duplicates of (chunk ID, SimHash) pairs in batched queries"""
+        candidates = []
+        try:
+            for start in range(0, len(signatures), Config.NEAR_DUPLICATE_LOOKUP_BATCH):
+                batch = [signature for _, signature in signatures[start:start + Config.NEAR_DUPLICATE_LOOKUP_BATCH]]
+                results = self.azure_services.search_client.search(
+                    search_text="*",
+                    filter=self.build_candidate_filter(batch),
+                    select=["id", "simhash"],
+                    top=1000
+                )
+                candidates.extend(self.parse_candidates(results))
+        
+        except Exception as e:
+            # Fall back to within-document detection only
+            logger.error(f"Error looking up near-duplicate chunks: {str(e)}")
+        
+        return self.match(content_id, signatures, candidates)
+
+def collapse_near_duplicates(search_results, top_k):
+    """Keep the highest-ranked result of each group of near-duplicate chunks"""
+    kept = []
+    signatures = []
+    for result in search_results:
+        # Use the stored signature when the chunk has one
+        signature = int(result["simhash"], 16) if result.get("simhash") else compute_simhash(result["content"])
+        if any(hamming_distance(signature, other) <= Config.NEAR_DUPLICATE_MAX_DISTANCE for other in signatures):
+            continue
+        kept.append(result)
+        signatures.append(signature)
+        if len(kept) == top_k:
+            break
+    return kept
+
+_token_encoding = None
+
+def count_tokens(text):
+    """Count tokens with the embedding model's tokenizer, or estimate them without tiktoken"""
+    global _token_encoding
+    if _token_encoding is None:
+        _token_encoding = False
+        if tiktoken is not None:
+            try:
+                _token_encoding = tiktoken.get_encoding(Config.TOKENIZER_ENCODING)
+            except Exception as e:
+                logger.warning(f"Tokenizer unavailable, estimating token counts: {str(e)}")
+    
+    if _token_encoding:
+        return len(_token_encoding.encode(text, disallowed_special=()))
+    return math.ceil(len(re.findall(r'\w+|[^\w\s]', text)) * 1.1)
+
+# Sentence ends (kept with their sentence) and paragraph breaks (blank lines)
+_UNIT_BOUNDARY = re.compile(r'[.!?]+["\')\]]*(?=\s)|\n[ \t]*\n')
+
+def _text_units(text):
+    """Yield (start, end, token count, ends paragraph) for each sentence of text"""
+    def units(start, end, paragraph_end):
+        while start < end and text[start].isspace():
+            start += 1
+        if start >= end:
+            return
+        tokens = count_tokens(text[start:end])
+        if tokens <= Config.CHUNK_MAX_TOKENS:
+            yield start, end, tokens, paragraph_end
+            return
+        
+        # Split an overlong sentence into roughly equal runs of words
+        words = [match.span() for match in re.finditer(r'\S+', text[start:end])]
+        pieces = math.ceil(tokens / Config.CHUNK_MAX_TOKENS)
+        size = math.ceil(len(words) / pieces)
+        for i in range(0, len(words), size):
+            piece_start, piece_end = start + words[i][0], start + words[min(i + size, len(words)) - 1][1]
+            last = i + size >= len(words)
+            yield piece_start, piece_end, count_tokens(text[piece_start:piece_end]), paragraph_end and last
+    
+    start = 0
+    for match in _UNIT_BOUNDARY.finditer(text):
+        paragraph_break = match.group().startswith('\n')
+        end = match.start() if paragraph_break else match.end()
+        yield from units(start, end, paragraph_break)
+        start = match.end()
+    yield from units(start, len(text), True)
+
+def chunk_text(text, page_spans=None):
+    """Split text into chunks on sentence and paragraph boundaries in a single pass
+    
+    page_spans is an optional sorted list of (character offset, page number)
+    pairs marking where each page starts. Each chunk is a dict with its
+    normalized text, character offsets into text, and first and last page.
+    """
+    page_offsets = [offset for offset, _ in page_spans] if page_spans else None
+    
+    def page_at(offset):
+        if not page_offsets:
+            return None
+        return page_spans[max(bisect.bisect_right(page_offsets, offset) - 1, 0)][1]
+    
+    chunks = []
+    current = []
+    current_tokens = 0
+    
+    def emit():
+        start, end = current[0][0], current[-1][1]
+        chunks.append({
+            "text": re.sub(r'\s+', ' ', text[start:end]).strip(),
+            "char_start": start,
+            "char_end": end,
+            "page_start": page_at(start),
+            "page_end": page_at(end - 1)
+        })
+    
+    for unit in _text_units(text):
+        _, _, tokens, paragraph_end = unit
+        
+        if current and current_tokens + tokens > Config.CHUNK_TARGET_TOKENS:
+            emit()
+            # Carry trailing sentences over as overlap, if they leave room for this one
+            carry, carry_tokens = [], 0
+            for previous in reversed(current):
+                if carry_tokens + previous[2] > Config.CHUNK_OVERLAP_TOKENS:
+                    break
+                carry.insert(0, previous)
+                carry_tokens += previous[2]
+            if carry_tokens + tokens > Config.CHUNK_MAX_TOKENS:
+                carry, carry_tokens = [], 0
+            current, current_tokens = carry, carry_tokens
+        
+        current.append(unit)
+        current_tokens += tokens
+        
+        # Prefer closing a reasonably sized chunk at the end of a paragraph
+        if paragraph_end and current_tokens >= Config.CHUNK_MIN_TOKENS:
+            emit()
+            current, current_tokens = [], 0
+    
+    if current and (not chunks or current[-1][1] > chunks[-1]["char_end"]):
+        emit()
+    
+    return chunks
+
+WEB_REQUEST_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
+}
+
+CATALOG_FIELDS = ["id", "title", "source_type", "created_date", "modified_date", "url", "chunk_count"]
+
+def build_catalog_entry(metadata):
+    """Listing entry for a document, stored in the single catalog partition"""
+    entry = {field: metadata.get(field) for field in CATALOG_FIELDS}
+    entry["pk"] = Config.CATALOG_PARTITION
+    return entry
+
+def chunk_ids(content_id, start, end):
+    return [f"{content_id}-chunk-{i}" for i in range(start, end)]
+
+def chunk_signatures(content_id, signatures):
+    """Pair the SimHash signatures of a document's chunks with their chunk IDs"""
+    return list(zip(chunk_ids(content_id, 0, len(signatures)), signatures))
+
+def duplicate_links(duplicates):
+    """Map the index of each chunk duplicating an indexed chunk to that chunk's ID, as in duplicate_chunks"""
+    return {str(i): canonical for i, canonical in enumerate(duplicates) if canonical}
+
+def index_batches(documents):
+    """Split documents into search index uploads or deletes of at most INDEX_BATCH_SIZE"""
+    return [documents[start:start + Config.INDEX_BATCH_SIZE]
+            for start in range(0, len(documents), Config.INDEX_BATCH_SIZE)]
+
+def previous_chunk_count(previous):
+    """Chunk count recorded for the previous version of a document (0 if there is none)"""
+    return (previous or {}).get("chunk_count") or 0
+
+def prepare_ingest_metadata(metadata, previous, chunk_count):
+    """Fill in the metadata recorded before a document's chunks are indexed
+    
+    A re-ingested document keeps its creation date and records the larger of
+    its old and new chunk counts, so chunks of an interrupted ingest can be
+    deleted.
+    """
+    if previous:
+        metadata["created_date"] = previous.get("created_date", metadata["created_date"])
+    metadata["chunk_count"] = max(chunk_count, previous_chunk_count(previous))
+
+def odata_string(value):
+    """Escape a value for a single-quoted OData string literal"""
+    return str(value).replace("'", "''")
+
+def chunk_owner(chunk_id):
+    """Content ID of the document a chunk ID belongs to"""
+    return chunk_id.rsplit("-chunk-", 1)[0]
+
+def duplicate_sources(duplicate_chunks):
+    """Content IDs of the documents owning the chunks a document's duplicates link to"""
+    return sorted({chunk_owner(canonical) for canonical in (duplicate_chunks or {}).values()})
+
+def rehomed_chunk(chunk_document, metadata, chunk_index):
+    """Copy of another document's chunk, stored as chunk chunk_index of this document"""
+    document = {key: value for key, value in chunk_document.items() if not key.startswith("@")}
+    document.update({
+        "id": f"{metadata['id']}-chunk-{chunk_index}",
+        "content_id": metadata["id"],
+        "source_type": metadata["source_type"],
+        "title": metadata["title"],
+        "url": metadata.get("url"),
+        "uploaded_date": metadata["created_date"],
+        "chunk_id": str(chunk_index)
+    })
+    return document
+
+def record_linker(item, linker_id):
+    """Add a linking document to an item's linked_by; returns False if it is already there"""
+    linked_by = item.setdefault("linked_by", [])
+    if linker_id in linked_by:
+        return False
+    linked_by.append(linker_id)
+    return True
+
+def merged_metadata(metadata, stored):
+    """Metadata to write over a stored item, keeping the documents linking to it
+    
+    linked_by is written by the linking documents, so writing a document's
+    own metadata adds to the stored list rather than replacing it.
+    """
+    body = dict(metadata)
+    body["linked_by"] = list(dict.fromkeys(((stored or {}).get("linked_by") or [])
+                                           + (metadata.get("linked_by") or [])))
+    return body
+
+def links_within(items):
+    """Record links between documents written together in their linked_by
+    
+    Returns the other links as {linked content ID: [linking content IDs]}.
+    """
+    by_id = {item["id"]: item for item in items}
+    outside = {}
+    for item in items:
+        for source in item["duplicate_of"]:
+            if source in by_id:
+                record_linker(by_id[source], item["id"])
+            else:
+                outside.setdefault(source, []).append(item["id"])
+    return outside
+
+# Documents whose links are not yet in the linked_by of the documents they link to
+UNRECORDED_LINKS_QUERY = "SELECT * FROM c WHERE NOT IS_DEFINED(c.links_recorded) OR c.links_recorded = false"
+
+# Document metadata storage
+class MetadataStore:
+    """Read, list, write and delete document metadata
+    
+    Full metadata items live in a container partitioned by /id, so reads,
+    writes and deletes of one document are single-partition point operations.
+    A compact catalog entry per document lives in one logical partition of a
+    second container, so listing is a single-partition query and catalog
+    writes can be grouped into transactional batches.
+    
+    Near-duplicate chunks are stored once and linked from other documents'
+    duplicate_chunks, and each document lists the documents linking to it in
+    linked_by. Deleting or re-ingesting a document first copies the chunks
+    others link to into those documents, found with point reads only.
+    """
+    def __init__(self, azure_services, keyword_index=None):
+        self.azure_services = azure_services
+        self.keyword_index = keyword_index
+    
+    def get(self, content_id):
+        """Return a document's metadata, or None if it does not exist"""
+        try:
+            return self.azure_services.get_metadata_container().read_item(
+                item=content_id, partition_key=content_id)
+        except CosmosResourceNotFoundError:
+            return None
+    
+    def update(self, content_id, change):
+        """Read-modify-write a document's metadata, retrying if it is written in between
+        
+        change(item) edits the item in place and returns False to leave it
+        unwritten. Returns False if the document does not exist.
+        """
+        container = self.azure_services.get_metadata_container()
+        for attempt in range(Config.METADATA_WRITE_RETRIES + 1):
+            item = self.get(content_id)
+            if item is None:
+                return False
+            if change(item) is False:
+                return True
+            try:
+                container.replace_item(item=content_id, body=item, etag=item.get("_etag"),
+                                       match_condition=MatchConditions.IfNotModified)
+                return True
+            except CosmosResourceNotFoundError:
+                return False
+            except CosmosAccessConditionFailedError:
+                if attempt == Config.METADATA_WRITE_RETRIES:
+                    raise
+    
+    def _write(self, metadata):
+        """Create or replace a document's metadata item, keeping its linked_by"""
+        container = self.azure_services.get_metadata_container()
+        for attempt in range(Config.METADATA_WRITE_RETRIES + 1):
+            stored = self.get(metadata["id"])
+            body = merged_metadata(metadata, stored)
+            try:
+                if stored is None:
+                    return container.create_item(body=body)
+                return container.replace_item(item=metadata["id"], body=body, etag=stored.get("_etag"),
+                                              match_condition=MatchConditions.IfNotModified)
+            except (CosmosResourceExistsError, CosmosAccessConditionFailedError):
+                if attempt == Config.METADATA_WRITE_RETRIES:
+                    raise
+    
+    def record_links(self, metadata):
+        """Add a document to linked_by of the documents its duplicate chunks link to
+        
+        Sets links_recorded, which stays False while a linked document does not
+        exist yet; record_unrecorded_links retries those. Returns the missing
+        content IDs.
+        """
+        missing = [source for source in metadata["duplicate_of"]
+                   if not self.update(source, lambda item: record_linker(item, metadata["id"]))]
+        metadata["links_recorded"] = not missing
+        return missing
+    
+    def upsert(self, metadata):
+        metadata["duplicate_of"] = duplicate_sources(metadata.get("duplicate_chunks"))
+        self.record_links(metadata)
+        self._write(metadata)
+        self.azure_services.get_catalog_container().upsert_item(body=build_catalog_entry(metadata))
+    
+    def bulk_upsert(self, items):
+        """Upsert many documents: parallel point writes plus batched catalog writes
+        
+        Returns links to documents that do not exist yet, as {linked content ID:
+        [linking content IDs]}; passing them in the linked documents' linked_by
+        when those are written records them.
+        """
+        if not items:
+            return {}
+        for item in items:
+            item["duplicate_of"] = duplicate_sources(item.get("duplicate_chunks"))
+        outside = links_within(items)
+        with ThreadPoolExecutor(max_workers=Config.METADATA_WRITE_CONCURRENCY) as executor:
+            found = list(executor.map(
+                lambda source: self.update(source, lambda item: any([record_linker(item, linker_id)
+                                                                     for linker_id in outside[source]])),
+                outside))
+            missing = {source: outside[source] for source, exists in zip(outside, found) if not exists}
+            for item in items:
+                item["links_recorded"] = not any(source in missing for source in item["duplicate_of"])
+            list(executor.map(self._write, items))
+        
+        catalog = self.azure_services.get_catalog_container()
+        for start in range(0, len(items), Config.METADATA_BATCH_SIZE):
+            operations = [("upsert", (build_catalog_entry(item),))
+                          for item in items[start:start + Config.METADATA_BATCH_SIZE]]
+            catalog.execute_item_batch(batch_operations=operations, partition_key=Config.CATALOG_PARTITION)
+        return missing
+    
+    def list(self, source_type=None, limit=50, continuation=None):
+        """List catalog entries, newest first, one page at a time
+        
+        Returns (entries, continuation token for the next page or None).
+        """
+        query = "SELECT * FROM c"
+        parameters = []
+        if source_type:
+            query += " WHERE c.source_type = @source_type"
+            parameters.append({"name": "@source_type", "value": source_type})
+        query += " ORDER BY c.created_date DESC"
+        
+        pages = self.azure_services.get_catalog_container().query_items(
+            query=query,
+            parameters=parameters,
+            partition_key=Config.CATALOG_PARTITION,
+            max_item_count=limit
+        ).by_page(continuation)
+        
+        entries = []
+        for page in pages:
+            entries = [{field: item.get(field) for field in CATALOG_FIELDS} for item in page]
+            break
+        return entries, pages.continuation_token
+    
+    def delete_chunks(self, content_id, start, end):
+        """Remove chunks [start, end) of a document from the search index in batches"""
+        return self.delete_chunk_ids(chunk_ids(content_id, start, end))
+    
+    @staticmethod
+    def _links_to(linked, content_id):
+        """Chunks of a document linked to chunks of content_id, as {chunk index: canonical chunk ID}"""
+        if linked["id"] == content_id:
+            return {}
+        return {index: canonical for index, canonical in (linked.get("duplicate_chunks") or {}).items()
+                if chunk_owner(canonical) == content_id}
+    
+    def rehome_linked_chunks(self, metadata):
+        """Copy a document's chunks that others link to into the documents in its linked_by
+        
+        Returns the number of chunks copied.
+        """
+        content_id = metadata["id"]
+        rehomed = 0
+        for linker_id in metadata.get("linked_by") or []:
+            linked = self.get(linker_id)
+            # Stale entries of documents since deleted or re-ingested link to nothing
+            links = self._links_to(linked, content_id) if linked else {}
+            if not links:
+                continue
+            
+            documents = []
+            for index, canonical in links.items():
+                try:
+                    chunk = self.azure_services.search_client.get_document(key=canonical)
+                except ResourceNotFoundError:
+                    logger.warning(f"Linked chunk {canonical} of {linked['id']} is missing")
+                    continue
+                documents.append(rehomed_chunk(chunk, linked, int(index)))
+            
+            if documents:
+                self.azure_services.search_client.upload_documents(
+                    documents=fit_to_index(documents, self.azure_services.index_fields()))
+                add_to_keyword_index(self.keyword_index, documents)
+            
+            for index in links:
+                del linked["duplicate_chunks"][index]
+            self.upsert(linked)
+            rehomed += len(documents)
+        
+        return rehomed
+    
+    def record_unrecorded_links(self):
+        """Record the links of documents written before linked_by existed, or whose linked documents were missing
+        
+        A cross-partition query, run when provisioning rather than per request.
+        Returns the number of documents updated.
+        """
+        items = self.azure_services.get_metadata_container().query_items(
+            query=UNRECORDED_LINKS_QUERY, enable_cross_partition_query=True)
+        updated = 0
+        for item in items:
+            item["duplicate_of"] = duplicate_sources(item.get("duplicate_chunks"))
+            self.record_links(item)
+            fields = {"duplicate_of": item["duplicate_of"], "links_recorded": item["links_recorded"]}
+            updated += self.update(item["id"], lambda stored: stored.update(fields))
+        return updated
+    
+    def indexed_chunk_ids(self, content_id):
+        """IDs of a document's chunks found in the search index rather than from its chunk count
+        
+        Used for metadata written without a chunk count. Indexes created with
+        a filterable content_id are queried directly; in older ones chunk IDs
+        are probed in order until one is missing.
+        """
+        try:
+            results = self.azure_services.search_client.search(
+                search_text="*", filter=f"content_id eq '{odata_string(content_id)}'", select=["id"])
+            return [result["id"] for result in results]
+        except HttpResponseError as e:
+            logger.warning(f"Cannot filter chunks by content ID, probing chunk IDs instead: {str(e)}")
+        
+        found = []
+        while True:
+            chunk_id = f"{content_id}-chunk-{len(found)}"
+            try:
+                self.azure_services.search_client.get_document(key=chunk_id, selected_fields=["id"])
+            except ResourceNotFoundError:
+                return found
+            found.append(chunk_id)
+    
+    def delete_chunk_ids(self, ids):
+        """Remove chunks from the search index in batches"""
+        for batch in index_batches(ids):
+            self.azure_services.search_client.delete_documents(documents=[{"id": chunk_id} for chunk_id in batch])
+        remove_from_keyword_index(self.keyword_index, ids)
+        return len(ids)
+    
+    def delete(self, content_id):
+        """Delete a document's chunks, stored file, metadata and catalog entry
+        
+        Returns False if the document does not exist.
+        """
+        metadata = self.get(content_id)
+        if metadata is None:
+            return False
+        
+        self.rehome_linked_chunks(metadata)
+        if metadata.get("chunk_count"):
+            deleted_chunks = self.delete_chunks(content_id, 0, metadata["chunk_count"])
+        else:
+            deleted_chunks = self.delete_chunk_ids(self.indexed_chunk_ids(content_id))
+        
+        # Only uploaded files have a blob; a missing one is not an error
+        if metadata.get("source_type") not in (None, "web"):
+            try:
+                self.azure_services.blob_service_client.get_blob_client(
+                    container=Config.AZURE_STORAGE_CONTAINER_NAME,
+                    blob=f"{content_id}.{metadata['source_type']}"
+                ).delete_blob()
+            except ResourceNotFoundError:
+                pass
+        
+        try:
+            self.azure_services.get_catalog_container().delete_item(
+                item=content_id, partition_key=Config.CATALOG_PARTITION)
+        except CosmosResourceNotFoundError:
+            pass
+        self.azure_services.get_metadata_container().delete_item(item=content_id, partition_key=content_id)
+        
+        logger.info(f"Deleted content ID {content_id} and {deleted_chunks} chunks")
+        return True
 
 # Document processor for different content types
 class DocumentProcessor:
-    def __init__(self, azure_services):
+    def __init__(self, azure_services, artifact_precomputer=None, metadata_store=None, keyword_index=None):
         self.azure_services = azure_services
+        self.artifact_precomputer = artifact_precomputer
+        self.keyword_index = keyword_index
+        self.metadata_store = metadata_store or MetadataStore(azure_services, keyword_index)
+        self.duplicate_detector = NearDuplicateDetector(azure_services) if Config.DEDUPLICATE_CHUNKS else None
     
-    def process_document(self, file_path=None, url=None, text_content=None, title=None, source_type=None):
-        """Process documents from different sources (file, URL, or text)"""
+    def process_document(self, file_path=None, url=None, text_content=None, title=None, source_type=None,
+                         content_id=None):
+        """Process documents from different sources (file, URL, or text)
+        
+        Passing an existing content_id re-ingests that document and
+        invalidates any precomputed learning artifacts.
+        """
+        metadata = None
         try:
-            content_id = str(uuid.uuid4())
+            reingest = content_id is not None
+            content_id = content_id or str(uuid.uuid4())
             document_content = ""
+            page_spans = None
+            
+            # Only existing documents are re-ingested; check before extracting anything
+            previous = self.metadata_store.get(content_id) if reingest else None
+            if reingest and previous is None:
+                raise DocumentNotFoundError(content_id)
             
             if file_path:
                 # Process file content
@@ -216,7 +1069,7 @@ class DocumentProcessor:
                     file_data = file.read()
                     
                 if source_type == 'pdf':
-                    document_content = self._extract_pdf_content(file_data)
+                    document_content, page_spans = self._extract_pdf_content(file_data)
                 elif source_type in ['docx', 'doc']:
                     # For demo purposes, assume text
                     document_content = file_data.decode('utf-8', errors='ignore')
@@ -229,7 +1082,7 @@ class DocumentProcessor:
                     container=Config.AZURE_STORAGE_CONTAINER_NAME,
                     blob=f"{content_id}.{source_type}"
                 )
-                blob_client.upload_blob(file_data)
+                blob_client.upload_blob(file_data, overwrite=True)
                 
             elif url:
                 # Process web content
@@ -243,54 +1096,105 @@ class DocumentProcessor:
                 title = title or f"Note {datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}"
             
             # Store metadata in Cosmos DB
-            metadata = {
-                "id": content_id,
-                "title": title,
-                "source_type": source_type,
-                "created_date": datetime.datetime.now().isoformat(),
-                "modified_date": datetime.datetime.now().isoformat(),
-                "url": url or ""
-            }
+            metadata = self._build_metadata(content_id, title, source_type, url,
+                                            precompute=bool(self.artifact_precomputer))
             
-            container = self.azure_services.cosmos_client.get_database_client(
-                Config.COSMOS_DB_DATABASE_NAME
-            ).get_container_client(Config.COSMOS_DB_CONTAINER_NAME)
+            # Upsert so that re-ingesting a document replaces its metadata
+            if previous:
+                # Chunks other documents link to are about to be overwritten
+                self.metadata_store.rehome_linked_chunks(previous)
+            
+            # Record the chunk count before indexing, so chunks of an interrupted ingest can be deleted
+            chunks = self._split_into_chunks(document_content, page_spans)
+            prepare_ingest_metadata(metadata, previous, len(chunks))
+            self.metadata_store.upsert(metadata)
             
-            container.create_item(body=metadata)
+            # Index the chunks in Azure AI Search
+            chunk_count, duplicate_chunks = self._process_and_index_content(chunks, metadata)
             
-            # Process content into chunks and index in Azure AI Search
-            self._process_and_index_content(document_content, metadata)
+            # Drop chunks left over from a longer earlier version of the document
+            if previous_chunk_count(previous) > chunk_count:
+                self.metadata_store.delete_chunks(content_id, chunk_count, previous_chunk_count(previous))
+            
+            # Record the chunk count and chunks linked to existing near-duplicates
+            metadata["chunk_count"] = chunk_count
+            metadata["duplicate_chunks"] = duplicate_chunks
+            self.metadata_store.upsert(metadata)
+            
+            # Precompute learning artifacts in the background
+            if self.artifact_precomputer:
+                self.artifact_precomputer.submit(document_content, metadata)
             
             return {"content_id": content_id, "title": title}
         
         except Exception as e:
             logger.error(f"Error processing document: {str(e)}")
+            # No artifact job was submitted; artifacts left pending would stay pending
+            if metadata is not None and metadata["artifacts_status"] == "pending":
+                try:
+                    self.metadata_store.update(content_id, fail_pending_artifacts(metadata["ingest_version"]))
+                except Exception as update_error:
+                    logger.error(f"Error marking artifacts failed for content ID {content_id}: "
+                                 f"{str(update_error)}")
             raise
     
-    def _extract_pdf_content(self, file_data):
-        """Extract text from PDF documents"""
+    @staticmethod
+    def _build_metadata(content_id, title, source_type, url=None, precompute=False):
+        """Build the Cosmos DB metadata item for a document"""
+        return {
+            "id": content_id,
+            "title": title,
+            "source_type": source_type,
+            "created_date": datetime.datetime.now().isoformat(),
+            "modified_date": datetime.datetime.now().isoformat(),
+            "url": url or "",
+            # A new ingest version invalidates artifacts from earlier ingests
+            "ingest_version": str(uuid.uuid4()),
+            "artifacts_status": "pending" if precompute else "disabled",
+            "artifacts": None,
+            "chunk_count": 0,
+            "duplicate_chunks": {}
+        }
+    
+    @staticmethod
+    def _extract_pdf_content(file_data):
+        """Extract text from PDF documents
+        
+        Returns the text and a list of (character offset, page number) pairs
+        marking where each page starts. Pages are separated by a blank line.
+        """
         try:
             pdf_document = fitz.open(stream=file_data, filetype="pdf")
             text = ""
+            page_spans = []
             
             for page_num in range(pdf_document.page_count):
                 page = pdf_document.load_page(page_num)
-                text += page.get_text()
+                page_spans.append((len(text), page_num + 1))
+                text += page.get_text() + "\n\n"
             
-            return text
+            return text, page_spans
         except Exception as e:
             logger.error(f"Error extracting PDF content: {str(e)}")
-            return ""
+            return "", []
     
     def _extract_web_content(self, url):
         """Extract content from web pages"""
         try:
-            response = requests.get(url, headers={
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3'
-            })
+            response = requests.get(url, headers=WEB_REQUEST_HEADERS)
             response.raise_for_status()
             
-            soup = BeautifulSoup(response.text, 'html.parser')
+            return self._parse_html(response.text, url)
+        
+        except Exception as e:
+            logger.error(f"Error extracting web content from {url}: {str(e)}")
+            return "", url
+    
+    @staticmethod
+    def _parse_html(html, url):
+        """Extract the main text and title from an HTML page"""
+        try:
+            soup = BeautifulSoup(html, 'html.parser')
             
             # Get title
             title = soup.title.string if soup.title else url
@@ -322,50 +1226,82 @@ class DocumentProcessor:
             return article_text.strip(), title
         
         except Exception as e:
-            logger.error(f"Error extracting web content from {url}: {str(e)}")
+            logger.error(f"Error parsing web content from {url}: {str(e)}")
             return "", url
     
-    def _process_and_index_content(self, content, metadata):
-        """Split content into chunks and index in Azure AI Search"""
+    def _process_and_index_content(self, chunks, metadata):
+        """Index chunks produced by chunk_text in Azure AI Search
+        
+        Returns the number of chunks and a mapping of chunk index to the ID of
+        the existing chunk it duplicates; those chunks are neither embedded nor
+        indexed.
+        """
         try:
-            # Clean content
-            content = re.sub(r'\s+', ' ', content).strip()
-            
-            # Split into chunks with overlap
-            chunks = []
-            for i in range(0, len(content), Config.MAX_CHUNK_SIZE - Config.OVERLAP_SIZE):
-                chunk_text = content[i:i + Config.MAX_CHUNK_SIZE]
-                if chunk_text:
-                    chunks.append(chunk_text)
+            # Link near-duplicates of already indexed chunks instead of embedding them
+            signatures = compute_simhashes([chunk["text"] for chunk in chunks])
+            duplicates = [None] * len(chunks)
+            if self.duplicate_detector and chunks:
+                duplicates = self.duplicate_detector.find_duplicates(metadata["id"],
+                                                                     chunk_signatures(metadata["id"], signatures))
             
             # Generate embeddings and index chunks
+            indexed_docs = []
             for i, chunk in enumerate(chunks):
+                if duplicates[i]:
+                    continue
+                
                 # Generate embedding
-                embedding = self._generate_embedding(chunk)
+                embedding = self._generate_embedding(chunk["text"])
                 
-                if embedding:
+                if embedding is not None:
                     # Create chunk document
-                    chunk_doc = {
-                        "id": f"{metadata['id']}-chunk-{i}",
-                        "content_id": metadata["id"],
-                        "source_type": metadata["source_type"],
-                        "title": metadata["title"],
-                        "url": metadata["url"],
-                        "uploaded_date": metadata["created_date"],
-                        "chunk_id": str(i),
-                        "content": chunk,
-                        "content_vector": embedding
-                    }
+                    chunk_doc = self._build_chunk_document(metadata, i, chunk, embedding, signatures[i])
                     
                     # Upload to Azure AI Search
-                    self.azure_services.search_client.upload_documents(documents=[chunk_doc])
+                    self.azure_services.search_client.upload_documents(
+                        documents=fit_to_index([chunk_doc], self.azure_services.index_fields()))
+                    indexed_docs.append(chunk_doc)
+            
+            # Keep the local keyword index in step with the search index
+            add_to_keyword_index(self.keyword_index, indexed_docs)
             
-            logger.info(f"Processed and indexed {len(chunks)} chunks for content ID: {metadata['id']}")
+            duplicate_chunks = duplicate_links(duplicates)
+            logger.info(f"Processed and indexed {len(chunks)} chunks for content ID: {metadata['id']} "
+                        f"({len(duplicate_chunks)} near-duplicates linked)")
+            return len(chunks), duplicate_chunks
         
         except Exception as e:
             logger.error(f"Error processing and indexing content: {str(e)}")
             raise
     
+    @staticmethod
+    def _split_into_chunks(content, page_spans=None):
+        """Split document text into sentence-aligned chunks with provenance"""
+        return chunk_text(content, page_spans)
+    
+    @staticmethod
+    def _build_chunk_document(metadata, chunk_index, chunk, embedding, simhash=None):
+        """Build the search index document for one chunk produced by chunk_text"""
+        simhash = compute_simhash(chunk["text"]) if simhash is None else simhash
+        return {
+            "id": f"{metadata['id']}-chunk-{chunk_index}",
+            "content_id": metadata["id"],
+            "source_type": metadata["source_type"],
+            "title": metadata["title"],
+            "url": metadata["url"],
+            "uploaded_date": metadata["created_date"],
+            "chunk_id": str(chunk_index),
+            "content": chunk["text"],
+            "page_start": chunk["page_start"],
+            "page_end": chunk["page_end"],
+            "char_start": chunk["char_start"],
+            "char_end": chunk["char_end"],
+            # Vectors stay float32 arrays until serialized for the index
+            "content_vector": embedding.tolist(),
+            "simhash": format(simhash, '016x'),
+            **{f"simhash_b{band}": value for band, value in enumerate(simhash_bands(simhash))}
+        }
+    
     def _generate_embedding(self, text):
         """Generate embedding vector for a text chunk"""
         try:
@@ -375,409 +1311,1642 @@ class DocumentProcessor:
                 model=Config.AZURE_OPENAI_EMBEDDING_MODEL
             )
             
-            return response.data[0].embedding
+            return as_vector(response.data[0].embedding)
         
         except Exception as e:
             logger.error(f"Error generating embedding: {str(e)}")
             return None
 
+def normalize_query_key(text):
+    """Default key normalizer: case-fold, collapse whitespace, drop edge punctuation"""
+    return re.sub(r'\s+', ' ', str(text or '')).strip().strip('?!.,;:').casefold()
+
+def exact_query_key(text):
+    """Key normalizer that only coalesces identical text"""
+    return str(text or '')
+
+# Key normalizers selectable with Config.COALESCE_KEY_NORMALIZER
+KEY_NORMALIZERS = {"default": normalize_query_key, "exact": exact_query_key}
+
+def configured_key_normalizer():
+    """The key normalizer named by Config.COALESCE_KEY_NORMALIZER"""
+    try:
+        return KEY_NORMALIZERS[Config.COALESCE_KEY_NORMALIZER]
+    except KeyError:
+        raise ValueError(f"Unknown COALESCE_KEY_NORMALIZER: {Config.COALESCE_KEY_NORMALIZER}")
+
+# Single-flight coalescing of identical in-flight calls
+class SingleFlight:
+    def __init__(self, name, key_normalizer=None):
+        self.name = name
+        self.key_normalizer = key_normalizer or normalize_query_key
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.calls = 0
+        self.executions = 0
+        self.deduplicated = 0
+    
+    def make_key(self, kind, text, params=None):
+        return (kind, self.key_normalizer(text), json.dumps(params, sort_keys=True, default=str))
+    
+    def do(self, kind, text, params, func):
+        """Run func once per key; concurrent callers with the same key share its result"""
+        if not Config.COALESCE_REQUESTS:
+            return func()
+        
+        key = self.make_key(kind, text, params)
+        with self._lock:
+            self.calls += 1
+        
+        while True:
+            with self._lock:
+                call = self._in_flight.get(key)
+                leader = call is None
+                if leader:
+                    call = {"event": threading.Event(), "result": None, "error": None, "done": False}
+                    self._in_flight[key] = call
+                    self.executions += 1
+            if leader:
+                break
+            
+            call["event"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            if call["done"]:
+                with self._lock:
+                    self.deduplicated += 1
+                # Each caller gets its own copy of the shared result
+                return copy.deepcopy(call["result"])
+            # The leader was interrupted without a result; run func again
+        
+        try:
+            call["result"] = func()
+            call["done"] = True
+            return copy.deepcopy(call["result"])
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            call["event"].set()
+    
+    def stats(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "executions": self.executions,
+                "deduplicated": self.deduplicated,
+                "in_flight": len(self._in_flight)
+            }
+
+class StageTimeout(Exception):
+    """A request stage did not finish within its share of the deadline"""
+
+# Per-request deadline passed down through each stage
+class Deadline:
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+    
+    def bucket(self):
+        """Requested length in whole seconds; calls may only share results within a bucket"""
+        return math.ceil(self.seconds)
+    
+    def remaining(self):
+        return max(self.expires_at - time.monotonic(), 0.0)
+    
+    def budget(self, cap=None, reserve=0.0):
+        """Time a stage may use, leaving reserve seconds for later stages"""
+        budget = max(self.remaining() - reserve, 0.0)
+        return min(budget, cap) if cap is not None else budget
+
+# Recent latencies of a stage, used to pick hedging delays
+class LatencyTracker:
+    def __init__(self, size=500):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+    
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+    
+    def percentile(self, p):
+        with self._lock:
+            if len(self._samples) < Config.HEDGE_MIN_SAMPLES:
+                return None
+            samples = sorted(self._samples)
+        return samples[min(int(len(samples) * p / 100), len(samples) - 1)]
+
+SEARCH_RESULT_FIELDS = ["id", "content_id", "title", "content", "source_type", "url", "uploaded_date",
+                        "page_start", "page_end", "simhash"]
+
+def fields_in_index(fields, index_fields):
+    """The fields the live index has, or all of them if its fields are unknown"""
+    if index_fields is None:
+        return list(fields)
+    return [field for field in fields if field in index_fields]
+
+def fit_to_index(documents, index_fields):
+    """Drop fields the live index lacks from documents before uploading them"""
+    if index_fields is None:
+        return documents
+    return [{field: value for field, value in document.items() if field in index_fields}
+            for document in documents]
+
+ANSWER_SYSTEM_PROMPT = "You are a helpful personal assistant that answers questions based on the user's personal knowledge base. Use ONLY the provided context to answer the question. If you don't find the answer in the context, say so honestly. Always cite your sources by mentioning the title of the document where you found the information, and the page numbers when they are given."
+
+def format_pages(result):
+    """Describe the page range of a search result, e.g. "p. 4" or "pp. 4-5" """
+    page_start, page_end = result.get("page_start"), result.get("page_end")
+    if not page_start:
+        return ""
+    if not page_end or page_end == page_start:
+        return f"p. {page_start}"
+    return f"pp. {page_start}-{page_end}"
+
+def build_context(search_results):
+    """Format search results as prompt context"""
+    return "\n\n".join([f"Title: {result['title']}"
+                        + (f" ({format_pages(result)})" if format_pages(result) else "")
+                        + f"\nContent: {result['content']}"
+                        for result in search_results])
+
+KEYWORD_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were will with".split()
+)
+
+def keyword_terms(text):
+    """Lowercased word terms used by the local keyword index"""
+    return [term for term in re.findall(r'\w+', text.lower()) if term not in KEYWORD_STOPWORDS]
+
+def quoted_phrase(query):
+    """Return the phrase of a query wrapped in double quotes, or None"""
+    query = query.strip()
+    if len(query) > 2 and query[0] == query[-1] == '"':
+        return " ".join(query[1:-1].split()).lower()
+    return None
+
+def is_exact_term_query(query):
+    """Whether a query asks for exact terms rather than meaning
+    
+    Quoted phrases are exact-term queries, as are short queries containing an
+    identifier: a word mixing letters and digits (error codes, versioned
+    names such as "ERR42" or "sha256") or a snake_case name. Plain words and
+    numbers ("World War 2", "python 3 features") are not.
+    """
+    if quoted_phrase(query):
+        return True
+    words = query.split()
+    return 0 < len(words) <= Config.FAST_PATH_MAX_TERMS and any(
+        re.search(r'[^\W\d_]', word) and re.search(r'\d', word) or re.search(r'[^\W_]_[^\W_]', word)
+        for word in words
+    )
+
+def expand_topic(topic, max_queries=None):
+    """Expand a topic into sub-queries for multi-query retrieval
+    
+    The topic itself comes first, then its parts when it is an explicit list
+    of subjects ("A, B, and C", "A; B", "A vs B") whose parts are all
+    multi-word, then the topic with each configured facet appended. A bare
+    "and" never splits a topic, as it is often part of a name ("Pride and
+    Prejudice"), and neither does a list of single words ("Paris, France").
+    """
+    max_queries = max_queries or Config.MULTI_QUERY_COUNT
+    topic = " ".join(topic.split())
+    parts = re.split(r'\s*[,;]\s*(?:and\s+)?|\s+(?:vs\.?|versus)\s+', topic, flags=re.IGNORECASE)
+    parts = [part for part in parts if part]
+    
+    queries = [topic]
+    if len(parts) > 1 and all(len(part.split()) > 1 for part in parts):
+        queries.extend(parts)
+    queries.extend(f"{topic} {facet}" for facet in Config.MULTI_QUERY_FACETS)
+    
+    unique = list({query.lower(): query for query in reversed(queries)}.values())[::-1]
+    return unique[:max_queries]
+
+def reciprocal_rank_fusion(ranked_lists, weights, k=None):
+    """Merge ranked result lists by weighted reciprocal rank
+    
+    Each result scores the sum of weight / (k + rank) over the lists it
+    appears in; results are identified by their "id".
+    """
+    k = k or Config.RRF_K
+    scores = {}
+    results = {}
+    for ranked, weight in zip(ranked_lists, weights):
+        for rank, result in enumerate(ranked, 1):
+            scores[result["id"]] = scores.get(result["id"], 0.0) + weight / (k + rank)
+            results.setdefault(result["id"], result)
+    return [results[result_id] for result_id in sorted(scores, key=scores.get, reverse=True)]
+
+def all_indexed_chunks(search_client, select=None, page_size=1000):
+    """Iterate over every chunk in the search index, in upload date order
+    
+    Pages are read by upload date range rather than an ever-growing skip,
+    which the service caps at 100,000; skip only steps over the chunks of
+    the previous page that share its last upload date.
+    """
+    select = list(select or ["id", "content"])
+    if "uploaded_date" not in select:
+        select.append("uploaded_date")
+    last_date, skip = None, 0
+    while True:
+        results = list(search_client.search(search_text="*", select=select, order_by=["uploaded_date asc"],
+                                            filter=f"uploaded_date ge {last_date}" if last_date else None,
+                                            top=page_size, skip=skip or None))
+        yield from results
+        if len(results) < page_size:
+            return
+        last_date, skip = next_chunks_page(results, last_date, skip)
+
+def next_chunks_page(results, last_date, skip):
+    """Upload date and skip of the page after a full page of all_indexed_chunks"""
+    page_last = results[-1].get("uploaded_date")
+    if page_last == last_date:
+        return last_date, skip + len(results)
+    # Earlier pages end on earlier dates, so every chunk seen with page_last is on this page
+    return page_last, sum(1 for result in results if result.get("uploaded_date") == page_last)
+
+def keyword_match_expression(query, require_all=False):
+    """FTS5 query for the terms of a query, or None if it has no terms
+    
+    A quoted query matches its phrase; otherwise chunks match any term, or
+    every term with require_all.
+    """
+    phrase = quoted_phrase(query)
+    if phrase:
+        return '"' + phrase.replace('"', '""') + '"'
+    terms = list(dict.fromkeys(keyword_terms(query)))
+    if not terms:
+        return None
+    return (" AND " if require_all else " OR ").join(f'"{term}"' for term in terms)
+
+KEYWORD_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    rowid INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    content TEXT NOT NULL,
+    source_type TEXT,
+    uploaded_date TEXT,
+    fields TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS chunk_terms USING fts5(
+    content, content='chunks', content_rowid='rowid', tokenize="unicode61 tokenchars '_'"
+);
+CREATE TRIGGER IF NOT EXISTS chunks_insert AFTER INSERT ON chunks BEGIN
+    INSERT INTO chunk_terms(rowid, content) VALUES (new.rowid, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS chunks_delete AFTER DELETE ON chunks BEGIN
+    INSERT INTO chunk_terms(chunk_terms, rowid, content) VALUES ('delete', old.rowid, old.content);
+END;
+"""
+
+INSERT_CHUNK = "INSERT INTO chunks (id, content, source_type, uploaded_date, fields) VALUES (?, ?, ?, ?, ?)"
+
+# Local keyword index
+class BM25Index:
+    """BM25 keyword index over chunk text, kept in SQLite FTS5
+    
+    Chunks are added as they are indexed in Azure AI Search. With a path, the
+    index is one database file shared by all server workers and bulk
+    ingestion runs: they read it through the OS page cache rather than each
+    holding a copy, and removed chunks free their space in place. Without a
+    path the index lives in this process's memory only.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._connections = []
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        
+        with self._connect() as connection:
+            if path:
+                connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(KEYWORD_INDEX_SCHEMA)
+    
+    def _open(self):
+        connection = sqlite3.connect(self.path or ":memory:", timeout=30, check_same_thread=False)
+        connection.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            self._connections.append(connection)
+        return connection
+    
+    @contextlib.contextmanager
+    def _connect(self):
+        """This thread's connection; an in-memory index has one, used under the lock"""
+        if not self.path:
+            if not self._connections:
+                self._open()
+            with self._lock:
+                yield self._connections[0]
+            return
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = self._open()
+        yield connection
+    
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+    
+    def __len__(self):
+        with self._connect() as connection:
+            return connection.execute("SELECT count(*) FROM chunks").fetchone()[0]
+    
+    def is_empty(self):
+        with self._connect() as connection:
+            return connection.execute("SELECT 1 FROM chunks LIMIT 1").fetchone() is None
+    
+    @staticmethod
+    def _rows(chunk_documents):
+        for document in chunk_documents:
+            fields = {field: document.get(field) for field in SEARCH_RESULT_FIELDS}
+            yield (fields["id"], fields["content"] or "", fields["source_type"], fields["uploaded_date"],
+                   json.dumps(fields))
+    
+    def add(self, chunk_documents):
+        """Add or replace chunks given as search index documents"""
+        rows = list(self._rows(chunk_documents))
+        if not rows:
+            return
+        with self._connect() as connection, connection:
+            connection.executemany("DELETE FROM chunks WHERE id = ?", [(row[0],) for row in rows])
+            connection.executemany(INSERT_CHUNK, rows)
+    
+    def remove(self, chunk_ids):
+        chunk_ids = [(chunk_id,) for chunk_id in chunk_ids]
+        if chunk_ids:
+            with self._connect() as connection, connection:
+                connection.executemany("DELETE FROM chunks WHERE id = ?", chunk_ids)
+    
+    def search(self, query, top_k=5, filter_criteria=None, require_all=False):
+        """Return the top_k chunks by BM25 score as search result dicts
+        
+        With require_all, only chunks containing every query term match; a
+        quoted query matches chunks containing the phrase itself.
+        """
+        match = keyword_match_expression(query, require_all)
+        if match is None:
+            return []
+        
+        # The filter criteria KnowledgeRetriever._build_filter sends to the search index
+        sql = ("SELECT chunks.fields FROM chunk_terms JOIN chunks ON chunks.rowid = chunk_terms.rowid "
+               "WHERE chunk_terms MATCH ?")
+        parameters = [match]
+        if filter_criteria and 'source_type' in filter_criteria:
+            sql += " AND chunks.source_type = ?"
+            parameters.append(filter_criteria['source_type'])
+        if filter_criteria and 'date_from' in filter_criteria and 'date_to' in filter_criteria:
+            sql += " AND substr(chunks.uploaded_date, 1, 19) BETWEEN ? AND ?"
+            parameters.extend([filter_criteria['date_from'][:19], filter_criteria['date_to'][:19]])
+        sql += " ORDER BY bm25(chunk_terms) LIMIT ?"
+        parameters.append(top_k)
+        
+        with self._connect() as connection:
+            return [json.loads(fields) for fields, in connection.execute(sql, parameters)]
+    
+    def rebuild(self, documents):
+        """Replace the index with the given chunks, e.g. all_indexed_chunks()
+        
+        The swap is one transaction: other connections read the old index
+        until it commits, and a failure part way through keeps the old index.
+        """
+        rows = self._rows(documents)
+        count = 0
+        with self._connect() as connection:
+            with connection:
+                connection.execute("DELETE FROM chunks")
+                for batch in iter(lambda: list(itertools.islice(rows, 1000)), []):
+                    connection.executemany(INSERT_CHUNK, batch)
+                    count += len(batch)
+            # Merge the index segments written by the bulk insert
+            with connection:
+                connection.execute("INSERT INTO chunk_terms(chunk_terms) VALUES ('optimize')")
+        return count
+
+def add_to_keyword_index(keyword_index, chunk_documents):
+    """Add indexed chunks to the keyword index, if there is one
+    
+    Best effort: the search index is the source of truth, and a keyword index
+    that misses chunks only loses recall the search index's own text query
+    still covers, so failures are logged rather than failing the ingest.
+    """
+    if keyword_index is None or not chunk_documents:
+        return
+    try:
+        keyword_index.add(chunk_documents)
+    except Exception as e:
+        logger.error(f"Error adding {len(chunk_documents)} chunks to keyword index: {str(e)}")
+
+def remove_from_keyword_index(keyword_index, chunk_ids):
+    """Remove deleted chunks from the keyword index, if there is one; best effort like add_to_keyword_index"""
+    if keyword_index is None or not chunk_ids:
+        return
+    try:
+        keyword_index.remove(chunk_ids)
+    except Exception as e:
+        logger.error(f"Error removing {len(chunk_ids)} chunks from keyword index: {str(e)}")
+
 # Knowledge retrieval functionality
 class KnowledgeRetriever:
-    def __init__(self, azure_services):
+    def __init__(self, azure_services, key_normalizer=None, keyword_index=None):
         self.azure_services = azure_services
+        self.keyword_index = keyword_index
+        self.single_flight = SingleFlight("knowledge_retriever", key_normalizer)
+        self.latencies = {stage: LatencyTracker() for stage in ("embedding", "search", "generation")}
+        self._stage_executor = ThreadPoolExecutor(max_workers=Config.STAGE_WORKERS,
+                                                  thread_name_prefix="stages")
+    
+    def close(self):
+        self._stage_executor.shutdown(wait=False)
+    
+    def _timed(self, stage, func):
+        started = time.monotonic()
+        result = func()
+        self.latencies[stage].record(time.monotonic() - started)
+        return result
+    
+    def _run_stage(self, stage, func, timeout, hedge=False):
+        """Run a stage call within timeout seconds, optionally hedging it
+        
+        An idempotent call still running after the stage's hedging percentile
+        is issued a second time and whichever finishes first wins. Calls that
+        lose or time out finish in the background and are discarded.
+        """
+        if timeout <= 0:
+            raise StageTimeout(stage)
+        
+        started = time.monotonic()
+        futures = [self._stage_executor.submit(self._timed, stage, func)]
+        
+        hedge_delay = self.latencies[stage].percentile(Config.HEDGE_PERCENTILE) if hedge else None
+        if hedge_delay is not None:
+            hedge_delay = max(hedge_delay, Config.HEDGE_MIN_DELAY)
+            if hedge_delay < timeout:
+                done, _ = wait(futures, timeout=hedge_delay)
+                if not done:
+                    logger.info(f"Hedging {stage} call after {hedge_delay:.3f}s")
+                    futures.append(self._stage_executor.submit(self._timed, stage, func))
+        
+        error = None
+        while futures:
+            done, pending = wait(futures, timeout=max(timeout - (time.monotonic() - started), 0),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                futures.remove(future)
+                try:
+                    return future.result()
+                except Exception as e:
+                    error = e
+        
+        if error is not None and not futures:
+            raise error
+        raise StageTimeout(stage)
+    
+    @staticmethod
+    def _build_filter(filter_criteria):
+        """Translate request filter criteria into an OData filter string"""
+        if not filter_criteria:
+            return None
+        
+        filter_parts = []
+        
+        if 'source_type' in filter_criteria:
+            filter_parts.append(f"source_type eq '{filter_criteria['source_type']}'")
+        
+        if 'date_from' in filter_criteria and 'date_to' in filter_criteria:
+            filter_parts.append(
+                f"uploaded_date ge {filter_criteria['date_from']} and uploaded_date le {filter_criteria['date_to']}"
+            )
+        
+        return " and ".join(filter_parts) if filter_parts else None
+    
+    @staticmethod
+    def _format_result(result):
+        # Chunks indexed before page provenance existed have no page fields
+        return {field: result.get(field) for field in SEARCH_RESULT_FIELDS}
+    
+    @staticmethod
+    def _answer_messages(query, search_results):
+        return [
+            {"role": "system", "content": ANSWER_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Context:\n{build_context(search_results)}\n\nQuestion: {query}"}
+        ]
+    
+    @staticmethod
+    def _format_sources(search_results):
+        """Prepare sources for citation"""
+        return [{
+            "title": result["title"],
+            "source_type": result["source_type"],
+            "url": result["url"] if result["url"] else None,
+            "pages": format_pages(result) or None
+        } for result in search_results]
+    
+    @staticmethod
+    def _merge_results(search_results, keyword_results, top_k):
+        """Fuse search index and keyword index results, then collapse near-duplicates"""
+        if keyword_results is not None:
+            search_results = reciprocal_rank_fusion([search_results, keyword_results],
+                                                    [Config.SEARCH_INDEX_WEIGHT, Config.KEYWORD_WEIGHT])
+        if Config.DEDUPLICATE_CHUNKS:
+            return collapse_near_duplicates(search_results, top_k)
+        return search_results[:top_k]
+    
+    @staticmethod
+    def _keyword_fast_path(keyword_index, query, top_k, filter_criteria):
+        """Results for an exact-term query from the keyword index alone, or None
+        
+        Only chunks containing every query term qualify; a query whose terms
+        are not all found goes through hybrid search instead.
+        """
+        if not (Config.KEYWORD_FAST_PATH and keyword_index is not None and is_exact_term_query(query)):
+            return None
+        fetch_k = top_k * 2 if Config.DEDUPLICATE_CHUNKS else top_k
+        keyword_results = keyword_index.search(query, fetch_k, filter_criteria, require_all=True)
+        if not keyword_results:
+            return None
+        return KnowledgeRetriever._merge_results([], keyword_results, top_k)
     
     def search_knowledge_base(self, query, top_k=5, filter_criteria=None):
         """Search knowledge base for relevant content based on query"""
+        return self.single_flight.do("search", query, [top_k, filter_criteria],
+                                     lambda: self._search_knowledge_base(query, top_k, filter_criteria))
+    
+    def _search_knowledge_base(self, query, top_k, filter_criteria):
         try:
+            # Exact-term queries are answered locally without any network call
+            fast_results = self._keyword_fast_path(self.keyword_index, query, top_k, filter_criteria)
+            if fast_results is not None:
+                return fast_results
+            
             # Generate embedding for query
             query_embedding = self._generate_embedding(query)
             
-            if not query_embedding:
-                logger.error("Failed to generate embedding for query")
-                return []
-            
-            # Prepare filter
-            filter_string = None
-            if filter_criteria:
-                filter_parts = []
-                
-                if 'source_type' in filter_criteria:
-                    filter_parts.append(f"source_type eq '{filter_criteria['source_type']}'")
-                
-                if 'date_from' in filter_criteria and 'date_to' in filter_criteria:
-                    filter_parts.append(
-                        f"uploaded_date ge {filter_criteria['date_from']} and uploaded_date le {filter_criteria['date_to']}"
-                    )
-                
-                if filter_parts:
-                    filter_string = " and ".join(filter_parts)
-            
-            # Perform vector search
-            results = self.azure_services.search_client.search(
-                search_text=query,
-                vector={"value": query_embedding, "k": top_k, "fields": "content_vector"},
-                select=["id", "content_id", "title", "content", "source_type", "url", "uploaded_date"],
-                filter=filter_string,
-                top=top_k
-            )
-            
-            search_results = []
-            for result in results:
-                search_results.append({
-                    "id": result["id"],
-                    "content_id": result["content_id"],
-                    "title": result["title"],
-                    "content": result["content"],
-                    "source_type": result["source_type"],
-                    "url": result["url"],
-                    "uploaded_date": result["uploaded_date"]
-                })
+            if query_embedding is None:
+                logger.error("Failed to generate embedding for query; falling back to keyword search")
             
-            return search_results
+            return self._execute_search(query, query_embedding, top_k, filter_criteria)
         
         except Exception as e:
             logger.error(f"Error searching knowledge base: {str(e)}")
             return []
     
-    def _generate_embedding(self, text):
-        """Generate embedding vector for a text chunk"""
+    def _execute_search(self, query, query_embedding, top_k, filter_criteria, timeout=None):
+        """Run a hybrid search, or a keyword-only search when query_embedding is None
+        
+        The search index always runs its own hybrid (or text-only) search, so
+        its keyword recall does not depend on the local index being complete.
+        With a keyword index, local BM25 results are fused on top.
+        """
+        # Prepare filter
+        filter_string = self._build_filter(filter_criteria)
+        
+        # Over-fetch so that collapsing near-duplicates still leaves top_k results
+        fetch_k = top_k * 2 if Config.DEDUPLICATE_CHUNKS else top_k
+        
+        keyword_results = None
+        if self.keyword_index is not None:
+            try:
+                keyword_results = self.keyword_index.search(query, fetch_k, filter_criteria)
+            except Exception as e:
+                logger.error(f"Error searching keyword index: {str(e)}")
+        
+        search_kwargs = {}
+        if query_embedding is not None:
+            search_kwargs["vector"] = {"value": query_embedding.tolist(), "k": fetch_k, "fields": "content_vector"}
+        if timeout:
+            search_kwargs["timeout"] = max(int(timeout), 1)
+        
+        # Perform vector search
+        results = self.azure_services.search_client.search(
+            search_text=query,
+            select=fields_in_index(SEARCH_RESULT_FIELDS, self.azure_services.index_fields()),
+            filter=filter_string,
+            top=fetch_k,
+            **search_kwargs
+        )
+        
+        search_results = []
+        for result in results:
+            search_results.append(self._format_result(result))
+        
+        return self._merge_results(search_results, keyword_results, top_k)
+    
+    def multi_query_search(self, queries, top_k=5, filter_criteria=None, deadline=None):
+        """Search for several queries at once and merge the results
+        
+        All queries are embedded in one batched call and searched concurrently,
+        so retrieval takes about as long as a single search. If embedding
+        takes longer than EMBEDDING_TIMEOUT, the queries are searched by
+        keyword only. The result lists
+        are fused by reciprocal rank, which keeps each chunk (content_id and
+        chunk_id) once, and near-duplicates are collapsed. Sub-queries still
+        running at the deadline are left out of the merge.
+        """
+        deadline = deadline or Deadline(Config.MULTI_QUERY_DEADLINE_SECONDS)
+        try:
+            # Exact-term sub-queries are answered by the keyword index
+            ranked_lists = [self._keyword_fast_path(self.keyword_index, query, top_k, filter_criteria)
+                            for query in queries]
+            pending = [i for i, results in enumerate(ranked_lists) if results is None]
+            
+            # Embed within a budget that leaves time to search; sub-queries without an
+            # embedding are searched by keyword only
+            embeddings = [None] * len(pending)
+            if pending:
+                embedding_timeout = deadline.budget(cap=Config.EMBEDDING_TIMEOUT, reserve=Config.MIN_SEARCH_BUDGET)
+                try:
+                    embeddings = self._run_stage(
+                        "embedding",
+                        lambda: self.azure_services.generate_embeddings([queries[i] for i in pending],
+                                                                        timeout=embedding_timeout),
+                        embedding_timeout
+                    )
+                except StageTimeout:
+                    logger.warning("Sub-query embeddings timed out; falling back to keyword search")
+            
+            futures = {i: self._stage_executor.submit(self._execute_search, queries[i], embedding, top_k,
+                                                      filter_criteria, deadline.remaining())
+                       for i, embedding in zip(pending, embeddings)}
+            
+            wait(futures.values(), timeout=deadline.remaining())
+            for i, future in futures.items():
+                ranked_lists[i] = []
+                if not future.done():
+                    # Finishes in the background and is discarded
+                    future.cancel()
+                    logger.warning(f"Sub-query '{queries[i]}' missed the retrieval deadline")
+                    continue
+                try:
+                    ranked_lists[i] = future.result()
+                except Exception as e:
+                    logger.error(f"Error searching sub-query '{queries[i]}': {str(e)}")
+            
+            merged = reciprocal_rank_fusion(ranked_lists, [1.0] * len(queries))
+            return self._merge_results(merged, None, top_k)
+        
+        except Exception as e:
+            logger.error(f"Error in multi-query search: {str(e)}")
+            return []
+    
+    def _generate_embedding(self, text, timeout=None):
+        """Generate embedding vector for a text chunk
+        
+        A timeout in seconds bounds the HTTP call itself, so a stage call that
+        timed out does not keep holding a stage thread.
+        """
         try:
             # Use Azure OpenAI to generate embedding
+            options = {"timeout": timeout} if timeout is not None else {}
             response = self.azure_services.openai_client.embeddings.create(
                 input=text,
-                model=Config.AZURE_OPENAI_EMBEDDING_MODEL
+                model=Config.AZURE_OPENAI_EMBEDDING_MODEL,
+                **options
             )
             
-            return response.data[0].embedding
+            return as_vector(response.data[0].embedding)
         
         except Exception as e:
             logger.error(f"Error generating embedding: {str(e)}")
             return None
             
-    def get_answer(self, query, top_k=5, filter_criteria=None):
-        """Get answer to a query based on knowledge base content"""
+    def get_answer(self, query, top_k=5, filter_criteria=None, deadline=None):
+        """Get answer to a query based on knowledge base content
+        
+        Every stage runs within the request deadline. When time runs short the
+        answer degrades instead of blocking: text-only search if the query
+        embedding is slow, and sources without a generated answer if there is
+        no time left for the chat completion. Degraded stages are listed under
+        "degraded" in the response.
+        """
+        deadline = deadline or Deadline(Config.ASK_DEADLINE_SECONDS)
+        return self.single_flight.do("answer", query, [top_k, filter_criteria, deadline.bucket()],
+                                     lambda: self._get_answer(query, top_k, filter_criteria, deadline))
+    
+    def _get_answer(self, query, top_k, filter_criteria, deadline):
+        degraded = []
         try:
-            # First, retrieve relevant content
-            search_results = self.search_knowledge_base(query, top_k, filter_criteria)
+            # Exact-term queries are answered from the keyword index without network calls
+            search_results = self._keyword_fast_path(self.keyword_index, query, top_k, filter_criteria)
+            
+            if search_results is None:
+                # Embed the query, leaving time for search and generation
+                query_embedding = None
+                embedding_timeout = deadline.budget(cap=Config.EMBEDDING_TIMEOUT,
+                                                    reserve=Config.MIN_SEARCH_BUDGET + Config.MIN_GENERATION_BUDGET)
+                try:
+                    query_embedding = self._run_stage(
+                        "embedding",
+                        lambda: self._generate_embedding(query, embedding_timeout),
+                        embedding_timeout,
+                        hedge=Config.HEDGE_REQUESTS
+                    )
+                except StageTimeout:
+                    logger.warning("Query embedding timed out; falling back to text-only search")
+                if query_embedding is None:
+                    degraded.append("embedding")
+                
+                # Retrieve relevant content
+                try:
+                    search_timeout = deadline.budget(reserve=Config.MIN_GENERATION_BUDGET)
+                    search_results = self._run_stage(
+                        "search",
+                        lambda: self._execute_search(query, query_embedding, top_k, filter_criteria, search_timeout),
+                        max(search_timeout, min(deadline.remaining(), Config.MIN_SEARCH_BUDGET)),
+                        hedge=Config.HEDGE_REQUESTS
+                    )
+                except StageTimeout:
+                    logger.warning("Search timed out")
+                    degraded.append("search")
+                    return {
+                        "answer": "Sorry, searching your knowledge base took too long. Please try again.",
+                        "sources": [],
+                        "degraded": degraded
+                    }
             
             if not search_results:
                 return {
                     "answer": "I couldn't find any relevant information in your knowledge base.",
-                    "sources": []
+                    "sources": [],
+                    "degraded": degraded
                 }
             
-            # Prepare context for OpenAI
-            context = "\n\n".join([f"Title: {result['title']}\nContent: {result['content']}" 
-                                 for result in search_results])
-            
-            # Generate answer using OpenAI
-            messages = [
-                {"role": "system", "content": "You are a helpful personal assistant that answers questions based on the user's personal knowledge base. Use ONLY the provided context to answer the question. If you don't find the answer in the context, say so honestly. Always cite your sources by mentioning the title of the document where you found the information."},
-                {"role": "user", "content": f"Context:\n{context}\n\nQuestion: {query}"}
-            ]
-            
-            response = self.azure_services.openai_client.chat.completions.create(
-                model=Config.AZURE_OPENAI_CHAT_MODEL,
-                messages=messages,
-                temperature=0.3,
-                max_tokens=1000
-            )
-            
-            answer = response.choices[0].message.content
-            
-            # Prepare sources for citation
-            sources = []
-            for result in search_results:
-                sources.append({
-                    "title": result["title"],
-                    "source_type": result["source_type"],
-                    "url": result["url"] if result["url"] else None
-                })
+            sources = self._format_sources(search_results)
+            
+            # Generate answer using OpenAI, or return sources alone if out of time
+            generation_timeout = deadline.budget()
+            if generation_timeout < Config.MIN_GENERATION_BUDGET:
+                degraded.append("generation")
+                return {"answer": None, "sources": sources, "degraded": degraded}
+            
+            messages = self._answer_messages(query, search_results)
+            
+            try:
+                answer = self._run_stage(
+                    "generation",
+                    lambda: self.azure_services.openai_client.chat.completions.create(
+                        model=Config.AZURE_OPENAI_CHAT_MODEL,
+                        messages=messages,
+                        temperature=0.3,
+                        max_tokens=1000,
+                        timeout=generation_timeout
+                    ).choices[0].message.content,
+                    generation_timeout
+                )
+            except StageTimeout:
+                logger.warning("Answer generation timed out; returning sources only")
+                degraded.append("generation")
+                return {"answer": None, "sources": sources, "degraded": degraded}
             
             return {
                 "answer": answer,
-                "sources": sources
+                "sources": sources,
+                "degraded": degraded
             }
             
         except Exception as e:
             logger.error(f"Error getting answer: {str(e)}")
             return {
                 "answer": "Sorry, I encountered an error while trying to answer your question.",
-                "sources": []
+                "sources": [],
+                "degraded": degraded
             }
 
 # Learning tools functionality
 class LearningTools:
-    def __init__(self, azure_services, knowledge_retriever):
+    def __init__(self, azure_services, knowledge_retriever, key_normalizer=None):
         self.azure_services = azure_services
         self.knowledge_retriever = knowledge_retriever
+        self.single_flight = SingleFlight("learning_tools", key_normalizer)
+    
+    def _retrieve(self, topic, top_k):
+        """Retrieve context for a topic, across expanded sub-queries in multi-query mode
+        
+        Multi-query mode merges MULTI_QUERY_TOP_K_FACTOR times top_k chunks,
+        since its sub-queries cover more of the topic than one query does.
+        """
+        if Config.MULTI_QUERY_RETRIEVAL:
+            return self.knowledge_retriever.multi_query_search(expand_topic(topic),
+                                                               top_k * Config.MULTI_QUERY_TOP_K_FACTOR)
+        return self.knowledge_retriever.search_knowledge_base(topic, top_k=top_k)
     
     def generate_flashcards(self, topic, count=None):
         """Generate flashcards for a specific topic"""
+        count = count or Config.FLASHCARD_COUNT
+        return self.single_flight.do("flashcards", topic, [count],
+                                     lambda: self._generate_flashcards(topic, count))
+    
+    def _generate_flashcards(self, topic, count):
         try:
-            count = count or Config.FLASHCARD_COUNT
-            
             # First, retrieve relevant content
-            search_results = self.knowledge_retriever.search_knowledge_base(topic, top_k=3)
+            search_results = self._retrieve(topic, top_k=3)
             
             if not search_results:
                 return []
             
             # Prepare context
-            context = "\n\n".join([f"Title: {result['title']}\nContent: {result['content']}" 
-                                 for result in search_results])
-            
-            # Generate flashcards using OpenAI
-            messages = [
-                {"role": "system", "content": f"You are a helpful assistant that creates flashcards to help users learn. Based on the provided context, create {count} flashcards in a question-answer format about the topic. Make sure the flashcards cover key concepts and important details."},
-                {"role": "user", "content": f"Context:\n{context}\n\nTopic: {topic}\nCreate {count} flashcards."}
-            ]
-            
-            response = self.azure_services.openai_client.chat.completions.create(
-                model=Config.AZURE_OPENAI_CHAT_MODEL,
-                messages=messages,
-                temperature=0.5,
-                max_tokens=1000
-            )
-            
-            flashcards_text = response.choices[0].message.content
+            context = build_context(search_results)
             
-            # Parse flashcards
-            flashcards = []
-            pattern = r"(?:Flashcard\s*\d+:?\s*)?Q(?:uestion)?:?\s*(.*?)\s*A(?:nswer)?:?\s*(.*?)(?=(?:\n\s*(?:Flashcard\s*\d+:?\s*)?Q(?:uestion)?:)|$)"
-            matches = re.finditer(pattern, flashcards_text, re.DOTALL)
-            
-            for match in matches:
-                question = match.group(1).strip()
-                answer = match.group(2).strip()
-                if question and answer:
-                    flashcards.append({
-                        "question": question,
-                        "answer": answer
-                    })
-            
-            return flashcards
+            return self._create_flashcards(context, topic, count)
             
         except Exception as e:
             logger.error(f"Error generating flashcards: {str(e)}")
             return []
     
+    @staticmethod
+    def _flashcard_messages(context, topic, count):
+        return [
+            {"role": "system", "content": f"You are a helpful assistant that creates flashcards to help users learn. Based on the provided context, create {count} flashcards in a question-answer format about the topic. Make sure the flashcards cover key concepts and important details."},
+            {"role": "user", "content": f"Context:\n{context}\n\nTopic: {topic}\nCreate {count} flashcards."}
+        ]
+    
+    def _create_flashcards(self, context, topic, count):
+        """Ask the chat model for flashcards over a context and parse them"""
+        messages = self._flashcard_messages(context, topic, count)
+        
+        response = self.azure_services.openai_client.chat.completions.create(
+            model=Config.AZURE_OPENAI_CHAT_MODEL,
+            messages=messages,
+            temperature=0.5,
+            max_tokens=max(1000, count * 150)
+        )
+        
+        return self._parse_flashcards(response.choices[0].message.content)
+    
+    @staticmethod
+    def _parse_flashcards(flashcards_text):
+        """Parse question/answer pairs from model output"""
+        flashcards = []
+        pattern = r"(?:Flashcard\s*\d+:?\s*)?Q(?:uestion)?:?\s*(.*?)\s*A(?:nswer)?:?\s*(.*?)(?=(?:\n\s*(?:Flashcard\s*\d+:?\s*)?Q(?:uestion)?:)|$)"
+        matches = re.finditer(pattern, flashcards_text, re.DOTALL)
+        
+        for match in matches:
+            question = match.group(1).strip()
+            answer = match.group(2).strip()
+            if question and answer:
+                flashcards.append({
+                    "question": question,
+                    "answer": answer
+                })
+        
+        return flashcards
+    
     def generate_summary(self, topic):
         """Generate a summary for a specific topic"""
+        return self.single_flight.do("summary", topic, None, lambda: self._generate_summary(topic))
+    
+    def _generate_summary(self, topic):
         try:
             # First, retrieve relevant content
-            search_results = self.knowledge_retriever.search_knowledge_base(topic, top_k=5)
+            search_results = self._retrieve(topic, top_k=5)
             
             if not search_results:
                 return "I couldn't find any relevant information to summarize."
             
             # Prepare context
-            context = "\n\n".join([f"Title: {result['title']}\nContent: {result['content']}" 
-                                 for result in search_results])
-            
-            # Generate summary using OpenAI
-            messages = [
-                {"role": "system", "content": "You are a helpful assistant that creates concise summaries based on the provided context. Create a well-structured summary that captures the main points and key details."},
-                {"role": "user", "content": f"Context:\n{context}\n\nCreate a summary about: {topic}"}
-            ]
-            
-            response = self.azure_services.openai_client.chat.completions.create(
-                model=Config.AZURE_OPENAI_CHAT_MODEL,
-                messages=messages,
-                temperature=0.3,
-                max_tokens=1000
-            )
+            context = build_context(search_results)
             
-            summary = response.choices[0].message.content
-            return summary
+            return self._create_summary(context, topic)
             
         except Exception as e:
             logger.error(f"Error generating summary: {str(e)}")
             return "Sorry, I encountered an error while trying to generate a summary."
     
+    @staticmethod
+    def _summary_messages(context, topic):
+        return [
+            {"role": "system", "content": "You are a helpful assistant that creates concise summaries based on the provided context. Create a well-structured summary that captures the main points and key details."},
+            {"role": "user", "content": f"Context:\n{context}\n\nCreate a summary about: {topic}"}
+        ]
+    
+    def _create_summary(self, context, topic):
+        """Ask the chat model for a summary of a context"""
+        messages = self._summary_messages(context, topic)
+        
+        response = self.azure_services.openai_client.chat.completions.create(
+            model=Config.AZURE_OPENAI_CHAT_MODEL,
+            messages=messages,
+            temperature=0.3,
+            max_tokens=1000
+        )
+        
+        return response.choices[0].message.content
+    
     def generate_quiz(self, topic, question_count=5):
         """Generate a quiz for a specific topic"""
+        return self.single_flight.do("quiz", topic, [question_count],
+                                     lambda: self._generate_quiz(topic, question_count))
+    
+    def _generate_quiz(self, topic, question_count):
         try:
             # First, retrieve relevant content
-            search_results = self.knowledge_retriever.search_knowledge_base(topic, top_k=3)
+            search_results = self._retrieve(topic, top_k=3)
             
             if not search_results:
                 return []
             
             # Prepare context
-            context = "\n\n".join([f"Title: {result['title']}\nContent: {result['content']}" 
-                                 for result in search_results])
-            
-            # Generate quiz using OpenAI
-            messages = [
-                {"role": "system", "content": f"You are a helpful assistant that creates quizzes to help users learn. Based on the provided context, create {question_count} quiz questions in a multiple-choice format about the topic. Include 4 options for each question and indicate the correct answer."},
-                {"role": "user", "content": f"Context:\n{context}\n\nTopic: {topic}\nCreate {question_count} multiple-choice questions."}
-            ]
-            
-            response = self.azure_services.openai_client.chat.completions.create(
-                model=Config.AZURE_OPENAI_CHAT_MODEL,
-                messages=messages,
-                temperature=0.5,
-                max_tokens=1500
-            )
-            
-            quiz_text = response.choices[0].message.content
-            
-            # Parse quiz questions
-            quiz = []
-            pattern = r"(?:Question\s*(\d+):?\s*)(.*?)(?:\n(?:Options|Choices):?\s*\n)((?:(?:[A-D]\.?\s*.*?\n){4}))(?:(?:Correct Answer|Answer):?\s*([A-D]))"
-            matches = re.finditer(pattern, quiz_text, re.DOTALL)
-            
-            for match in matches:
-                question_num = match.group(1)
-                question_text = match.group(2).strip()
-                options_text = match.group(3).strip()
-                correct_answer = match.group(4).strip()
-                
-                # Parse options
-                options = {}
-                option_pattern = r"([A-D])\.?\s*(.*?)(?=\n[A-D]\.|\Z)"
-                option_matches = re.finditer(option_pattern, options_text + "\n", re.DOTALL)
-                
-                for option_match in option_matches:
-                    option_letter = option_match.group(1)
-                    option_content = option_match.group(2).strip()
-                    options[option_letter] = option_content
-                
-                quiz.append({
-                    "question_number": question_num,
-                    "question": question_text,
-                    "options": options,
-                    "correct_answer": correct_answer
-                })
+            context = build_context(search_results)
             
-            return quiz
+            return self._create_quiz(context, topic, question_count)
             
         except Exception as e:
             logger.error(f"Error generating quiz: {str(e)}")
             return []
+    
+    @staticmethod
+    def _quiz_messages(context, topic, question_count):
+        return [
+            {"role": "system", "content": f"You are a helpful assistant that creates quizzes to help users learn. Based on the provided context, create {question_count} quiz questions in a multiple-choice format about the topic. Include 4 options for each question and indicate the correct answer."},
+            {"role": "user", "content": f"Context:\n{context}\n\nTopic: {topic}\nCreate {question_count} multiple-choice questions."}
+        ]
+    
+    def _create_quiz(self, context, topic, question_count):
+        """Ask the chat model for multiple-choice questions and parse them"""
+        messages = self._quiz_messages(context, topic, question_count)
+        
+        response = self.azure_services.openai_client.chat.completions.create(
+            model=Config.AZURE_OPENAI_CHAT_MODEL,
+            messages=messages,
+            temperature=0.5,
+            max_tokens=max(1500, question_count * 250)
+        )
+        
+        return self._parse_quiz(response.choices[0].message.content)
+    
+    @staticmethod
+    def _parse_quiz(quiz_text):
+        """Parse multiple-choice questions from model output"""
+        quiz = []
+        pattern = r"(?:Question\s*(\d+):?\s*)(.*?)(?:\n(?:Options|Choices):?\s*\n)((?:(?:[A-D]\.?\s*.*?\n){4}))(?:(?:Correct Answer|Answer):?\s*([A-D]))"
+        matches = re.finditer(pattern, quiz_text, re.DOTALL)
+        
+        for match in matches:
+            question_num = match.group(1)
+            question_text = match.group(2).strip()
+            options_text = match.group(3).strip()
+            correct_answer = match.group(4).strip()
+            
+            # Parse options
+            options = {}
+            option_pattern = r"([A-D])\.?\s*(.*?)(?=\n[A-D]\.|\Z)"
+            option_matches = re.finditer(option_pattern, options_text + "\n", re.DOTALL)
+            
+            for option_match in option_matches:
+                option_letter = option_match.group(1)
+                option_content = option_match.group(2).strip()
+                options[option_letter] = option_content
+            
+            quiz.append({
+                "question_number": question_num,
+                "question": question_text,
+                "options": options,
+                "correct_answer": correct_answer
+            })
+        
+        return quiz
+    
+    def generate_document_artifacts(self, document_content, metadata):
+        """Generate a summary and pools of flashcards and quiz questions for one document
+        
+        Long documents are covered section by section (see artifact_sections):
+        the pools are split over the sections, and the section summaries are
+        summarized once more.
+        """
+        sections, truncated = artifact_sections(document_content)
+        if not sections:
+            return None
+        
+        topic = metadata["title"]
+        contexts = [artifact_context(topic, section) for section in sections]
+        summaries = [self._create_summary(context, topic) for context in contexts]
+        summary = summaries[0] if len(summaries) == 1 else \
+            self._create_summary(artifact_context(topic, "\n\n".join(summaries)), topic)
+        flashcards = [self._create_flashcards(context, topic, count) if count else []
+                      for context, count in zip(contexts, split_pool(Config.FLASHCARD_POOL_SIZE, len(contexts)))]
+        quizzes = [self._create_quiz(context, topic, count) if count else []
+                   for context, count in zip(contexts, split_pool(Config.QUIZ_POOL_SIZE, len(contexts)))]
+        
+        return build_document_artifacts(metadata, summary, flashcards, quizzes, truncated)
+    
+    def get_document_artifacts(self, content_ids):
+        """Load precomputed artifacts for the given documents
+        
+        Returns (status, documents) as described in resolve_artifacts.
+        """
+        container = self.azure_services.get_metadata_container()
+        items = []
+        
+        for content_id in content_ids:
+            try:
+                items.append(container.read_item(item=content_id, partition_key=content_id))
+            except CosmosResourceNotFoundError:
+                items.append(None)
+        
+        return resolve_artifacts(items)
+    
+    @staticmethod
+    def document_flashcards(documents, count=None):
+        """Sample flashcards from the precomputed pools of one or more documents"""
+        count = count or Config.FLASHCARD_COUNT
+        pool = [card for _, artifacts in documents for card in artifacts.get("flashcards", [])]
+        return random.sample(pool, min(count, len(pool)))
+    
+    @staticmethod
+    def document_summary(documents):
+        """Combine the precomputed summaries of one or more documents"""
+        if len(documents) == 1:
+            return documents[0][1].get("summary", "")
+        return "\n\n".join([f"{item['title']}\n{artifacts.get('summary', '')}"
+                            for item, artifacts in documents])
+    
+    @staticmethod
+    def document_quiz(documents, question_count=5):
+        """Sample quiz questions from the precomputed pools of one or more documents"""
+        pool = [question for _, artifacts in documents for question in artifacts.get("quiz", [])]
+        quiz = random.sample(pool, min(question_count, len(pool)))
+        
+        # Renumber sampled questions
+        return [dict(question, question_number=str(i + 1)) for i, question in enumerate(quiz)]
+
+def artifact_sections(document_content):
+    """Split document text into the sections learning artifacts are generated from
+    
+    Sections of up to ARTIFACT_CONTEXT_CHARS characters, split between words,
+    cover the text up to ARTIFACT_MAX_SECTIONS sections. Returns (sections,
+    truncated), truncated telling whether text was left out.
+    """
+    content = " ".join(document_content.split())
+    sections = []
+    while content and len(sections) < Config.ARTIFACT_MAX_SECTIONS:
+        cut = len(content)
+        if cut > Config.ARTIFACT_CONTEXT_CHARS:
+            cut = content.rfind(" ", 0, Config.ARTIFACT_CONTEXT_CHARS + 1)
+            if cut <= 0:
+                cut = Config.ARTIFACT_CONTEXT_CHARS
+        sections.append(content[:cut])
+        content = content[cut:].lstrip()
+    return sections, bool(content)
+
+def artifact_context(title, content):
+    return f"Title: {title}\nContent: {content}"
 
-# Initialize services
-azure_services = AzureServices()
-document_processor = DocumentProcessor(azure_services)
-knowledge_retriever = KnowledgeRetriever(azure_services)
-learning_tools = LearningTools(azure_services, knowledge_retriever)
+def split_pool(size, parts):
+    """Split an artifact pool size over parts, earlier parts taking the remainder"""
+    return [size // parts + (1 if part < size % parts else 0) for part in range(parts)]
+
+def build_document_artifacts(metadata, summary, flashcards, quizzes, truncated):
+    """Combine the artifacts generated per section of a document
+    
+    flashcards and quizzes hold one list per section. Quiz questions are
+    renumbered across sections.
+    """
+    if truncated:
+        logger.warning(f"Artifacts for content ID {metadata['id']} cover only the first "
+                       f"{Config.ARTIFACT_MAX_SECTIONS * Config.ARTIFACT_CONTEXT_CHARS} characters")
+    quiz = [question for section in quizzes for question in section]
+    return {
+        "summary": summary,
+        "flashcards": [card for section in flashcards for card in section],
+        "quiz": [dict(question, question_number=str(i + 1)) for i, question in enumerate(quiz)],
+        "truncated": truncated,
+        "generated_date": datetime.datetime.now().isoformat()
+    }
+
+def fail_pending_artifacts(ingest_version):
+    """MetadataStore.update change marking the pending artifacts of a failed ingest as failed
+    
+    Artifacts of any other ingest version are left alone.
+    """
+    def change(item):
+        if item.get("ingest_version") != ingest_version or item.get("artifacts_status") != "pending":
+            return False
+        item["artifacts_status"] = "failed"
+    return change
+
+def store_artifacts(ingest_version, artifacts, status):
+    """MetadataStore.update change storing generated artifacts
+    
+    The write is skipped if the document was re-ingested meanwhile; the
+    change's stored attribute tells whether the last attempt wrote them.
+    """
+    def change(item):
+        change.stored = item.get("ingest_version") == ingest_version
+        if not change.stored:
+            return False
+        item["artifacts"] = artifacts
+        item["artifacts_status"] = status
+    change.stored = False
+    return change
+
+# Artifact states that will not change without re-ingesting, most severe first
+ARTIFACT_ERRORS = {
+    "missing": ("Document not found", 404),
+    "failed": ("Learning material could not be generated for this document", 422),
+    "empty": ("The document has no content to generate learning material from", 422),
+    "disabled": ("Learning material is not precomputed; provide a topic instead", 422),
+}
+
+def resolve_artifacts(items):
+    """Combine the artifact state of documents read from the metadata container
+    
+    items holds one metadata item per requested document (None if missing).
+    Returns ("ready", [(metadata, artifacts)]) when every document is ready,
+    otherwise the most severe state of ARTIFACT_ERRORS present, or "pending",
+    with no documents.
+    """
+    states = set()
+    for item in items:
+        if item is None:
+            states.add("missing")
+        elif item.get("artifacts_status") == "ready" and item.get("artifacts"):
+            states.add("ready")
+        elif item.get("artifacts_status") == "ready":
+            states.add("empty")
+        else:
+            states.add(item.get("artifacts_status") or "disabled")
+    
+    for status in ARTIFACT_ERRORS:
+        if status in states:
+            return status, None
+    if states - {"ready"}:
+        return "pending", None
+    return "ready", [(item, item["artifacts"]) for item in items]
+
+def artifacts_unavailable(status, key, empty):
+    """Response body and status code for a document-scoped request without ready artifacts"""
+    if status in ARTIFACT_ERRORS:
+        message, code = ARTIFACT_ERRORS[status]
+        return {"status": status, "error": message, key: empty}, code
+    return {"status": "pending", key: empty}, 202
+
+# Background precomputation of learning artifacts
+class ArtifactPrecomputer:
+    def __init__(self, azure_services, learning_tools, max_workers=None, metadata_store=None):
+        self.azure_services = azure_services
+        self.learning_tools = learning_tools
+        self.metadata_store = metadata_store or MetadataStore(azure_services)
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or Config.ARTIFACT_WORKERS,
+            thread_name_prefix="artifacts"
+        )
+    
+    def submit(self, document_content, metadata):
+        """Schedule artifact generation for a freshly ingested document"""
+        return self.executor.submit(self._precompute, document_content, dict(metadata))
+    
+    def _precompute(self, document_content, metadata):
+        content_id = metadata["id"]
+        for attempt in range(Config.ARTIFACT_RETRIES + 1):
+            try:
+                artifacts = self.learning_tools.generate_document_artifacts(document_content, metadata)
+                status = "ready" if artifacts else "empty"
+                break
+            except Exception as e:
+                logger.error(f"Error precomputing artifacts for content ID {content_id} "
+                             f"(attempt {attempt + 1}): {str(e)}")
+                artifacts = None
+                status = "failed"
+                if attempt < Config.ARTIFACT_RETRIES:
+                    time.sleep(Config.ARTIFACT_RETRY_DELAY * 2 ** attempt)
+        
+        try:
+            # Re-read and re-checked on every retry of a write that lost to another one
+            change = store_artifacts(metadata["ingest_version"], artifacts, status)
+            if self.metadata_store.update(content_id, change) and change.stored:
+                logger.info(f"Stored precomputed artifacts for content ID: {content_id} ({status})")
+            else:
+                logger.info(f"Discarding stale artifacts for content ID: {content_id}")
+        
+        except Exception as e:
+            logger.error(f"Error storing artifacts for content ID {content_id}: {str(e)}")
+    
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+def backfill_select(azure_services):
+    """Fields read from the search index to backfill the keyword index
+    
+    Keyword-only results are cited like search results, so besides the text
+    the backfill reads the result fields the live index has.
+    """
+    return fields_in_index(SEARCH_RESULT_FIELDS, azure_services.index_fields())
+
+def open_keyword_index():
+    """Open the configured keyword index, or None if it is disabled or fails to open
+    
+    Without a keyword index, search falls back to the search index alone.
+    """
+    if not Config.KEYWORD_INDEX:
+        return None
+    try:
+        return BM25Index(Config.KEYWORD_INDEX_PATH or None)
+    except Exception as e:
+        logger.error(f"Error opening keyword index: {str(e)}")
+        return None
+
+def create_keyword_index(azure_services):
+    """Open this process's keyword index, or None if it is disabled
+    
+    A shared database is backfilled once by provision_resources; an index kept
+    in process memory only is loaded from the search index here, and a failed
+    load is logged and leaves it empty.
+    """
+    keyword_index = open_keyword_index()
+    if keyword_index is not None and not Config.KEYWORD_INDEX_PATH:
+        try:
+            keyword_index.rebuild(all_indexed_chunks(azure_services.search_client, backfill_select(azure_services)))
+        except Exception as e:
+            logger.error(f"Error loading keyword index: {str(e)}")
+    return keyword_index
+
+# Per-process service registry
+class Services:
+    def __init__(self, provision=False):
+        self.azure_services = AzureServices(provision=provision)
+        self.keyword_index = create_keyword_index(self.azure_services)
+        self.metadata_store = MetadataStore(self.azure_services, self.keyword_index)
+        key_normalizer = configured_key_normalizer()
+        self.knowledge_retriever = KnowledgeRetriever(self.azure_services, key_normalizer, self.keyword_index)
+        self.learning_tools = LearningTools(self.azure_services, self.knowledge_retriever, key_normalizer)
+        self.artifact_precomputer = (ArtifactPrecomputer(self.azure_services, self.learning_tools,
+                                                         metadata_store=self.metadata_store)
+                                     if Config.PRECOMPUTE_ARTIFACTS else None)
+        self.document_processor = DocumentProcessor(self.azure_services, self.artifact_precomputer,
+                                                    self.metadata_store, self.keyword_index)
+    
+    def coalescing_stats(self):
+        return {
+            "knowledge_retriever": self.knowledge_retriever.single_flight.stats(),
+            "learning_tools": self.learning_tools.single_flight.stats()
+        }
+    
+    def close(self):
+        if self.artifact_precomputer:
+            self.artifact_precomputer.shutdown(wait=True)
+        self.knowledge_retriever.close()
+        self.azure_services.close()
+
+_services = None
+_services_pid = None
+_services_lock = threading.Lock()
+
+def get_services():
+    """Return this process's services, creating them on first use after a fork
+    
+    Clients are keyed by process ID so that a worker never reuses connection
+    pools or executor threads inherited from its parent.
+    """
+    global _services, _services_pid
+    pid = os.getpid()
+    if _services_pid != pid:
+        with _services_lock:
+            if _services_pid != pid:
+                _services = Services(provision=False)
+                _services_pid = pid
+                logger.info(f"Initialized services for worker process {pid}")
+    return _services
+
+def reset_services():
+    """Drop services inherited from a parent process without closing its sockets"""
+    global _services, _services_pid, _services_lock
+    _services = None
+    _services_pid = None
+    _services_lock = threading.Lock()
+
+def shutdown_services():
+    """Close this process's services, waiting for background artifact jobs"""
+    global _services, _services_pid
+    if _services is not None and _services_pid == os.getpid():
+        _services.close()
+    _services = None
+    _services_pid = None
+
+def provision_resources():
+    """Create the storage container, database and search index if missing
+    
+    Run once per deployment (or in the server master before forking); the
+    clients used for provisioning are closed before returning.
+    """
+    azure_services = AzureServices(provision=True)
+    try:
+        if Config.KEYWORD_INDEX and Config.KEYWORD_INDEX_PATH:
+            backfill_keyword_index(azure_services)
+        record_unrecorded_links(azure_services)
+    finally:
+        azure_services.close()
+
+def record_unrecorded_links(azure_services):
+    """Record links of documents that are missing from linked_by, e.g. written before it existed
+    
+    Best effort, like the keyword index backfill.
+    """
+    try:
+        count = MetadataStore(azure_services).record_unrecorded_links()
+        if count:
+            logger.info(f"Recorded links of {count} documents")
+    except Exception as e:
+        logger.error(f"Error recording document links: {str(e)}")
+
+def backfill_keyword_index(azure_services):
+    """Fill an empty shared keyword index from chunks indexed before it existed
+    
+    Best effort: on failure the error is logged, the server starts anyway, and
+    the next provisioning run retries.
+    """
+    try:
+        keyword_index = BM25Index(Config.KEYWORD_INDEX_PATH)
+        try:
+            if keyword_index.is_empty():
+                count = keyword_index.rebuild(all_indexed_chunks(azure_services.search_client,
+                                                                 backfill_select(azure_services)))
+                logger.info(f"Built keyword index with {count} chunks")
+        finally:
+            keyword_index.close()
+    except Exception as e:
+        logger.error(f"Error backfilling keyword index: {str(e)}")
+
+def _requested_content_ids(payload):
+    """Read the document scope of a learning tools request"""
+    content_ids = payload.get('content_ids') or []
+    if payload.get('content_id'):
+        content_ids = [payload['content_id']] + list(content_ids)
+    return content_ids
+
+# Request parsing and responses shared by the Flask and Quart endpoints
+class RequestError(Exception):
+    """A malformed API request, answered with a 400"""
+
+class DocumentNotFoundError(Exception):
+    """A request naming a document that does not exist, answered with a 404"""
+
+# Client-supplied content IDs become metadata item IDs, blob names and the
+# prefix of search index keys, which allow letters, digits, "_", "-" and "="
+# and may not start with "_"
+CONTENT_ID_PATTERN = re.compile(r'[A-Za-z0-9=-][A-Za-z0-9_=-]{0,127}')
+
+def parse_content_id(content_id):
+    """Validate the content ID of a document to re-ingest; None when not given"""
+    if content_id is None or content_id == "":
+        return None
+    # "-chunk-" would make chunk IDs of different documents collide
+    if not isinstance(content_id, str) or not CONTENT_ID_PATTERN.fullmatch(content_id) or "-chunk-" in content_id:
+        raise RequestError("Invalid content_id")
+    return content_id
+
+# Learning tools: count parameter, default count and empty value of each response key
+LEARNING_TOOL_REQUESTS = {
+    "flashcards": ("count", Config.FLASHCARD_COUNT, []),
+    "summary": (None, None, ""),
+    "quiz": ("question_count", 5, []),
+}
+
+def parse_upload_request(payload):
+    """Keyword arguments of process_document for a URL or text upload"""
+    payload = payload or {}
+    if 'url' in payload:
+        return {"url": payload['url'], "title": payload.get('title'),
+                "content_id": parse_content_id(payload.get('content_id'))}
+    if 'text' in payload:
+        return {"text_content": payload['text'], "title": payload.get('title'), "source_type": 'note',
+                "content_id": parse_content_id(payload.get('content_id'))}
+    raise RequestError("No content provided")
+
+def parse_file_upload(filename, form):
+    """Keyword arguments of process_document for an uploaded file, besides its data"""
+    if not filename:
+        raise RequestError("No file selected")
+    return {"title": form.get('title', filename), "content_id": parse_content_id(form.get('content_id'))}
+
+def parse_ask_request(payload):
+    """Read the query, filter criteria and optional client deadline of a question"""
+    payload = payload or {}
+    query = payload.get('query')
+    if not query:
+        raise RequestError("No question provided")
+    
+    # Optional client deadline, capped by the server
+    deadline_ms = payload.get('deadline_ms')
+    if deadline_ms is None:
+        return query, payload.get('filter'), None
+    try:
+        if isinstance(deadline_ms, bool):
+            raise TypeError(deadline_ms)
+        seconds = float(deadline_ms) / 1000
+    except (TypeError, ValueError):
+        raise RequestError("deadline_ms must be a number of milliseconds")
+    if not seconds > 0:
+        raise RequestError("deadline_ms must be positive")
+    return query, payload.get('filter'), Deadline(min(seconds, Config.MAX_DEADLINE_SECONDS))
+
+def parse_learning_request(kind, payload):
+    """Read the topic, count and document scope of a learning tools request"""
+    payload = payload or {}
+    count_key, default_count, _ = LEARNING_TOOL_REQUESTS[kind]
+    topic = payload.get('topic')
+    count = payload.get(count_key, default_count) if count_key else None
+    content_ids = _requested_content_ids(payload)
+    if not topic and not content_ids:
+        raise RequestError("No topic provided")
+    return topic, count, content_ids
+
+def document_artifacts_response(kind, status, documents, count, topic):
+    """Body and status code for a document-scoped learning tools request
+    
+    Returns None when the artifacts are not ready but a topic was given, so
+    the material is generated from the topic instead.
+    """
+    if status == "ready":
+        if kind == "summary":
+            material = LearningTools.document_summary(documents)
+        else:
+            material = getattr(LearningTools, f"document_{kind}")(documents, count)
+        return {kind: material, "precomputed": True}, 200
+    if not topic:
+        return artifacts_unavailable(status, kind, LEARNING_TOOL_REQUESTS[kind][2])
+    return None
+
+def generate_learning_material(learning_tools, kind, topic, count):
+    """Generate a learning tool's material for a topic (a coroutine for async learning tools)"""
+    if kind == "summary":
+        return learning_tools.generate_summary(topic)
+    return getattr(learning_tools, f"generate_{kind}")(topic, count)
+
+def parse_list_request(args):
+    """Read the source type, page size and continuation token of a document listing"""
+    try:
+        limit = int(args.get('limit', 50))
+    except (TypeError, ValueError):
+        raise RequestError("limit must be an integer")
+    if limit < 1:
+        raise RequestError("limit must be positive")
+    return args.get('source_type'), min(limit, 500), args.get('continuation')
+
+def public_metadata(metadata):
+    """Document metadata without the container's system properties"""
+    return {key: value for key, value in metadata.items() if not key.startswith('_')}
 
 # API endpoints
-@app.route('/')
+api = Blueprint('api', __name__)
+
+@api.route('/')
 def index():
     """Main page"""
     return render_template('index.html')
 
-@app.route('/api/upload', methods=['POST'])
+@api.route('/api/upload', methods=['POST'])
 def upload_document():
     """Upload a document to the knowledge base"""
     try:
         if 'file' in request.files:
             file = request.files['file']
-            if file.filename == '':
-                return jsonify({"error": "No file selected"}), 400
+            upload = parse_file_upload(file.filename, request.form)
             
             # Save file temporarily
             temp_file_path = f"/tmp/{file.filename}"
             file.save(temp_file_path)
             
             # Process document
-            result = document_processor.process_document(
-                file_path=temp_file_path,
-                title=request.form.get('title', file.filename)
-            )
-            
-            # Clean up
-            os.remove(temp_file_path)
-            
-            return jsonify(result)
-        
-        elif 'url' in request.json:
-            url = request.json['url']
-            # Process URL
-            result = document_processor.process_document(
-                url=url,
-                title=request.json.get('title')
-            )
-            return jsonify(result)
-        
-        elif 'text' in request.json:
-            text = request.json['text']
-            # Process text
-            result = document_processor.process_document(
-                text_content=text,
-                title=request.json.get('title'),
-                source_type='note'
-            )
+            try:
+                result = get_services().document_processor.process_document(file_path=temp_file_path, **upload)
+            finally:
+                os.remove(temp_file_path)
             return jsonify(result)
         
-        else:
-            return jsonify({"error": "No content provided"}), 400
+        upload = parse_upload_request(request.json)
+        result = get_services().document_processor.process_document(**upload)
+        return jsonify(result)
     
+    except RequestError as e:
+        return jsonify({"error": str(e)}), 400
+    except DocumentNotFoundError:
+        return jsonify({"error": "Document not found"}), 404
     except Exception as e:
         logger.error(f"Error in upload_document: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/ask', methods=['POST'])
+@api.route('/api/ask', methods=['POST'])
 def ask_question():
     """Ask a question to the knowledge base"""
     try:
-        query = request.json.get('query')
-        if not query:
-            return jsonify({"error": "No question provided"}), 400
-        
-        filter_criteria = request.json.get('filter')
+        query, filter_criteria, deadline = parse_ask_request(request.json)
         
         # Get answer
-        result = knowledge_retriever.get_answer(query, filter_criteria=filter_criteria)
+        result = get_services().knowledge_retriever.get_answer(query, filter_criteria=filter_criteria,
+                                                               deadline=deadline)
         return jsonify(result)
     
+    except RequestError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.error(f"Error in ask_question: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/flashcards', methods=['POST'])
-def create_flashcards():
-    """Create flashcards for a topic"""
+def _learning_tool_endpoint(kind):
+    """Serve precomputed material for document-scoped requests, else generate it for the topic"""
     try:
-        topic = request.json.get('topic')
-        count = request.json.get('count', Config.FLASHCARD_COUNT)
+        topic, count, content_ids = parse_learning_request(kind, request.json)
+        learning_tools = get_services().learning_tools
         
-        if not topic:
-            return jsonify({"error": "No topic provided"}), 400
+        if content_ids:
+            status, documents = learning_tools.get_document_artifacts(content_ids)
+            response = document_artifacts_response(kind, status, documents, count, topic)
+            if response is not None:
+                body, code = response
+                return jsonify(body), code
         
-        # Generate flashcards
-        flashcards = learning_tools.generate_flashcards(topic, count)
-        return jsonify({"flashcards": flashcards})
+        return jsonify({kind: generate_learning_material(learning_tools, kind, topic, count)})
     
+    except RequestError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        logger.error(f"Error in create_flashcards: {str(e)}")
+        logger.error(f"Error in create_{kind}: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/summary', methods=['POST'])
+@api.route('/api/flashcards', methods=['POST'])
+def create_flashcards():
+    """Create flashcards for a topic or for specific documents"""
+    return _learning_tool_endpoint("flashcards")
+
+@api.route('/api/summary', methods=['POST'])
 def create_summary():
-    """Create a summary for a topic"""
+    """Create a summary for a topic or for specific documents"""
+    return _learning_tool_endpoint("summary")
+
+@api.route('/api/quiz', methods=['POST'])
+def create_quiz():
+    """Create a quiz for a topic or for specific documents"""
+    return _learning_tool_endpoint("quiz")
+
+@api.route('/api/documents', methods=['GET'])
+def list_documents():
+    """List documents in the knowledge base, newest first"""
     try:
-        topic = request.json.get('topic')
-        
-        if not topic:
-            return jsonify({"error": "No topic provided"}), 400
-        
-        # Generate summary
-        summary = learning_tools.generate_summary(topic)
-        return jsonify({"summary": summary})
+        source_type, limit, continuation = parse_list_request(request.args)
+        documents, continuation = get_services().metadata_store.list(
+            source_type=source_type,
+            limit=limit,
+            continuation=continuation
+        )
+        return jsonify({"documents": documents, "continuation": continuation})
     
+    except RequestError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        logger.error(f"Error in create_summary: {str(e)}")
+        logger.error(f"Error in list_documents: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/quiz', methods=['POST'])
-def create_quiz():
-    """Create a quiz for a topic"""
+@api.route('/api/documents/<content_id>', methods=['GET'])
+def get_document(content_id):
+    """Get a document's metadata"""
     try:
-        topic = request.json.get('topic')
-        question_count = request.json.get('question_count', 5)
-        
-        if not topic:
-            return jsonify
\ No newline at end of file
+        metadata = get_services().metadata_store.get(content_id)
+        if metadata is None:
+            return jsonify({"error": "Document not found"}), 404
+        return jsonify(public_metadata(metadata))
+    
+    except Exception as e:
+        logger.error(f"Error in get_document: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/documents/<content_id>', methods=['DELETE'])
+def delete_document(content_id):
+    """Delete a document and all of its chunks"""
+    try:
+        if not get_services().metadata_store.delete(content_id):
+            return jsonify({"error": "Document not found"}), 404
+        return jsonify({"deleted": content_id})
+    
+    except Exception as e:
+        logger.error(f"Error in delete_document: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/metrics/coalescing', methods=['GET'])
+def coalescing_metrics():
+    """Report how many calls were served from an identical in-flight call"""
+    return jsonify(get_services().coalescing_stats())
+
+def create_app(provision=False):
+    """Application factory
+    
+    Services are created lazily in each process on first request, so the app
+    can be imported in a pre-fork server master and shared by its workers.
+    """
+    if provision:
+        provision_resources()
+    
+    app = Flask(__name__)
+    app.register_blueprint(api)
+    return app
+
+if __name__ == '__main__':
+    create_app(provision=True).run(debug=True)
@@ -0,0 +1,139 @@
+from types import SimpleNamespace
+
+import pytest
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError, CosmosResourceNotFoundError
+
+from index2 import (
+    ArtifactPrecomputer,
+    Config,
+    DocumentProcessor,
+    LearningTools,
+    MetadataStore,
+    artifact_sections,
+    artifacts_unavailable,
+    resolve_artifacts,
+)
+
+
+def item(status, artifacts=None):
+    return {"id": status, "title": status, "artifacts_status": status, "artifacts": artifacts}
+
+
+def test_ready_when_every_document_is_ready():
+    ready = item("ready", {"summary": "s"})
+    status, documents = resolve_artifacts([ready, ready])
+    assert status == "ready"
+    assert documents == [(ready, {"summary": "s"}), (ready, {"summary": "s"})]
+
+
+def test_pending_until_all_documents_are_ready():
+    assert resolve_artifacts([item("ready", {"summary": "s"}), item("pending")]) == ("pending", None)
+
+
+def test_terminal_states_win_over_pending():
+    assert resolve_artifacts([item("pending"), item("failed")]) == ("failed", None)
+    assert resolve_artifacts([item("empty"), item("pending")]) == ("empty", None)
+    assert resolve_artifacts([item("pending"), None]) == ("missing", None)
+
+
+def test_ready_without_artifacts_is_not_ready():
+    assert resolve_artifacts([item("ready", None)]) == ("empty", None)
+
+
+def test_unavailable_responses():
+    assert artifacts_unavailable("pending", "quiz", []) == ({"status": "pending", "quiz": []}, 202)
+    body, code = artifacts_unavailable("failed", "summary", "")
+    assert code == 422 and body["status"] == "failed" and body["summary"] == ""
+    assert artifacts_unavailable("missing", "flashcards", [])[1] == 404
+
+
+class FakeContainer:
+    """Metadata container that can lose the next replace to a concurrent write"""
+    def __init__(self, items=()):
+        self.items = {item["id"]: dict(item, _etag="0") for item in items}
+        self.concurrent_writes = []
+
+    def read_item(self, item, partition_key):
+        if item not in self.items:
+            raise CosmosResourceNotFoundError(status_code=404, message="missing")
+        return dict(self.items[item])
+
+    def replace_item(self, item, body, etag=None, match_condition=None):
+        if self.concurrent_writes:
+            self.items[item].update(self.concurrent_writes.pop(0), _etag=str(int(self.items[item]["_etag"]) + 1))
+        if etag != self.items[item]["_etag"]:
+            raise CosmosAccessConditionFailedError(status_code=412, message="modified")
+        self.items[item] = dict(body, _etag=str(int(etag) + 1))
+
+    def upsert_item(self, body):
+        self.items[body["id"]] = dict(body, _etag="0")
+
+    create_item = upsert_item
+
+
+def store_with(documents):
+    return MetadataStore(SimpleNamespace(get_metadata_container=lambda: documents,
+                                         get_catalog_container=lambda: FakeContainer()))
+
+
+def test_sections_cover_long_documents_up_to_the_limit(monkeypatch):
+    monkeypatch.setattr(Config, "ARTIFACT_CONTEXT_CHARS", 20)
+    monkeypatch.setattr(Config, "ARTIFACT_MAX_SECTIONS", 3)
+
+    sections, truncated = artifact_sections("one two three\nfour five six seven")
+    assert sections == ["one two three four", "five six seven"] and not truncated
+
+    sections, truncated = artifact_sections("word " * 30)
+    assert len(sections) == 3 and all(len(section) <= 20 for section in sections) and truncated
+
+
+def test_document_artifacts_are_built_from_every_section(monkeypatch):
+    monkeypatch.setattr(Config, "ARTIFACT_CONTEXT_CHARS", 20)
+    tools = object.__new__(LearningTools)
+    tools._create_summary = lambda context, topic: f"summary of {context.split('Content: ')[1]}"
+    tools._create_flashcards = lambda context, topic, count: [{"front": context}] * count
+    tools._create_quiz = lambda context, topic, count: [{"question_number": "1", "question": context}] * count
+
+    artifacts = tools.generate_document_artifacts("alpha beta gamma delta epsilon zeta", {"id": "doc", "title": "T"})
+
+    assert "summary of alpha beta gamma" in artifacts["summary"]
+    assert "summary of delta epsilon zeta" in artifacts["summary"]
+    assert len(artifacts["flashcards"]) == Config.FLASHCARD_POOL_SIZE
+    assert any("epsilon" in card["front"] for card in artifacts["flashcards"])
+    assert [question["question_number"] for question in artifacts["quiz"]] == \
+        [str(i + 1) for i in range(Config.QUIZ_POOL_SIZE)]
+    assert artifacts["truncated"] is False
+
+
+@pytest.mark.parametrize("concurrent_write, status", [
+    ({"title": "Renamed"}, "ready"),
+    ({"ingest_version": "v2"}, "pending"),
+])
+def test_artifacts_are_rechecked_after_losing_a_write(concurrent_write, status):
+    documents = FakeContainer([{"id": "doc", "title": "Doc", "ingest_version": "v1", "artifacts_status": "pending"}])
+    documents.concurrent_writes.append(concurrent_write)
+    tools = SimpleNamespace(generate_document_artifacts=lambda content, metadata: {"summary": "s"})
+    precomputer = ArtifactPrecomputer(None, tools, max_workers=1, metadata_store=store_with(documents))
+
+    precomputer._precompute("text", {"id": "doc", "ingest_version": "v1"})
+    precomputer.shutdown()
+
+    # A concurrent edit is kept and the artifacts retried; a re-ingest discards them
+    assert documents.items["doc"]["artifacts_status"] == status
+    assert documents.items["doc"]["ingest_version"] == concurrent_write.get("ingest_version", "v1")
+
+
+def test_failed_ingest_does_not_leave_artifacts_pending():
+    documents = FakeContainer()
+    processor = object.__new__(DocumentProcessor)
+    processor.metadata_store = store_with(documents)
+    processor.artifact_precomputer = SimpleNamespace(submit=lambda content, metadata: pytest.fail("submitted"))
+
+    def index_chunks(chunks, metadata):
+        raise RuntimeError("search index unavailable")
+
+    processor._process_and_index_content = index_chunks
+    with pytest.raises(RuntimeError):
+        processor.process_document(text_content="Some text. " * 20)
+
+    assert [item["artifacts_status"] for item in documents.items.values()] == ["failed"]
@@ -0,0 +1,53 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import numpy as np
+
+from async_app import AsyncAzureServices, AsyncDocumentProcessor
+from index2 import Config, DocumentProcessor, chunk_signatures, index_batches
+
+
+def test_index_batches_and_chunk_signatures(monkeypatch):
+    monkeypatch.setattr(Config, "INDEX_BATCH_SIZE", 2)
+    assert index_batches([1, 2, 3, 4, 5]) == [[1, 2], [3, 4], [5]]
+    assert index_batches([]) == []
+    assert chunk_signatures("doc", [7, 9]) == [("doc-chunk-0", 7), ("doc-chunk-1", 9)]
+
+
+def test_close_closes_the_web_client(caplog):
+    services = AsyncAzureServices()
+
+    async def close():
+        services.web_client = httpx.AsyncClient()
+        await services.close()
+
+    asyncio.run(close())
+
+    assert services.web_client.is_closed
+    assert "Error closing" not in caplog.text
+
+
+def test_chunks_are_uploaded_in_index_batches(monkeypatch):
+    monkeypatch.setattr(Config, "INDEX_BATCH_SIZE", 2)
+    monkeypatch.setattr(Config, "DEDUPLICATE_CHUNKS", False)
+    uploads = []
+
+    async def upload_documents(documents):
+        uploads.append([document["id"] for document in documents])
+
+    async def generate_embedding(text):
+        return np.ones(3, dtype=np.float32)
+
+    azure_services = SimpleNamespace(search_client=SimpleNamespace(upload_documents=upload_documents),
+                                     generate_embedding=generate_embedding, index_fields=lambda: None)
+    processor = AsyncDocumentProcessor(azure_services, None, None)
+    chunks = [{"text": f"chunk {i}", "page_start": None, "page_end": None, "char_start": 0, "char_end": 7}
+              for i in range(5)]
+    metadata = DocumentProcessor._build_metadata("doc", "Doc", "text")
+
+    chunk_count, _ = asyncio.run(processor._process_and_index_content(metadata, chunks, [0] * 5))
+
+    assert chunk_count == 5
+    assert sorted(len(batch) for batch in uploads) == [1, 2, 2]
+    assert sorted(chunk_id for batch in uploads for chunk_id in batch) == [f"doc-chunk-{i}" for i in range(5)]
@@ -0,0 +1,131 @@
+import queue
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import bulk_ingest
+from bulk_ingest import BulkIngester, Checkpoint
+from index2 import Config
+
+
+class FakeSearchClient:
+    def __init__(self, reject=()):
+        self.reject = set(reject)
+        self.uploaded = []
+        self.deleted = []
+
+    def upload_documents(self, documents):
+        self.uploaded.extend(document["id"] for document in documents)
+        return [SimpleNamespace(key=document["id"], succeeded=document["content_id"] not in self.reject)
+                for document in documents]
+
+    def delete_documents(self, documents):
+        self.deleted.extend(document["id"] for document in documents)
+
+
+@pytest.fixture
+def ingester_for(monkeypatch):
+    monkeypatch.setattr(Config, "KEYWORD_INDEX", False)
+    monkeypatch.setattr(Config, "DEDUPLICATE_CHUNKS", False)
+
+    def make(search_client, stored=()):
+        azure_services = SimpleNamespace(search_client=search_client, index_fields=lambda: None,
+                                         generate_embeddings=lambda texts: [np.ones(3, dtype=np.float32)
+                                                                            for _ in texts])
+        ingester = BulkIngester(azure_services, Checkpoint(None), extract_workers=1, upload_blobs=False)
+        ingester.metadata_store.bulk_upsert = lambda items: {}
+        stored_by_id = {item["id"]: item for item in stored}
+        ingester.metadata_store.get = stored_by_id.get
+        return ingester
+
+    return make
+
+
+def test_rejected_chunks_keep_their_file_out_of_the_checkpoint(tmp_path, ingester_for):
+    good, bad = tmp_path / "good.txt", tmp_path / "bad.txt"
+    good.write_text("The first document. " * 20)
+    bad.write_text("Another document entirely. " * 20)
+    search_client = FakeSearchClient(reject={bulk_ingest.file_content_id(str(bad))})
+    ingester = ingester_for(search_client)
+
+    report = ingester.run([str(good), str(bad)])
+
+    assert report["files_ingested"] == 1 and report["files_failed"] == 1
+    assert ingester.checkpoint.is_done(str(good))
+    assert not ingester.checkpoint.is_done(str(bad))
+
+
+def test_duplicate_paths_are_ingested_once(tmp_path, ingester_for):
+    path = tmp_path / "doc.txt"
+    path.write_text("Some text to ingest. " * 20)
+    search_client = FakeSearchClient()
+    ingester = ingester_for(search_client)
+
+    report = ingester.run([str(path), str(tmp_path / "." / "doc.txt")])
+
+    assert report["files_total"] == 1 and report["files_ingested"] == 1
+    assert len(search_client.uploaded) == len(set(search_client.uploaded))
+
+
+def test_reingesting_a_shorter_file_deletes_its_extra_chunks(tmp_path, ingester_for):
+    path = tmp_path / "doc.txt"
+    path.write_text("Some text to ingest. " * 20)
+    content_id = bulk_ingest.file_content_id(str(path))
+    previous = {"id": content_id, "created_date": "2024-01-01T00:00:00", "chunk_count": 5,
+                "linked_by": ["other"]}
+    search_client = FakeSearchClient()
+    ingester = ingester_for(search_client, stored=[previous])
+    written, rehomed = [], []
+    ingester.metadata_store.bulk_upsert = lambda items: written.extend(items) or {}
+    ingester.metadata_store.rehome_linked_chunks = rehomed.append
+
+    report = ingester.run([str(path)])
+
+    assert report["files_ingested"] == 1
+    assert rehomed == [previous]
+    chunk_count = written[0]["chunk_count"]
+    assert 0 < chunk_count < 5
+    assert search_client.deleted == [f"{content_id}-chunk-{i}" for i in range(chunk_count, 5)]
+    assert written[0]["created_date"] == "2024-01-01T00:00:00"
+
+
+class BrokenResultsSearchClient(FakeSearchClient):
+    def upload_documents(self, documents):
+        super().upload_documents(documents)
+        return [object() for _ in documents]
+
+
+class FailingVectorStore:
+    def add(self, ids, vectors):
+        raise OSError("disk full")
+
+
+def run_with_timeout(ingester, paths, timeout=30):
+    reports = []
+    thread = threading.Thread(target=lambda: reports.append(ingester.run(paths)), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "bulk ingestion hung"
+    return reports[0]
+
+
+@pytest.mark.parametrize("fault", ["index", "embed"])
+def test_stage_errors_fail_files_instead_of_hanging(tmp_path, ingester_for, fault):
+    paths = []
+    for i in range(12):
+        path = tmp_path / f"doc{i}.txt"
+        path.write_text(f"Document number {i} has its own text. " * 60)
+        paths.append(str(path))
+    ingester = ingester_for(BrokenResultsSearchClient() if fault == "index" else FakeSearchClient())
+    if fault == "embed":
+        ingester.vector_store = FailingVectorStore()
+    # Small queues fill up quickly once a stage stops consuming
+    ingester.chunk_queue = queue.Queue(maxsize=2)
+    ingester.document_queue = queue.Queue(maxsize=2)
+
+    report = run_with_timeout(ingester, paths)
+
+    assert report["files_failed"] == len(paths) and report["files_ingested"] == 0
+    assert not any(ingester.checkpoint.is_done(path) for path in paths)
@@ -0,0 +1,87 @@
+from types import SimpleNamespace
+
+from index2 import (
+    AzureServices,
+    Config,
+    SEARCH_RESULT_FIELDS,
+    chunk_text,
+    count_tokens,
+    fields_in_index,
+    fit_to_index,
+)
+
+
+def paragraphs(count, sentences=12):
+    return "\n\n".join(
+        " ".join(f"Paragraph {p} sentence {s} talks about topic number {p * 100 + s}." for s in range(sentences))
+        for p in range(count)
+    )
+
+
+def test_chunks_respect_token_limits_and_cover_the_text():
+    text = paragraphs(30)
+    chunks = chunk_text(text)
+
+    assert len(chunks) > 1
+    assert all(count_tokens(chunk["text"]) <= Config.CHUNK_TARGET_TOKENS + Config.CHUNK_MAX_TOKENS
+               for chunk in chunks)
+    assert chunks[0]["char_start"] == 0
+    assert chunks[-1]["char_end"] == len(text.rstrip())
+    # Chunks advance through the text, overlapping by at most a few sentences
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert previous["char_start"] < chunk["char_start"] <= previous["char_end"] + 2
+
+
+def test_chunks_end_on_sentence_boundaries():
+    for chunk in chunk_text(paragraphs(20)):
+        assert chunk["text"].endswith(".")
+        assert chunk["text"] == " ".join(chunk["text"].split())
+
+
+def test_overlong_sentences_are_split():
+    sentence = " ".join(f"word{i}" for i in range(Config.CHUNK_MAX_TOKENS * 3))
+    chunks = chunk_text(sentence + ".")
+    assert len(chunks) >= 3
+    assert all(count_tokens(chunk["text"]) <= Config.CHUNK_TARGET_TOKENS + Config.CHUNK_MAX_TOKENS
+               for chunk in chunks)
+
+
+def test_page_provenance():
+    first, second = paragraphs(8), paragraphs(8)
+    text = first + "\n\n" + second
+    chunks = chunk_text(text, page_spans=[(0, 1), (len(first) + 2, 2)])
+
+    assert chunks[0]["page_start"] == 1
+    assert chunks[-1]["page_end"] == 2
+    for chunk in chunks:
+        assert chunk["page_start"] <= chunk["page_end"]
+    assert all(chunk["page_start"] is None for chunk in chunk_text(first))
+
+
+def test_empty_text_has_no_chunks():
+    assert chunk_text("") == []
+    assert chunk_text("   \n\n  ") == []
+
+
+def test_select_and_upload_only_fields_the_index_has():
+    old_index = frozenset(["id", "content_id", "title", "content", "source_type", "url", "uploaded_date",
+                           "chunk_id", "content_vector"])
+    assert fields_in_index(SEARCH_RESULT_FIELDS, old_index) == [
+        "id", "content_id", "title", "content", "source_type", "url", "uploaded_date"]
+    assert fields_in_index(SEARCH_RESULT_FIELDS, None) == SEARCH_RESULT_FIELDS
+
+    document = {"id": "a-chunk-0", "content": "text", "page_start": 1, "simhash_b0": "ffff"}
+    assert fit_to_index([document], old_index) == [{"id": "a-chunk-0", "content": "text"}]
+    assert fit_to_index([document], None) == [document]
+
+
+def test_index_fields_are_read_once():
+    reads = []
+    services = object.__new__(AzureServices)
+    services._index_fields = None
+    services.search_index_client = SimpleNamespace(
+        get_index=lambda name: reads.append(name) or SimpleNamespace(fields=[SimpleNamespace(name="id")]))
+
+    assert services.index_fields() == {"id"}
+    assert services.index_fields() == {"id"}
+    assert len(reads) == 1
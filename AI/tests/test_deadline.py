@@ -0,0 +1,93 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+from index2 import (
+    Config,
+    Deadline,
+    KnowledgeRetriever,
+    LatencyTracker,
+    RequestError,
+    SingleFlight,
+    create_app,
+    parse_ask_request,
+)
+
+
+def test_budget_leaves_the_reserve_and_respects_the_cap():
+    deadline = Deadline(10)
+    assert 9 < deadline.remaining() <= 10
+    assert deadline.budget(cap=2) == 2
+    assert 3 < deadline.budget(reserve=6) <= 4
+    assert deadline.budget(reserve=20) == 0.0
+
+
+def test_expired_deadline_has_no_time_left():
+    deadline = Deadline(0.01)
+    time.sleep(0.02)
+    assert deadline.remaining() == 0.0
+    assert deadline.budget() == 0.0
+
+
+def test_bucket_groups_requested_lengths():
+    assert Deadline(0.3).bucket() == Deadline(0.9).bucket() == 1
+    assert Deadline(1.5).bucket() == 2
+    assert Deadline(Config.ASK_DEADLINE_SECONDS).bucket() != Deadline(1).bucket()
+
+
+def test_answers_for_different_deadlines_are_not_shared():
+    retriever = object.__new__(KnowledgeRetriever)
+    retriever.single_flight = SingleFlight("test")
+    keys = []
+    retriever.single_flight.do = lambda kind, text, params, func: keys.append(
+        retriever.single_flight.make_key(kind, text, params))
+
+    retriever.get_answer("q")
+    retriever.get_answer("q", deadline=Deadline(Config.ASK_DEADLINE_SECONDS))
+    retriever.get_answer("q", deadline=Deadline(0.5))
+
+    assert keys[0] == keys[1]
+    assert keys[0] != keys[2]
+
+
+def test_client_deadline_is_capped():
+    _, _, deadline = parse_ask_request({"query": "q", "deadline_ms": 10 ** 9})
+    assert deadline.seconds == Config.MAX_DEADLINE_SECONDS
+    _, _, deadline = parse_ask_request({"query": "q", "deadline_ms": "1500"})
+    assert deadline.seconds == 1.5
+
+
+@pytest.mark.parametrize("deadline_ms", ["soon", -5, 0, True, [100], "nan"])
+def test_invalid_client_deadlines_are_rejected(deadline_ms):
+    with pytest.raises(RequestError):
+        parse_ask_request({"query": "q", "deadline_ms": deadline_ms})
+
+
+def test_invalid_deadline_gets_400():
+    response = create_app().test_client().post("/api/ask", json={"query": "q", "deadline_ms": "soon"})
+    assert response.status_code == 400
+
+
+def test_query_embedding_call_is_bounded_by_its_stage_budget():
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs)
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[1.0, 0.0, 0.0])])
+
+    retriever = object.__new__(KnowledgeRetriever)
+    retriever.keyword_index = None
+    retriever.latencies = {stage: LatencyTracker() for stage in ("embedding", "search", "generation")}
+    retriever._stage_executor = ThreadPoolExecutor(max_workers=2)
+    retriever.azure_services = SimpleNamespace(
+        openai_client=SimpleNamespace(embeddings=SimpleNamespace(create=create)))
+    retriever._execute_search = lambda query, query_embedding, top_k, filter_criteria, timeout: []
+
+    try:
+        retriever._get_answer("q", 5, None, Deadline(10))
+    finally:
+        retriever._stage_executor.shutdown()
+
+    assert 0 < calls[0]["timeout"] <= Config.EMBEDDING_TIMEOUT
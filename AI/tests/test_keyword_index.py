@@ -0,0 +1,223 @@
+import sqlite3
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from index2 import (
+    BM25Index,
+    Config,
+    KnowledgeRetriever,
+    MetadataStore,
+    add_to_keyword_index,
+    all_indexed_chunks,
+    is_exact_term_query,
+    reciprocal_rank_fusion,
+)
+
+
+def chunk(chunk_id, content, source_type="text", uploaded_date="2026-01-01T00:00:00Z"):
+    return {"id": chunk_id, "content_id": chunk_id.split("_")[0], "title": f"Title {chunk_id}",
+            "content": content, "source_type": source_type, "url": None, "uploaded_date": uploaded_date}
+
+
+CHUNKS = [
+    chunk("a_0", "The retry loop raised ERR_1042 after the connection pool was exhausted."),
+    chunk("b_0", "Connection pools are sized per worker; the pool grows on demand.", source_type="web"),
+    chunk("c_0", "Gardening tips: water tomatoes in the morning.", uploaded_date="2026-03-01T00:00:00Z"),
+    chunk("d_0", "Pool pool pool: the word pool appears here many times, pool."),
+]
+
+
+@pytest.fixture
+def index():
+    keyword_index = BM25Index()
+    keyword_index.add(CHUNKS)
+    yield keyword_index
+    keyword_index.close()
+
+
+def ids(results):
+    return [result["id"] for result in results]
+
+
+def test_search_ranks_by_bm25_and_returns_result_fields(index):
+    results = index.search("pool", top_k=3)
+    assert ids(results)[0] == "d_0"
+    assert set(ids(results)) == {"a_0", "b_0", "d_0"}
+    assert results[0]["title"] == "Title d_0"
+    assert index.search("tomatoes")[0]["content"] == CHUNKS[2]["content"]
+    assert index.search("the of and") == []
+
+
+def test_require_all_and_phrases(index):
+    assert ids(index.search("err_1042 pool", require_all=True)) == ["a_0"]
+    assert set(ids(index.search("err_1042 tomatoes"))) == {"a_0", "c_0"}
+    assert index.search("err_1042 tomatoes", require_all=True) == []
+    assert ids(index.search('"connection pool was exhausted"')) == ["a_0"]
+    assert index.search('"pool connection"') == []
+
+
+def test_search_applies_request_filters(index):
+    assert ids(index.search("pool", filter_criteria={"source_type": "web"})) == ["b_0"]
+    march = {"date_from": "2026-02-01T00:00:00Z", "date_to": "2026-04-01T00:00:00Z"}
+    assert ids(index.search("tomatoes pool", filter_criteria=march)) == ["c_0"]
+
+
+def test_add_replaces_and_remove_deletes(index):
+    index.add([chunk("a_0", "Rewritten chunk about tomatoes.")])
+    assert len(index) == 4
+    assert "a_0" not in ids(index.search("err_1042"))
+    assert "a_0" in ids(index.search("tomatoes"))
+    index.remove(["a_0", "c_0", "missing"])
+    assert len(index) == 2
+    assert index.search("tomatoes") == []
+
+
+def test_rebuild_replaces_everything_and_keeps_old_index_on_failure(index):
+    assert index.rebuild([chunk("e_0", "Fresh corpus")]) == 1
+    assert ids(index.search("fresh")) == ["e_0"]
+    assert index.search("pool") == []
+
+    def failing():
+        yield chunk("f_0", "Partial corpus")
+        raise RuntimeError("search service unavailable")
+
+    with pytest.raises(RuntimeError):
+        index.rebuild(failing())
+    assert ids(index.search("fresh")) == ["e_0"]
+    assert index.search("partial") == []
+
+
+def test_database_is_shared_between_instances_and_threads(tmp_path):
+    path = str(tmp_path / "data" / "keyword_index.db")
+    writer, reader = BM25Index(path), BM25Index(path)
+    assert reader.is_empty()
+    writer.add(CHUNKS[:2])
+    assert not reader.is_empty()
+    assert ids(reader.search("err_1042")) == ["a_0"]
+
+    threads = [threading.Thread(target=writer.add, args=([chunk(f"t{i}_0", f"thread{i} chunk")],))
+               for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(reader) == 6
+    writer.remove(["a_0"])
+    assert reader.search("err_1042") == []
+    writer.close()
+    reader.close()
+
+
+class FakeSearchClient:
+    """Serves search index pages the way all_indexed_chunks requests them"""
+    def __init__(self, documents):
+        self.documents = sorted(documents, key=lambda document: document["uploaded_date"])
+        self.calls = []
+
+    def search(self, search_text, select, order_by, filter, top, skip):
+        self.calls.append({"filter": filter, "skip": skip})
+        documents = self.documents
+        if filter:
+            since = filter.split(" ge ")[1]
+            documents = [document for document in documents if document["uploaded_date"] >= since]
+        return [{field: document[field] for field in select} for document in documents[skip or 0:][:top]]
+
+
+def test_all_indexed_chunks_pages_by_upload_date():
+    # Three chunks per date, so pages end part way through a date
+    documents = [chunk(f"doc{day}_{i}", f"chunk {i}", uploaded_date=f"2026-01-{day:02d}T00:00:00Z")
+                 for day in range(1, 11) for i in range(3)]
+    client = FakeSearchClient(documents)
+    found = list(all_indexed_chunks(client, ["id", "content"], page_size=4))
+    assert sorted(document["id"] for document in found) == sorted(document["id"] for document in documents)
+    assert len(found) == len(documents)
+    assert set(found[0]) == {"id", "content", "uploaded_date"}
+    assert max(call["skip"] or 0 for call in client.calls) < 4
+
+
+def test_all_indexed_chunks_steps_over_a_date_larger_than_a_page():
+    documents = [chunk(f"doc_{i}", "same day") for i in range(10)] + \
+                [chunk("late_0", "later", uploaded_date="2026-02-01T00:00:00Z")]
+    found = list(all_indexed_chunks(FakeSearchClient(documents), ["id"], page_size=3))
+    assert sorted(document["id"] for document in found) == sorted(document["id"] for document in documents)
+
+
+def test_reciprocal_rank_fusion_orders_by_weighted_reciprocal_rank():
+    a, b, c = {"id": "a"}, {"id": "b"}, {"id": "c"}
+    # b is second in both lists and beats a and c, which each appear once
+    assert ids(reciprocal_rank_fusion([[a, b], [c, b]], [1.0, 1.0], k=60)) == ["b", "a", "c"]
+    # A heavier second list puts its first result ahead
+    assert ids(reciprocal_rank_fusion([[a, b], [c, b]], [1.0, 3.0], k=60))[:2] == ["b", "c"]
+    assert ids(reciprocal_rank_fusion([[a], [c]], [1.0, 2.0], k=60)) == ["c", "a"]
+    assert reciprocal_rank_fusion([[], []], [1.0, 1.0]) == []
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("What is COVID", False),
+    ("World War 2", False),
+    ("python 3 features", False),
+    ("how do connection pools work", False),
+    ("ERR_1042", True),
+    ("E1234 timeout", True),
+    ("sha256 digest", True),
+    ("max_pool_size", True),
+    ('"connection pool was exhausted"', True),
+    ("E1234 in a very long natural language question", False),
+])
+def test_is_exact_term_query(query, expected):
+    assert is_exact_term_query(query) is expected
+
+
+def test_fast_path_requires_every_term(index, monkeypatch):
+    monkeypatch.setattr(Config, "KEYWORD_FAST_PATH", True)
+    assert ids(KnowledgeRetriever._keyword_fast_path(index, "ERR_1042", 5, None)) == ["a_0"]
+    assert KnowledgeRetriever._keyword_fast_path(index, "ERR_1042 tomatoes", 5, None) is None
+    assert KnowledgeRetriever._keyword_fast_path(index, "What is COVID", 5, None) is None
+
+
+class RecordingSearchClient:
+    def __init__(self, results):
+        self.results = results
+        self.kwargs = None
+
+    def search(self, **kwargs):
+        self.kwargs = kwargs
+        return list(self.results)
+
+
+def test_search_keeps_the_search_index_text_query_alongside_the_keyword_index(monkeypatch):
+    monkeypatch.setattr(Config, "DEDUPLICATE_CHUNKS", False)
+    # The local index is stale: it has never seen the chunk the search index finds by text
+    stale_index = BM25Index()
+    stale_index.add(CHUNKS[:1])
+    client = RecordingSearchClient([chunk("z_0", "Indexed before the keyword index existed: ERR_1042")])
+    azure_services = type("FakeAzureServices", (), {"search_client": client, "index_fields": lambda self: None})()
+    retriever = KnowledgeRetriever(azure_services, keyword_index=stale_index)
+    try:
+        results = retriever._execute_search("ERR_1042 retry", None, 5, None)
+    finally:
+        retriever.close()
+        stale_index.close()
+    assert client.kwargs["search_text"] == "ERR_1042 retry"
+    assert set(ids(results)) == {"a_0", "z_0"}
+
+
+class LockedIndex:
+    def add(self, chunk_documents):
+        raise sqlite3.OperationalError("database is locked")
+
+    def remove(self, chunk_ids):
+        raise sqlite3.OperationalError("database is locked")
+
+
+def test_keyword_index_writes_are_best_effort():
+    add_to_keyword_index(LockedIndex(), CHUNKS)
+    add_to_keyword_index(None, CHUNKS)
+
+    deleted = []
+    search_client = SimpleNamespace(delete_documents=lambda documents: deleted.extend(documents))
+    store = MetadataStore(SimpleNamespace(search_client=search_client), LockedIndex())
+    assert store.delete_chunk_ids(["a_0", "b_0"]) == 2
+    assert [document["id"] for document in deleted] == ["a_0", "b_0"]
@@ -0,0 +1,131 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+
+from bulk_ingest import BulkIngester, Checkpoint
+from index2 import (
+    Config,
+    DocumentProcessor,
+    MetadataStore,
+    RequestError,
+    create_app,
+    parse_list_request,
+)
+
+
+class FakeSearchClient:
+    def __init__(self, chunk_ids, filterable=True):
+        self.chunk_ids = set(chunk_ids)
+        self.filterable = filterable
+        self.deleted = []
+
+    def search(self, search_text, filter, select):
+        if not self.filterable:
+            raise HttpResponseError("Invalid expression: content_id is not a filterable field")
+        content_id = filter.split("'")[1]
+        return [{"id": chunk_id} for chunk_id in sorted(self.chunk_ids) if chunk_id.startswith(content_id)]
+
+    def get_document(self, key, selected_fields=None):
+        if key not in self.chunk_ids:
+            raise ResourceNotFoundError("missing")
+        return {"id": key}
+
+    def delete_documents(self, documents):
+        self.deleted.extend(document["id"] for document in documents)
+
+
+class FakeContainer:
+    def __init__(self, items=()):
+        self.items = {item["id"]: item for item in items}
+
+    def read_item(self, item, partition_key):
+        if item not in self.items:
+            raise CosmosResourceNotFoundError(status_code=404, message="missing")
+        return self.items[item]
+
+    def query_items(self, query, parameters, **kwargs):
+        return []
+
+    def upsert_item(self, body):
+        self.items[body["id"]] = dict(body)
+
+    create_item = upsert_item
+
+    def replace_item(self, item, body, etag=None, match_condition=None):
+        self.upsert_item(body)
+
+    def delete_item(self, item, partition_key):
+        self.items.pop(item, None)
+
+
+def services_with(search_client, items):
+    documents = FakeContainer(items)
+    return SimpleNamespace(search_client=search_client, get_metadata_container=lambda: documents,
+                           get_catalog_container=lambda: FakeContainer(), index_fields=lambda: None)
+
+
+@pytest.mark.parametrize("filterable", [True, False])
+def test_delete_without_chunk_count_finds_the_chunks(filterable):
+    search_client = FakeSearchClient(["doc-chunk-0", "doc-chunk-1", "doc-chunk-2", "other-chunk-0"], filterable)
+    legacy = {"id": "doc", "title": "Doc", "source_type": "web"}
+
+    assert MetadataStore(services_with(search_client, [legacy])).delete("doc")
+    assert sorted(search_client.deleted) == ["doc-chunk-0", "doc-chunk-1", "doc-chunk-2"]
+
+
+def test_chunk_count_is_recorded_before_chunks_are_indexed():
+    search_client = FakeSearchClient([])
+    store = MetadataStore(services_with(search_client, []))
+    processor = object.__new__(DocumentProcessor)
+    processor.metadata_store = store
+    processor.artifact_precomputer = None
+    recorded = []
+
+    def index_chunks(chunks, metadata):
+        # An ingest that stops here has already recorded how many chunks to delete
+        recorded.append(store.get(metadata["id"])["chunk_count"])
+        return len(chunks), {}
+
+    processor._process_and_index_content = index_chunks
+    result = processor.process_document(text_content="A sentence about something. " * 400)
+
+    assert recorded[0] > 1
+    assert recorded[0] == store.get(result["content_id"])["chunk_count"]
+
+
+@pytest.mark.parametrize("limit", ["abc", "0", "-3", "1.5"])
+def test_invalid_list_limits_are_rejected(limit):
+    with pytest.raises(RequestError):
+        parse_list_request({"limit": limit})
+
+
+def test_invalid_list_limit_gets_400():
+    assert create_app().test_client().get("/api/documents?limit=abc").status_code == 400
+
+
+def test_concurrent_finalization_counts_every_file(monkeypatch):
+    monkeypatch.setattr(Config, "KEYWORD_INDEX", False)
+    monkeypatch.setattr(Config, "DEDUPLICATE_CHUNKS", False)
+    monkeypatch.setattr(Config, "METADATA_BATCH_SIZE", 7)
+    ingester = BulkIngester(SimpleNamespace(), Checkpoint(None), upload_blobs=False)
+    written = []
+    ingester.metadata_store.bulk_upsert = lambda items: written.extend(items) or {}
+    ingester.checkpoint.mark_done = lambda path, content_id, chunk_count: None
+    ingester.file_bar = SimpleNamespace(update=lambda count: None)
+
+    def finalize(worker):
+        for i in range(500):
+            ingester._finalize_file(f"{worker}-{i}", {"id": f"{worker}-{i}"}, 1)
+
+    threads = [threading.Thread(target=finalize, args=(worker,)) for worker in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    ingester._flush_metadata()
+
+    assert ingester.files_done == 2000
+    assert len({item["id"] for item in written}) == 2000
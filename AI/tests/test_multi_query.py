@@ -0,0 +1,178 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from async_app import AsyncKnowledgeRetriever, AsyncLearningTools
+from index2 import Config, Deadline, KnowledgeRetriever, LearningTools, expand_topic
+
+
+@pytest.fixture(autouse=True)
+def facets(monkeypatch):
+    monkeypatch.setattr(Config, "MULTI_QUERY_FACETS", ["examples"])
+    monkeypatch.setattr(Config, "MULTI_QUERY_COUNT", 5)
+    monkeypatch.setattr(Config, "DEDUPLICATE_CHUNKS", False)
+    monkeypatch.setattr(Config, "KEYWORD_FAST_PATH", False)
+
+
+@pytest.mark.parametrize("topic, parts", [
+    ("Pride and Prejudice", []),
+    ("Paris, France", []),
+    ("Python vs Java", []),
+    ("World War 2", []),
+    ("machine learning, deep learning", ["machine learning", "deep learning"]),
+    ("supervised learning, unsupervised learning, and reinforcement learning",
+     ["supervised learning", "unsupervised learning", "reinforcement learning"]),
+    ("static typing versus dynamic typing", ["static typing", "dynamic typing"]),
+    ("cell biology; organic chemistry", ["cell biology", "organic chemistry"]),
+])
+def test_expand_topic_splits_only_explicit_multi_word_lists(topic, parts):
+    assert expand_topic(topic) == [topic] + parts + [f"{topic} examples"]
+
+
+def test_expand_topic_dedupes_and_caps():
+    assert expand_topic("  Pride   and Prejudice ") == ["Pride and Prejudice", "Pride and Prejudice examples"]
+    assert len(expand_topic("a b, c d, e f, g h, i j", max_queries=3)) == 3
+
+
+def result(chunk_id):
+    return {"id": chunk_id, "content": chunk_id}
+
+
+class RecordingRetriever:
+    def __init__(self):
+        self.calls = []
+
+    def multi_query_search(self, queries, top_k):
+        self.calls.append(("multi", queries, top_k))
+        return []
+
+    def search_knowledge_base(self, query, top_k):
+        self.calls.append(("single", query, top_k))
+        return []
+
+
+@pytest.mark.parametrize("multi_query, expected", [(True, ("multi", ["topic", "topic examples"], 6)),
+                                                   (False, ("single", "topic", 3))])
+def test_retrieve_scales_the_requested_top_k(monkeypatch, multi_query, expected):
+    monkeypatch.setattr(Config, "MULTI_QUERY_RETRIEVAL", multi_query)
+    monkeypatch.setattr(Config, "MULTI_QUERY_TOP_K_FACTOR", 2)
+    retriever = RecordingRetriever()
+    LearningTools(None, retriever)._retrieve("topic", top_k=3)
+    assert retriever.calls == [expected]
+
+
+def test_async_retrieve_scales_the_requested_top_k(monkeypatch):
+    monkeypatch.setattr(Config, "MULTI_QUERY_RETRIEVAL", True)
+    monkeypatch.setattr(Config, "MULTI_QUERY_TOP_K_FACTOR", 2)
+    calls = []
+
+    class Retriever:
+        async def multi_query_search(self, queries, top_k):
+            calls.append(top_k)
+            return []
+
+    asyncio.run(AsyncLearningTools(None, Retriever())._retrieve("topic", top_k=5))
+    assert calls == [10]
+
+
+def fake_services():
+    return SimpleNamespace(generate_embeddings=lambda texts, timeout=None: [np.ones(3, dtype=np.float32)
+                                                                           for _ in texts])
+
+
+def test_multi_query_search_drops_sub_queries_past_the_deadline():
+    retriever = KnowledgeRetriever(fake_services())
+
+    def execute_search(query, embedding, top_k, filter_criteria, timeout=None):
+        if query == "slow":
+            time.sleep(2)
+        return [result(query)]
+
+    retriever._execute_search = execute_search
+    try:
+        started = time.monotonic()
+        results = retriever.multi_query_search(["fast", "slow", "also fast"], 5, deadline=Deadline(0.3))
+        elapsed = time.monotonic() - started
+    finally:
+        retriever.close()
+    assert elapsed < 1.5
+    assert [item["id"] for item in results] == ["fast", "also fast"]
+
+
+def test_async_multi_query_search_drops_sub_queries_past_the_deadline():
+    async def generate_embeddings(texts):
+        return [np.ones(3, dtype=np.float32) for _ in texts]
+
+    retriever = AsyncKnowledgeRetriever(SimpleNamespace(generate_embeddings=generate_embeddings))
+
+    async def execute_search(query, embedding, top_k, filter_criteria):
+        if query == "slow":
+            await asyncio.sleep(2)
+        return [result(query)]
+
+    retriever._execute_search = execute_search
+
+    async def run():
+        started = time.monotonic()
+        results = await retriever.multi_query_search(["fast", "slow"], 5, deadline=Deadline(0.3))
+        return results, time.monotonic() - started
+
+    results, elapsed = asyncio.run(run())
+    assert elapsed < 1.5
+    assert [item["id"] for item in results] == ["fast"]
+
+
+def test_multi_query_search_falls_back_to_keywords_when_embedding_is_slow():
+    timeouts = []
+
+    def generate_embeddings(texts, timeout=None):
+        timeouts.append(timeout)
+        time.sleep(3)
+        return [np.ones(3, dtype=np.float32) for _ in texts]
+
+    retriever = KnowledgeRetriever(SimpleNamespace(generate_embeddings=generate_embeddings))
+    searched = []
+
+    def execute_search(query, embedding, top_k, filter_criteria, timeout=None):
+        searched.append(embedding)
+        return [result(query)]
+
+    retriever._execute_search = execute_search
+    try:
+        started = time.monotonic()
+        results = retriever.multi_query_search(["a", "b"], 5, deadline=Deadline(5))
+        elapsed = time.monotonic() - started
+    finally:
+        retriever.close()
+    assert elapsed < Config.EMBEDDING_TIMEOUT + 1
+    assert 0 < timeouts[0] <= Config.EMBEDDING_TIMEOUT
+    assert searched == [None, None]
+    assert [item["id"] for item in results] == ["a", "b"]
+
+
+def test_async_multi_query_search_falls_back_to_keywords_when_embedding_is_slow():
+    async def generate_embeddings(texts):
+        await asyncio.sleep(3)
+        return [np.ones(3, dtype=np.float32) for _ in texts]
+
+    retriever = AsyncKnowledgeRetriever(SimpleNamespace(generate_embeddings=generate_embeddings))
+    searched = []
+
+    async def execute_search(query, embedding, top_k, filter_criteria):
+        searched.append(embedding)
+        return [result(query)]
+
+    retriever._execute_search = execute_search
+
+    async def run():
+        started = time.monotonic()
+        results = await retriever.multi_query_search(["a", "b"], 5, deadline=Deadline(5))
+        return results, time.monotonic() - started
+
+    results, elapsed = asyncio.run(run())
+    assert elapsed < Config.EMBEDDING_TIMEOUT + 1
+    assert searched == [None, None]
+    assert [item["id"] for item in results] == ["a", "b"]
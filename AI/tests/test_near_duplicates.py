@@ -0,0 +1,235 @@
+import copy
+from types import SimpleNamespace
+
+from azure.core.exceptions import ResourceNotFoundError
+from azure.cosmos.exceptions import (
+    CosmosAccessConditionFailedError,
+    CosmosResourceExistsError,
+    CosmosResourceNotFoundError,
+)
+
+from index2 import (
+    AzureServices,
+    Config,
+    DocumentProcessor,
+    MetadataStore,
+    NearDuplicateDetector,
+    compute_simhash,
+    duplicate_sources,
+    hamming_distance,
+    simhash_bands,
+)
+
+TEXT = ("Retrieval augmented generation combines a search step with a language model so that "
+        "answers are grounded in documents the user has uploaded to the knowledge base.")
+
+
+def test_simhash_is_stable_and_locality_sensitive():
+    assert compute_simhash(TEXT) == compute_simhash(TEXT)
+    # Case and punctuation do not change the shingles
+    assert compute_simhash(TEXT.upper().replace(".", "!")) == compute_simhash(TEXT)
+    edited = TEXT.replace("uploaded", "added")
+    unrelated = "The quarterly budget review covers travel, equipment and training expenses for every team."
+    assert hamming_distance(compute_simhash(TEXT), compute_simhash(edited)) < \
+        hamming_distance(compute_simhash(TEXT), compute_simhash(unrelated))
+    assert hamming_distance(compute_simhash(TEXT), compute_simhash(unrelated)) > Config.NEAR_DUPLICATE_MAX_DISTANCE
+
+
+def test_bands_cover_the_signature():
+    signature = compute_simhash(TEXT)
+    bands = simhash_bands(signature)
+    assert len(bands) == Config.SIMHASH_BANDS
+    assert int("".join(reversed(bands)), 16) == signature
+    # Signatures within the distance threshold always share a band
+    flipped = signature ^ 0b1 ^ (1 << 20) ^ (1 << 40)
+    assert any(a == b for a, b in zip(bands, simhash_bands(flipped)))
+
+
+def test_match_links_to_other_documents_and_earlier_chunks():
+    signature = compute_simhash(TEXT)
+    other = compute_simhash("Something else entirely, about gardening and the seasons of the year.")
+    candidates = [("old-chunk-0", signature), ("doc-chunk-5", other)]
+    signatures = [("doc-chunk-0", signature), ("doc-chunk-1", other), ("doc-chunk-2", other)]
+
+    matches = NearDuplicateDetector.match("doc", signatures, candidates)
+
+    # The document's own indexed chunk is ignored; its later copy links to the earlier one in the batch
+    assert matches == ["old-chunk-0", None, "doc-chunk-1"]
+
+
+def test_candidate_filter_queries_every_band():
+    query = NearDuplicateDetector.build_candidate_filter([compute_simhash(TEXT)])
+    assert all(f"simhash_b{band}" in query for band in range(Config.SIMHASH_BANDS))
+
+
+def test_duplicate_sources():
+    assert duplicate_sources({"0": "a-chunk-1", "3": "b-c-chunk-0", "4": "a-chunk-2"}) == ["a", "b-c"]
+    assert duplicate_sources(None) == []
+
+
+class FakeContainer:
+    """Point operations only, with an _etag per item; any query fails the test"""
+    def __init__(self, items=()):
+        self.items = {}
+        self.writes = 0
+        for item in items:
+            self.upsert_item(item)
+
+    def _store(self, body):
+        self.writes += 1
+        self.items[body["id"]] = dict(body, _etag=str(self.writes))
+        return copy.deepcopy(self.items[body["id"]])
+
+    def read_item(self, item, partition_key):
+        if item not in self.items:
+            raise CosmosResourceNotFoundError(status_code=404, message="missing")
+        return copy.deepcopy(self.items[item])
+
+    def create_item(self, body):
+        if body["id"] in self.items:
+            raise CosmosResourceExistsError(status_code=409, message="exists")
+        return self._store(body)
+
+    def replace_item(self, item, body, etag=None, match_condition=None):
+        if item not in self.items:
+            raise CosmosResourceNotFoundError(status_code=404, message="missing")
+        if etag is not None and etag != self.items[item]["_etag"]:
+            raise CosmosAccessConditionFailedError(status_code=412, message="modified")
+        return self._store(body)
+
+    def upsert_item(self, body):
+        return self._store(body)
+
+    def execute_item_batch(self, batch_operations, partition_key):
+        for _, (body,) in batch_operations:
+            self._store(body)
+
+    def delete_item(self, item, partition_key):
+        self.items.pop(item, None)
+
+
+class FakeSearchClient:
+    def __init__(self, documents):
+        self.documents = {document["id"]: document for document in documents}
+        self.events = []
+
+    def get_document(self, key):
+        if key not in self.documents:
+            raise ResourceNotFoundError("missing")
+        return dict(self.documents[key], **{"@search.score": 1.0})
+
+    def upload_documents(self, documents):
+        self.events.append(("upload", [document["id"] for document in documents]))
+        self.documents.update({document["id"]: document for document in documents})
+
+    def delete_documents(self, documents):
+        self.events.append(("delete", [document["id"] for document in documents]))
+        for document in documents:
+            self.documents.pop(document["id"], None)
+
+
+def metadata(content_id, duplicate_chunks=None, chunk_count=2):
+    return {"id": content_id, "title": content_id.title(), "source_type": "web", "url": None,
+            "created_date": "2024-01-01T00:00:00", "chunk_count": chunk_count,
+            "duplicate_chunks": duplicate_chunks or {}}
+
+
+def store_with(search_client, documents):
+    services = SimpleNamespace(search_client=search_client, get_metadata_container=lambda: documents,
+                               get_catalog_container=lambda: FakeContainer(), index_fields=lambda: None)
+    return MetadataStore(services)
+
+
+def test_delete_moves_linked_chunks_into_the_linking_document():
+    chunks = [{"id": f"a-chunk-{i}", "content_id": "a", "title": "A", "content": f"text {i}"} for i in range(2)]
+    search_client = FakeSearchClient(chunks)
+    documents = FakeContainer()
+    store = store_with(search_client, documents)
+    for item in [metadata("a"), metadata("b", {"1": "a-chunk-0"}), metadata("c")]:
+        store.upsert(item)
+    assert documents.items["a"]["linked_by"] == ["b"]
+
+    # Found from a's linked_by with point reads; FakeContainer has no query_items
+    assert store.delete("a")
+
+    # The linked chunk was copied before a's chunks were deleted
+    assert search_client.events[0] == ("upload", ["b-chunk-1"])
+    assert search_client.events[1] == ("delete", ["a-chunk-0", "a-chunk-1"])
+    moved = search_client.documents["b-chunk-1"]
+    assert moved["content_id"] == "b" and moved["title"] == "B" and moved["content"] == "text 0"
+    assert "@search.score" not in moved
+    assert documents.items["b"]["duplicate_chunks"] == {} and documents.items["b"]["duplicate_of"] == []
+    assert "a" not in documents.items
+
+
+def test_provisioning_adds_missing_index_fields():
+    index = SimpleNamespace(fields=[SimpleNamespace(name="id"), SimpleNamespace(name="content")])
+    updated = []
+    services = object.__new__(AzureServices)
+    services.search_index_client = SimpleNamespace(get_index=lambda name: index,
+                                                   create_or_update_index=updated.append)
+
+    services._update_search_index()
+
+    added = {field.name for field in updated[0].fields} - {"id", "content"}
+    assert {"simhash", "simhash_b0", "page_start", "char_end", "content_vector"} <= added
+
+
+def test_writing_a_document_keeps_the_links_to_it():
+    documents = FakeContainer()
+    store = store_with(FakeSearchClient([]), documents)
+    store.upsert(metadata("a"))
+    store.upsert(metadata("b", {"0": "a-chunk-1"}))
+
+    # A re-ingested a is written without linked_by, while c links to it concurrently
+    replace_item = documents.replace_item
+
+    def replace_after_c_links(item, body, etag=None, match_condition=None):
+        if item == "a" and "c" not in documents.items["a"]["linked_by"]:
+            documents.upsert_item(dict(documents.items["a"], linked_by=["b", "c"]))
+        return replace_item(item, body, etag, match_condition)
+
+    documents.replace_item = replace_after_c_links
+    store.upsert(metadata("a", chunk_count=3))
+
+    assert documents.items["a"]["chunk_count"] == 3
+    assert documents.items["a"]["linked_by"] == ["b", "c"]
+
+
+def test_bulk_upsert_records_links_within_the_batch_and_returns_the_rest():
+    documents = FakeContainer()
+    store = store_with(FakeSearchClient([]), documents)
+    store.upsert(metadata("a"))
+
+    missing = store.bulk_upsert([metadata("b", {"0": "a-chunk-0", "1": "c-chunk-0", "2": "later-chunk-0"}),
+                                 metadata("c")])
+
+    assert missing == {"later": ["b"]}
+    assert documents.items["a"]["linked_by"] == ["b"]
+    assert documents.items["c"]["linked_by"] == ["b"]
+    assert documents.items["b"]["links_recorded"] is False
+    assert documents.items["c"]["links_recorded"] is True
+
+
+def test_reingest_moves_linked_chunks_before_overwriting_them():
+    chunks = [{"id": f"a-chunk-{i}", "content_id": "a", "title": "A", "content": f"old {i}"} for i in range(2)]
+    search_client = FakeSearchClient(chunks)
+    documents = FakeContainer()
+    store = store_with(search_client, documents)
+    store.upsert(metadata("a"))
+    store.upsert(metadata("b", {"1": "a-chunk-1"}))
+    processor = object.__new__(DocumentProcessor)
+    processor.metadata_store = store
+    processor.artifact_precomputer = None
+
+    def index_chunks(chunks, metadata):
+        search_client.upload_documents([{"id": f"a-chunk-{i}", "content_id": "a", "content": "new"}
+                                        for i in range(len(chunks))])
+        return len(chunks), {}
+
+    processor._process_and_index_content = index_chunks
+    processor.process_document(text_content="A new version. " * 20, content_id="a", title="A")
+
+    assert search_client.events[0] == ("upload", ["b-chunk-1"])
+    assert search_client.documents["b-chunk-1"]["content"] == "old 1"
+    assert documents.items["b"]["duplicate_chunks"] == {}
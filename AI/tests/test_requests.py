@@ -0,0 +1,102 @@
+from types import SimpleNamespace
+
+import pytest
+
+import index2
+from index2 import (
+    DocumentProcessor,
+    LearningTools,
+    RequestError,
+    create_app,
+    document_artifacts_response,
+    parse_ask_request,
+    parse_file_upload,
+    parse_learning_request,
+    parse_list_request,
+    parse_upload_request,
+)
+
+
+def test_upload_request_kinds():
+    assert parse_upload_request({"url": "https://example.com", "title": "t"})["url"] == "https://example.com"
+    note = parse_upload_request({"text": "hello", "content_id": "c1"})
+    assert note["text_content"] == "hello" and note["source_type"] == "note" and note["content_id"] == "c1"
+    with pytest.raises(RequestError):
+        parse_upload_request({})
+    with pytest.raises(RequestError):
+        parse_upload_request(None)
+
+
+@pytest.mark.parametrize("content_id", ["a/b", "has space", "_leading", "doc-chunk-3", "x" * 200, 42, "a?b"])
+def test_invalid_content_ids_are_rejected(content_id):
+    with pytest.raises(RequestError):
+        parse_upload_request({"text": "hello", "content_id": content_id})
+    with pytest.raises(RequestError):
+        parse_file_upload("a.pdf", {"content_id": content_id})
+
+
+def test_reingesting_an_unknown_document_gets_404(monkeypatch):
+    processor = object.__new__(DocumentProcessor)
+    processor.metadata_store = SimpleNamespace(get=lambda content_id: None)
+    monkeypatch.setattr(index2, "get_services", lambda: SimpleNamespace(document_processor=processor))
+
+    client = create_app().test_client()
+    response = client.post("/api/upload", json={"text": "hello", "content_id": "6f1c2a9e-0b7d-4c1e-9a55-3c2d1e0f4b7a"})
+    assert response.status_code == 404
+    assert client.post("/api/upload", json={"text": "hello", "content_id": "a/b"}).status_code == 400
+
+
+def test_file_upload_needs_a_filename():
+    assert parse_file_upload("a.pdf", {})["title"] == "a.pdf"
+    with pytest.raises(RequestError):
+        parse_file_upload("", {})
+
+
+def test_ask_request():
+    query, filter_criteria, deadline = parse_ask_request({"query": "q", "filter": {"source_type": "pdf"}})
+    assert query == "q" and filter_criteria == {"source_type": "pdf"} and deadline is None
+    with pytest.raises(RequestError):
+        parse_ask_request({"query": ""})
+
+
+def test_learning_request_defaults_and_scope():
+    topic, count, content_ids = parse_learning_request("quiz", {"topic": "t"})
+    assert (topic, count, content_ids) == ("t", 5, [])
+    topic, count, content_ids = parse_learning_request("summary", {"content_id": "a", "content_ids": ["b"]})
+    assert (topic, count, content_ids) == (None, None, ["a", "b"])
+    with pytest.raises(RequestError):
+        parse_learning_request("flashcards", {})
+
+
+def test_document_artifacts_response(monkeypatch):
+    monkeypatch.setattr(LearningTools, "document_quiz", staticmethod(lambda documents, count: ["q"] * count))
+    assert document_artifacts_response("quiz", "ready", [], 2, None) == ({"quiz": ["q", "q"], "precomputed": True},
+                                                                        200)
+    assert document_artifacts_response("summary", "pending", None, None, None) == (
+        {"status": "pending", "summary": ""}, 202)
+    # With a topic, unavailable artifacts fall back to generation
+    assert document_artifacts_response("flashcards", "failed", None, 5, "topic") is None
+
+
+def test_list_request():
+    assert parse_list_request({"limit": "900", "source_type": "pdf"}) == ("pdf", 500, None)
+    assert parse_list_request({})[1] == 50
+
+
+def test_malformed_requests_get_400():
+    client = create_app().test_client()
+    assert client.post("/api/ask", json={}).status_code == 400
+    assert client.post("/api/quiz", json={}).status_code == 400
+    assert client.post("/api/upload", json={}).status_code == 400
+
+
+def test_async_app_shares_validation():
+    import asyncio
+
+    import async_app
+
+    async def statuses():
+        client = async_app.create_app().test_client()
+        return [(await client.post(path, json={})).status_code for path in ("/api/ask", "/api/summary")]
+
+    assert asyncio.run(statuses()) == [400, 400]
@@ -0,0 +1,106 @@
+import asyncio
+import threading
+
+import pytest
+
+from async_app import AsyncSingleFlight
+from index2 import Config, SingleFlight, configured_key_normalizer, exact_query_key
+
+
+def test_concurrent_identical_calls_run_once():
+    flight = SingleFlight("test")
+    started, release = threading.Event(), threading.Event()
+    runs = []
+
+    def func():
+        runs.append(1)
+        started.set()
+        release.wait()
+        return {"answer": [1]}
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("ask", "What is X?", None, func)))
+    leader.start()
+    started.wait()
+    followers = [threading.Thread(target=lambda: results.append(flight.do("ask", "what is x", None, func)))
+                 for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    while flight.stats()["calls"] < 4:
+        pass
+    release.set()
+    for thread in [leader] + followers:
+        thread.join()
+
+    assert len(runs) == 1
+    assert results == [{"answer": [1]}] * 4
+    # Callers get independent copies
+    assert len({id(result) for result in results}) == 4
+    assert flight.stats() == {"calls": 4, "executions": 1, "deduplicated": 3, "in_flight": 0}
+
+
+def test_errors_are_shared_and_not_cached():
+    flight = SingleFlight("test")
+
+    def fail():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        flight.do("ask", "q", None, fail)
+    assert flight.do("ask", "q", None, lambda: 2) == 2
+
+
+def test_params_are_part_of_the_key():
+    flight = SingleFlight("test", exact_query_key)
+    assert flight.make_key("ask", "Q", {"a": 1}) != flight.make_key("ask", "Q", {"a": 2})
+    assert flight.make_key("ask", "Q", None) != flight.make_key("ask", "q", None)
+
+
+def test_configured_key_normalizer(monkeypatch):
+    monkeypatch.setattr(Config, "COALESCE_KEY_NORMALIZER", "exact")
+    assert configured_key_normalizer() is exact_query_key
+    monkeypatch.setattr(Config, "COALESCE_KEY_NORMALIZER", "unknown")
+    with pytest.raises(ValueError):
+        configured_key_normalizer()
+
+
+def test_async_followers_share_the_leader_result():
+    flight = AsyncSingleFlight("test")
+    runs = []
+
+    async def func():
+        runs.append(1)
+        await asyncio.sleep(0.01)
+        return ["result"]
+
+    async def main():
+        return await asyncio.gather(*[flight.do("ask", "q", None, func) for _ in range(5)])
+
+    assert asyncio.run(main()) == [["result"]] * 5
+    assert len(runs) == 1
+    assert flight.stats()["deduplicated"] == 4
+
+
+def test_async_cancelled_leader_does_not_poison_followers():
+    flight = AsyncSingleFlight("test")
+    runs = []
+
+    async def func():
+        runs.append(1)
+        await asyncio.sleep(0.05)
+        return "answer"
+
+    async def main():
+        leader = asyncio.create_task(flight.do("ask", "q", None, func))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do("ask", "q", None, func))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await follower
+
+    assert asyncio.run(main()) == "answer"
+    # The follower ran func itself once the leader was cancelled
+    assert len(runs) == 2
+    assert flight.stats()["in_flight"] == 0
@@ -0,0 +1,114 @@
+import os
+
+import numpy as np
+import pytest
+
+from vector_store import CompactVectorStore, normalize, quantize, dequantize
+
+DIMENSION = 16
+
+
+def random_vectors(count, seed=0):
+    return np.random.default_rng(seed).standard_normal((count, DIMENSION)).astype(np.float32)
+
+
+@pytest.mark.parametrize("quantization", ["int8", "float16", "none"])
+def test_search_finds_each_vector_itself(quantization):
+    vectors = random_vectors(200)
+    store = CompactVectorStore(DIMENSION, quantization)
+    store.add([f"v{i}" for i in range(200)], vectors)
+
+    for i in (0, 57, 199):
+        top_id, score = store.search(vectors[i], top_k=3)[0]
+        assert top_id == f"v{i}" and score == pytest.approx(1.0, abs=1e-3)
+
+
+def test_int8_round_trip_is_close():
+    vectors = normalize(random_vectors(50))
+    codes, scales = quantize(vectors, "int8")
+    assert codes.dtype == np.int8
+    assert np.abs(dequantize(codes, scales) - vectors).max() < 0.01
+
+
+def test_re_adding_an_id_replaces_its_vector():
+    vectors = random_vectors(3)
+    store = CompactVectorStore(DIMENSION)
+    store.add(["a", "b", "c"], vectors)
+    store.add(["b"], vectors[:1])
+
+    assert len(store) == 3
+    assert {vector_id for vector_id, score in store.search(vectors[0], top_k=2)} == {"a", "b"}
+
+
+def test_save_after_load_to_the_same_directory(tmp_path):
+    """Regression: saving over full.npy while it was memory-mapped failed with OSError"""
+    path = str(tmp_path / "store")
+    vectors = random_vectors(300)
+    store = CompactVectorStore(DIMENSION)
+    store.add([f"v{i}" for i in range(200)], vectors[:200])
+    store.save(path)
+
+    loaded = CompactVectorStore.load(path)
+    loaded.save(path)
+    # Replace a memory-mapped row and append new ones, then save over the loaded files
+    loaded.add(["v5"], vectors[250:251])
+    loaded.add([f"v{i}" for i in range(200, 250)], vectors[200:250])
+    loaded.save(path)
+
+    # The store stays usable after saving, and the saved copy holds every change
+    for store_to_check in (loaded, CompactVectorStore.load(path)):
+        assert len(store_to_check) == 250
+        assert store_to_check.search(vectors[220], top_k=1)[0][0] == "v220"
+        assert store_to_check.search(vectors[250], top_k=1)[0][0] == "v5"
+        assert store_to_check.search(vectors[7], top_k=1)[0][0] == "v7"
+    assert not [name for name in os.listdir(path) if name.endswith(".tmp")]
+
+
+def test_saving_an_unchanged_store_skips_the_write(tmp_path):
+    path = str(tmp_path / "store")
+    store = CompactVectorStore(DIMENSION)
+    store.add(["a"], random_vectors(1))
+    store.save(path)
+    written = os.stat(os.path.join(path, "full.npy")).st_mtime_ns
+
+    loaded = CompactVectorStore.load(path)
+    loaded.save(path)
+    assert os.stat(os.path.join(path, "full.npy")).st_mtime_ns == written
+
+    # A clean store can still be copied to another directory
+    loaded.save(str(tmp_path / "copy"))
+    assert len(CompactVectorStore.load(str(tmp_path / "copy"))) == 1
+
+
+def test_adding_to_a_loaded_store_keeps_the_file_mapped(tmp_path):
+    path = str(tmp_path / "store")
+    store = CompactVectorStore(DIMENSION)
+    store.add([f"v{i}" for i in range(100)], random_vectors(100))
+    store.save(path)
+
+    loaded = CompactVectorStore.load(path)
+    loaded.add(["v1"], random_vectors(1, seed=1))
+    assert isinstance(loaded._full, np.memmap)
+    assert loaded.memory_bytes() == store.memory_bytes() + DIMENSION * 4
+
+
+def test_small_batches_match_one_add_and_grow_geometrically(tmp_path):
+    vectors = random_vectors(5000)
+    ids = [f"v{i}" for i in range(5000)]
+    batched = CompactVectorStore(DIMENSION)
+    reallocations = 0
+    for start in range(0, 5000, 16):
+        codes = batched._codes
+        batched.add(ids[start:start + 16], vectors[start:start + 16])
+        reallocations += batched._codes is not codes
+    assert reallocations <= 4
+
+    whole = CompactVectorStore(DIMENSION)
+    whole.add(ids, vectors)
+    assert batched.memory_bytes() == whole.memory_bytes()
+    assert batched.search(vectors[4321], top_k=3) == whole.search(vectors[4321], top_k=3)
+
+    batched.save(str(tmp_path / "batched"))
+    loaded = CompactVectorStore.load(str(tmp_path / "batched"))
+    assert loaded._codes.shape == (5000, DIMENSION)
+    assert loaded.search(vectors[17], top_k=1)[0][0] == "v17"
@@ -0,0 +1,283 @@
+"""Compact local storage for content vectors
+
+Vectors are kept as NumPy arrays end to end. The in-memory copy used for
+scanning is quantized (int8 with a per-vector scale, or float16), and the top
+candidates of each search are rescored exactly against float32 vectors that
+live in a memory-mapped file, so only the rescored rows are read from disk.
+
+    store = CompactVectorStore(quantization="int8")
+    store.add(ids, vectors)
+    store.save("vectors")
+    store = CompactVectorStore.load("vectors")
+    store.search(query_vector, top_k=5)
+
+With keep_full=False the float32 copy is dropped as well, shrinking the disk
+footprint by the same factor at the cost of searching on quantized scores only.
+
+Vectors added to a loaded store are kept in memory next to the memory-mapped
+file until the next save, which writes each file beside the old one and
+swaps it into place, so a store can be saved back to the directory it was
+loaded from. In-memory arrays grow geometrically, so adding vectors in many
+small batches costs the same as adding them at once.
+"""
+import json
+import os
+
+import numpy as np
+
+from index2 import Config
+
+QUANTIZATIONS = ("int8", "float16", "none")
+
+# Rows scored per block so int8 codes are never widened to float32 all at once
+_SCORE_BLOCK_ROWS = 65536
+# Rows copied per block when writing the float32 vectors
+_COPY_BLOCK_ROWS = 65536
+# Rows an in-memory array first grows to; it then doubles whenever it fills up
+_MIN_CAPACITY_ROWS = 1024
+
+
+def normalize(vectors):
+    """L2-normalize rows so that cosine similarity is a dot product"""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def quantize(vectors, quantization):
+    """Return (codes, scales) for float32 rows; scales is None unless int8"""
+    if quantization == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales = np.maximum(scales, 1e-12).astype(np.float32)
+        codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        return codes, scales
+    if quantization == "float16":
+        return vectors.astype(np.float16), None
+    if quantization == "none":
+        return vectors.astype(np.float32), None
+    raise ValueError(f"Unknown quantization: {quantization}")
+
+
+def _reserve(array, rows):
+    """Return array if it has room for rows rows, else a copy with at least twice the room"""
+    if len(array) >= rows:
+        return array
+    grown = np.empty((max(rows, 2 * len(array), _MIN_CAPACITY_ROWS),) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+def dequantize(codes, scales):
+    vectors = codes.astype(np.float32)
+    if scales is not None:
+        vectors *= scales[:, None]
+    return vectors
+
+
+class CompactVectorStore:
+    def __init__(self, dimension=None, quantization=None, rescore_factor=None, keep_full=True):
+        self.dimension = dimension or Config.VECTOR_DIMENSION
+        self.quantization = quantization or Config.VECTOR_QUANTIZATION
+        if self.quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization: {self.quantization}")
+        self.rescore_factor = rescore_factor or Config.VECTOR_RESCORE_FACTOR
+        # Unquantized codes are already exact, so no separate float32 copy is needed
+        self.keep_full = keep_full and self.quantization != "none"
+
+        self.ids = []
+        self._id_positions = {}
+        # Row i of each array belongs to ids[i]; rows past len(ids) are spare capacity
+        self._codes = np.empty((0, self.dimension), dtype=self._code_dtype())
+        self._scales = np.empty(0, dtype=np.float32) if self.quantization == "int8" else None
+        # Exact vectors for rescoring: rows memory-mapped from the saved file, rows
+        # added since in memory, and in-memory replacements of memory-mapped rows
+        self._full = np.empty((0, self.dimension), dtype=np.float32)
+        self._full_added = np.empty((0, self.dimension), dtype=np.float32)
+        self._full_replaced = {}
+        # Directory the store was loaded from or last saved to, and whether it changed since
+        self._path = None
+        self._dirty = False
+
+    def _code_dtype(self):
+        return {"int8": np.int8, "float16": np.float16, "none": np.float32}[self.quantization]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, ids, vectors):
+        """Add float32 vectors; re-adding an existing ID replaces its vector"""
+        vectors = normalize(vectors).reshape(-1, self.dimension)
+        if len(ids) != len(vectors):
+            raise ValueError("ids and vectors must have the same length")
+
+        codes, scales = quantize(vectors, self.quantization)
+        new_rows = [row for row, vector_id in enumerate(ids) if vector_id not in self._id_positions]
+        replaced = [row for row, vector_id in enumerate(ids) if vector_id in self._id_positions]
+
+        if replaced:
+            positions = [self._id_positions[ids[row]] for row in replaced]
+            self._codes[positions] = codes[replaced]
+            if scales is not None:
+                self._scales[positions] = scales[replaced]
+            if self.keep_full:
+                # The memory-mapped file is read-only; replacements are kept until the next save
+                for position, row in zip(positions, replaced):
+                    if position < len(self._full):
+                        self._full_replaced[position] = vectors[row]
+                    else:
+                        self._full_added[position - len(self._full)] = vectors[row]
+
+        if new_rows:
+            start = len(self.ids)
+            end = start + len(new_rows)
+            self._codes = _reserve(self._codes, end)
+            self._codes[start:end] = codes[new_rows]
+            if scales is not None:
+                self._scales = _reserve(self._scales, end)
+                self._scales[start:end] = scales[new_rows]
+            if self.keep_full:
+                self._full_added = _reserve(self._full_added, end - len(self._full))
+                self._full_added[start - len(self._full):end - len(self._full)] = vectors[new_rows]
+            for row in new_rows:
+                self._id_positions[ids[row]] = len(self.ids)
+                self.ids.append(ids[row])
+
+        self._dirty = self._dirty or bool(ids)
+
+    def _full_rows(self, positions):
+        """Exact float32 vectors at the given row positions"""
+        positions = np.asarray(positions)
+        saved = positions < len(self._full)
+        rows = np.empty((len(positions), self.dimension), dtype=np.float32)
+        rows[saved] = self._full[positions[saved]]
+        rows[~saved] = self._full_added[positions[~saved] - len(self._full)]
+        if self._full_replaced:
+            for i in np.flatnonzero(saved):
+                replacement = self._full_replaced.get(int(positions[i]))
+                if replacement is not None:
+                    rows[i] = replacement
+        return rows
+
+    def _approximate_scores(self, query):
+        count = len(self.ids)
+        scores = np.empty(count, dtype=np.float32)
+        for start in range(0, count, _SCORE_BLOCK_ROWS):
+            block = self._codes[start:min(start + _SCORE_BLOCK_ROWS, count)].astype(np.float32)
+            scores[start:start + len(block)] = block @ query
+        if self._scales is not None:
+            scores *= self._scales[:count]
+        return scores
+
+    def search(self, query, top_k=5, rescore=True):
+        """Return [(id, cosine similarity)] for the top_k nearest vectors"""
+        if not self.ids:
+            return []
+        query = normalize(query).reshape(self.dimension)
+        top_k = min(top_k, len(self.ids))
+
+        scores = self._approximate_scores(query)
+        rescore = rescore and self.keep_full
+        candidate_count = min(top_k * self.rescore_factor, len(self.ids)) if rescore else top_k
+        candidates = np.argpartition(-scores, candidate_count - 1)[:candidate_count]
+
+        if rescore and self.quantization != "none":
+            # Exact float32 rescoring of the shortlisted rows only
+            candidates = np.sort(candidates)
+            scores = self._full_rows(candidates) @ query
+        else:
+            scores = scores[candidates]
+
+        order = np.argsort(-scores)[:top_k]
+        return [(self.ids[candidates[i]], float(scores[i])) for i in order]
+
+    def memory_bytes(self):
+        """Bytes of the rows held in memory (excludes the memory-mapped float32 file and spare capacity)"""
+        count = len(self.ids)
+        total = self._codes[:count].nbytes
+        if self._scales is not None:
+            total += self._scales[:count].nbytes
+        if not isinstance(self._full, np.memmap):
+            total += self._full.nbytes
+        if self.keep_full:
+            total += self._full_added[:count - len(self._full)].nbytes
+        total += len(self._full_replaced) * self.dimension * 4
+        return total
+
+    def save(self, path):
+        """Write the store to a directory: quantized codes, scales, float32 vectors and IDs
+
+        Each file is written to a temporary name and then renamed over the old
+        one, so the memory-mapped vectors of a loaded store stay readable while
+        the new file is written. Saving an unchanged store to the directory it
+        was loaded from does nothing.
+        """
+        if not self._dirty and self._path is not None and os.path.abspath(self._path) == os.path.abspath(path):
+            return
+        os.makedirs(path, exist_ok=True)
+
+        count = len(self.ids)
+        _replace_file(os.path.join(path, "codes.npy"), lambda f: np.save(f, self._codes[:count]))
+        if self._scales is not None:
+            _replace_file(os.path.join(path, "scales.npy"), lambda f: np.save(f, self._scales[:count]))
+        if self.keep_full:
+            _replace_file(os.path.join(path, "full.npy"), self._write_full)
+        # The ID list goes last: it names the rows the other files must hold
+        _replace_file(os.path.join(path, "store.json"), lambda f: f.write(json.dumps({
+            "dimension": self.dimension,
+            "quantization": self.quantization,
+            "rescore_factor": self.rescore_factor,
+            "keep_full": self.keep_full,
+            "ids": self.ids
+        }).encode("utf-8")))
+
+        if self.keep_full:
+            self._map_full(path)
+        self._path = path
+        self._dirty = False
+
+    def _write_full(self, f):
+        """Stream the float32 vectors to a file in blocks, without loading the memory-mapped rows at once"""
+        np.lib.format.write_array_header_1_0(f, {
+            "descr": np.lib.format.dtype_to_descr(np.dtype(np.float32)),
+            "fortran_order": False,
+            "shape": (len(self.ids), self.dimension)
+        })
+        for start in range(0, len(self.ids), _COPY_BLOCK_ROWS):
+            positions = np.arange(start, min(start + _COPY_BLOCK_ROWS, len(self.ids)))
+            f.write(np.ascontiguousarray(self._full_rows(positions)).tobytes())
+
+    def _map_full(self, path):
+        self._full = np.load(os.path.join(path, "full.npy"), mmap_mode="r")
+        self._full_added = np.empty((0, self.dimension), dtype=np.float32)
+        self._full_replaced = {}
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "store.json")) as f:
+            info = json.load(f)
+        store = cls(info["dimension"], info["quantization"], info["rescore_factor"], info["keep_full"])
+        store.ids = info["ids"]
+        store._id_positions = {vector_id: i for i, vector_id in enumerate(store.ids)}
+        store._codes = np.load(os.path.join(path, "codes.npy"))
+        if store.quantization == "int8":
+            store._scales = np.load(os.path.join(path, "scales.npy"))
+        if store.keep_full:
+            store._map_full(path)
+        store._path = path
+        return store
+
+    def disk_bytes(self, path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def _replace_file(path, write):
+    """Write a file under a temporary name, then rename it over path"""
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            write(f)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
@@ -0,0 +1,7 @@
+"""WSGI entry point for pre-fork servers
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+"""
+from index2 import create_app
+
+app = create_app()